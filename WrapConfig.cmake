@@ -23,6 +23,11 @@ if (NOT Wrap_CONFIG_LOADED)
   #
   # Optionally, flags may be supplied to pass to the wrapper generator.
   #
+  # If the flags include --shards N, the extra files wrap.py generates (a
+  # header and shards <name>_1 ... <name>_<N-1>) are outputs of the command too.
+  # All generated sources are returned to the caller in WRAP_OUTPUTS, so they
+  # can be added to a library together.
+  #
   function(add_wrapped_file file_name wrapper_name)
     set(file_path    ${CMAKE_CURRENT_BINARY_DIR}/${file_name})
     set(wrapper_path ${CMAKE_CURRENT_SOURCE_DIR}/${wrapper_name})
@@ -94,23 +99,58 @@ if (NOT Wrap_CONFIG_LOADED)
       endif()
     endif()
 
-    # Mark target file as generated so the build system knows what to do w/it
-    set_source_files_properties(${file_path} PROPERTIES GENERATED TRUE)
+    # With --shards N, wrap.py writes a header and N-1 more files next to file_path.
+    set(file_paths ${file_path})
+    set(file_names ${file_name})
+    if ("${wrap_flags}" MATCHES "--shards[= ;]+([0-9]+)")
+      set(wrap_shards ${CMAKE_MATCH_1})
+      # Only the last extension is replaced, as wrap.py does.
+      string(REGEX MATCH "\\.[^./]*$" file_ext "${file_name}")
+      string(REGEX REPLACE "\\.[^./]*$" "" file_stem "${file_name}")
+      list(APPEND file_names ${file_stem}.h)
+      if (wrap_shards GREATER 1)
+        math(EXPR last_shard "${wrap_shards} - 1")
+        foreach(shard RANGE 1 ${last_shard})
+          list(APPEND file_names ${file_stem}_${shard}${file_ext})
+        endforeach()
+      endif()
+      set(file_paths "")
+      foreach(name ${file_names})
+        list(APPEND file_paths ${CMAKE_CURRENT_BINARY_DIR}/${name})
+      endforeach()
+    endif()
+
+    # Mark target files as generated so the build system knows what to do w/them
+    set_source_files_properties(${file_paths} PROPERTIES GENERATED TRUE)
+
+    # Have wrap.py write a depfile listing mpi.h and the headers it includes, so
+    # wrappers are regenerated when the MPI installation changes.  Makefile
+    # generators only support DEPFILE as of CMake 3.20.
+    set(wrap_depfile_flags "")
+    set(wrap_depfile_args  "")
+    if (CMAKE_GENERATOR MATCHES "Ninja" OR NOT CMAKE_VERSION VERSION_LESS 3.20)
+      set(depfile_path ${file_path}.d)
+      set(wrap_depfile_flags -MF ${depfile_path})
+      set(wrap_depfile_args  DEPFILE ${depfile_path})
+    endif()
 
     # Add a command to automatically wrap files.
     add_custom_command(
-      OUTPUT  ${file_path}
+      OUTPUT  ${file_paths}
       COMMAND ${command}
-      ARGS    ${script_arg} ${wrap_compiler} ${wrap_includes} ${wrap_flags} ${wrapper_path} -o ${file_path}
+      ARGS    ${script_arg} ${wrap_compiler} ${wrap_includes} ${wrap_flags} ${wrap_depfile_flags} ${wrapper_path} -o ${file_path}
       WORKING_DIRECTORY "${CMAKE_CURRENT_BINARY_DIR}"
       DEPENDS ${wrapper_path}
+      ${wrap_depfile_args}
       COMMENT "Generating ${wrap_lang} code for ${file_name} from ${wrapper_name}"
       VERBATIM)
 
     # Add generated files to list of things to be cleaned for the directory.
     get_directory_property(cleanfiles ADDITIONAL_MAKE_CLEAN_FILES)
-    list(APPEND cleanfiles ${file_name})
+    list(APPEND cleanfiles ${file_names})
     set_directory_properties(PROPERTIES ADDITIONAL_MAKE_CLEAN_FILES "${cleanfiles}")
+
+    set(WRAP_OUTPUTS ${file_paths} PARENT_SCOPE)
   endfunction()
 
 endif()
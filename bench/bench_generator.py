@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Benchmarks wrap.py's whole pipeline on synthetic MPI headers.
+
+Uses fake_mpicc.py in place of mpicc, so no MPI installation is needed.  For
+each header size (a number of synthetic MPI functions), it times:
+
+    mpi.h     running the fake mpicc and scanning its output for declarations
+    generate  parsing a tool-like wrapper file and expanding it into C and
+              Fortran wrappers (-f -g) for every function
+
+and reports throughput and the peak memory the pipeline allocated.  Times
+are the best of -r repetitions.  Peak memory is measured with tracemalloc in
+a separate run, since tracing slows everything down.
+
+    bench_generator.py [-r reps] [-w wrapper.w] [--wrap other/wrap.py] [functions ...]
+
+-w benchmarks your own wrapper file instead of the built-in one.  --wrap runs
+the benchmark on another copy of wrap.py (see bench_parser.py).  The function
+counts default to 500 2000 8000.
+"""
+from __future__ import print_function
+import getopt, os, sys, tempfile, time
+from bench_parser import load_wrap
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Wrapper file in the style of a simple tracing tool.
+tool = """\
+#include <stdio.h>
+static double total_time = 0;
+static int calls[1 << 16];
+
+// Time and count every MPI function.
+{{fnall fn_name MPI_Init MPI_Finalize MPI_Wtime MPI_Wtick}}
+    double start = PMPI_Wtime();
+    {{callfn}}
+    total_time += PMPI_Wtime() - start;
+    calls[{{fn_num}}]++;
+{{endfnall}}
+
+{{fn fn_name MPI_Init}}
+    {{callfn}}
+    fprintf(stderr, "Tracing {{fn_name}}\\n");
+{{endfn}}
+
+{{fn fn_name MPI_Finalize}}
+    fprintf(stderr, "%f seconds in MPI\\n", total_time);
+    {{callfn}}
+{{endfn}}
+
+/* Table of argument types. */
+{{forallfn fn_name MPI_Wtime MPI_Wtick}}
+    /* {{fn_name}}: {{sub {{types}} '\\*' ' ptr'}} */
+{{endforallfn}}
+"""
+
+def fake_mpicc(functions):
+    """Command line for the fake mpicc with a number of synthetic functions."""
+    return "%s %s -n %d" % (sys.executable, os.path.join(bench_dir, "fake_mpicc.py"), functions)
+
+def run(wrap_path, wrapper_file, functions):
+    """Runs the pipeline once on a fresh copy of wrap.py.  Returns the time to
+       load mpi.h, the time to generate, the number of functions, and the size
+       of the output."""
+    wrap = load_wrap(wrap_path)
+    wrap.configure(mpicc=fake_mpicc(functions), use_cache=False,
+                   output_fortran_wrappers=True, output_guards=True)
+
+    start = time.time()
+    wrap.load_mpi_functions()
+    loaded = time.time()
+    code = wrap.generate([wrapper_file])
+    done = time.time()
+    return loaded - start, done - loaded, len(wrap.mpi_functions), len(code)
+
+def peak_memory(wrap_path, wrapper_file, functions):
+    """Peak bytes allocated by one run of the pipeline, or None without tracemalloc."""
+    if not tracemalloc:
+        return None
+    tracemalloc.start()
+    try:
+        run(wrap_path, wrapper_file, functions)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "r:w:", ["wrap="])
+    opts = dict(opts)
+    reps = int(opts.get("-r", 3))
+    wrap_path = opts.get("--wrap", os.path.join(bench_dir, "..", "wrap.py"))
+    sizes = [int(a) for a in args] or [500, 2000, 8000]
+
+    wrapper_file = opts.get("-w")
+    if not wrapper_file:
+        fd, wrapper_file = tempfile.mkstemp(suffix=".w")
+        with os.fdopen(fd, "w") as f:
+            f.write(tool)
+
+    try:
+        print("%-8s %10s %10s %10s %10s %10s %10s" %
+              ("fns", "mpi.h s", "fns/s", "gen s", "out MB", "MB/s", "peak MB"))
+        for functions in sizes:
+            best = None
+            for i in range(reps):
+                result = run(wrap_path, wrapper_file, functions)
+                if best is None:
+                    best = list(result)
+                best[0] = min(best[0], result[0])
+                best[1] = min(best[1], result[1])
+            load_time, gen_time, nfunctions, size = best
+            mb = size / (1024.0 * 1024.0)
+
+            peak = peak_memory(wrap_path, wrapper_file, functions)
+            peak = "%10.1f" % (peak / (1024.0 * 1024.0)) if peak is not None else "%10s" % "-"
+            print("%-8d %10.3f %10.0f %10.3f %10.2f %10.2f %s" %
+                  (nfunctions, load_time, nfunctions / load_time, gen_time, mb, mb / gen_time, peak))
+    finally:
+        if not opts.get("-w"):
+            os.remove(wrapper_file)
+
+if __name__ == "__main__":
+    main()
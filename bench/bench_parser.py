@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Benchmarks wrap.py's lexer and parser on large generated wrapper files.
+
+Generates .w files of increasing size and reports the time to lex and parse
+each one.  Parsing should take time linear in the size of the input, so the
+time per megabyte should stay about the same as the files get bigger.
+
+    bench_parser.py [-s] [-r reps] [--wrap other/wrap.py] [size_mb ...]
+
+--wrap runs the benchmark on another copy of wrap.py, e.g. an older version
+saved with 'git show <rev>:wrap.py > old_wrap.py', for comparison.  It first
+checks that both copies parse the examples and a generated file into the same
+chunk trees, and stops if they don't.  -s uses the lexer for non-C output
+(wrap.py -s).  Sizes default to 1 2 4 8.
+"""
+from __future__ import print_function
+import getopt, os, sys, time, types
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+
+# One block of wrapper code, roughly what a real tool looks like: C text,
+# comments (with a long block comment), and nested and quoted macro arguments.
+block = """\
+/* ----------------------------------------------------------------------
+ * Block %(n)d.  %(comment)s
+ * ---------------------------------------------------------------------- */
+static double time_%(n)d_{{fileno}} = 0;   // per-file accumulator
+{{fn fn_name MPI_Send MPI_Recv MPI_Isend MPI_Irecv}}
+    double start = PMPI_Wtime();
+    {{callfn}}
+    time_%(n)d_{{fileno}} += PMPI_Wtime() - start;
+    if (0) printf("{{fn_name}}({{list {{argList}}}}) -> %%d\\n", {{ret_val}});
+    {{def types {{sub {{types}} "(\\\\*|const )" ""}}}}
+    {{apply_to_type MPI_Comm swap_world}}
+{{endfn}}
+{{forallfn fn_name MPI_Wtime MPI_Wtick}}
+    /* {{fn_name}} */ int {{fn_name}}_count_%(n)d = {{filter '^MPI_Comm' {{types}}}};
+{{endforallfn}}
+"""
+
+comment = "A long comment that spans many lines to exercise comment lexing. " * 20
+
+def make_wrapper(size):
+    """Returns wrapper code about size bytes long."""
+    blocks = []
+    total = 0
+    n = 0
+    while total < size:
+        text = block % {"n" : n, "comment" : comment.replace(". ", ".\n * ")}
+        blocks.append(text)
+        total += len(text)
+        n += 1
+    return "".join(blocks)
+
+def load_wrap(path):
+    """Loads a copy of wrap.py as a module.  Older copies run their command line
+       when loaded, so they're run with no arguments, which stops them with a usage
+       message once everything is defined."""
+    wrap = types.ModuleType("bench_wrap")
+    wrap.__file__ = path
+    argv, stderr = sys.argv, sys.stderr
+    sys.argv, sys.stderr = [path], StringIO()
+    try:
+        with open(path) as f:
+            exec(compile(f.read(), path, "exec"), wrap.__dict__)
+    except SystemExit:
+        pass
+    finally:
+        sys.argv, sys.stderr = argv, stderr
+    return wrap
+
+def chunk_tree(chunk):
+    """A chunk as nested tuples of its macro, text, args, and children, for comparing
+       the trees that different copies of wrap.py parse.  Line numbers are left out,
+       since older copies don't have them."""
+    if not isinstance(chunk, (list, tuple)) and not hasattr(chunk, "macro"):
+        return chunk    # A plain string argument.
+    if isinstance(chunk, (list, tuple)):
+        return tuple(chunk_tree(c) for c in chunk)
+    return (chunk.macro, chunk.text, chunk_tree(chunk.args), chunk_tree(chunk.children))
+
+def check_same_trees(wrap, other, texts):
+    """Exits with an error if wrap and other parse any of texts into different trees."""
+    for name, text in texts:
+        trees = [chunk_tree(w.Parser(w.macros).parse(text)) for w in (wrap, other)]
+        if trees[0] != trees[1]:
+            sys.stderr.write("Error: %s parses differently with %s.\n" % (name, other.__file__))
+            sys.exit(1)
+        print("%s: same chunk trees" % name)
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "sr:", ["wrap="])
+    opts = dict(opts)
+    reps = int(opts.get("-r", 3))
+    wrap_path = os.path.join(bench_dir, "..", "wrap.py")
+    wrap = load_wrap(opts.get("--wrap", wrap_path))
+    wrap.skip_headers = "-s" in opts
+    sizes = [float(a) for a in args] or [1, 2, 4, 8]
+
+    if "--wrap" in opts:
+        current = load_wrap(wrap_path)
+        current.skip_headers = wrap.skip_headers
+        examples = os.path.join(bench_dir, "..", "examples")
+        texts = [("generated", make_wrapper(64 * 1024))]
+        for name in sorted(os.listdir(examples)):
+            if name.endswith(".w"):
+                with open(os.path.join(examples, name)) as f:
+                    texts.append((name, f.read()))
+        check_same_trees(current, wrap, texts)
+
+    print("%-8s %10s %10s %10s" % ("MB", "seconds", "s/MB", "MB/s"))
+    for mb in sizes:
+        text = make_wrapper(int(mb * 1024 * 1024))
+        best = None
+        for i in range(reps):
+            start = time.time()
+            wrap.Parser(wrap.macros).parse(text)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        size = len(text) / (1024.0 * 1024.0)
+        print("%-8.2f %10.3f %10.3f %10.2f" % (size, best, best / size, size / best))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Stand-in for 'mpicc -E' that prints a synthetic preprocessed mpi.h.
+
+wrap.py finds MPI functions by running 'mpicc -E' on a file that includes
+mpi.h.  This script prints what that looks like, so wrap.py can be run and
+benchmarked without an MPI installation:
+
+    wrap.py -c "python bench/fake_mpicc.py -n 5000" -o out.c tool.w
+
+The output has line markers for a few headers, typedefs and other noise,
+the real MPI functions that take handle arrays, and -n synthetic functions
+(default 1000) with a mix of signatures: handles, requests and statuses,
+count and displacement arrays, '...' arguments, multi-word types like
+'unsigned long long', declarations split across several lines, and
+large-count _c variants.  It is the same every time for the same -n.
+
+    fake_mpicc.py [-n functions] [-E] [-I dir ...] [file.c]
+
+Other compiler flags are ignored.
+"""
+from __future__ import print_function
+import sys
+
+# Real MPI functions, including every one wrap.py converts handle arrays for.
+real_functions = """\
+int MPI_Init(int *argc, char ***argv);
+int MPI_Finalize(void);
+int MPI_Pcontrol(const int level, ...);
+double MPI_Wtime(void);
+double MPI_Wtick(void);
+int MPI_Comm_rank(MPI_Comm comm, int *rank);
+int MPI_Comm_size(MPI_Comm comm, int *size);
+int MPI_Send(const void *buf, int count, MPI_Datatype datatype, int dest,
+             int tag, MPI_Comm comm);
+int MPI_Recv(void *buf, int count, MPI_Datatype datatype, int source,
+             int tag, MPI_Comm comm, MPI_Status *status);
+int MPI_Startall(int count, MPI_Request array_of_requests[]);
+int MPI_Testall(int count, MPI_Request array_of_requests[], int *flag,
+                MPI_Status array_of_statuses[]);
+int MPI_Testany(int count, MPI_Request array_of_requests[], int *indx,
+                int *flag, MPI_Status *status);
+int MPI_Testsome(int incount, MPI_Request array_of_requests[], int *outcount,
+                 int array_of_indices[], MPI_Status array_of_statuses[]);
+int MPI_Type_create_struct(int count, const int array_of_blocklengths[],
+                           const MPI_Aint array_of_displacements[],
+                           const MPI_Datatype array_of_types[],
+                           MPI_Datatype *newtype);
+int MPI_Type_get_contents(MPI_Datatype datatype, int max_integers,
+                          int max_addresses, int max_datatypes,
+                          int array_of_integers[],
+                          MPI_Aint array_of_addresses[],
+                          MPI_Datatype array_of_datatypes[]);
+int MPI_Waitall(int count, MPI_Request array_of_requests[],
+                MPI_Status *array_of_statuses);
+int MPI_Waitany(int count, MPI_Request array_of_requests[], int *indx,
+                MPI_Status *status);
+int MPI_Waitsome(int incount, MPI_Request array_of_requests[],
+                 int *outcount, int array_of_indices[],
+                 MPI_Status array_of_statuses[]);
+"""
+
+# Signatures for synthetic functions.  %(n)d makes each name unique.
+signatures = [
+    ("int", "MPI_Bench_send_%(n)d", ["const void *buf", "int count", "MPI_Datatype datatype",
+                                     "int dest", "int tag", "MPI_Comm comm"]),
+    ("int", "MPI_Bench_isend_%(n)d", ["const void *buf", "int count", "MPI_Datatype datatype",
+                                      "int dest", "int tag", "MPI_Comm comm",
+                                      "MPI_Request *request"]),
+    ("int", "MPI_Bench_wait_%(n)d", ["MPI_Request *request", "MPI_Status *status"]),
+    ("int", "MPI_Bench_alltoallv_%(n)d", ["const void *sendbuf", "const int sendcounts[]",
+                                          "const int sdispls[]", "MPI_Datatype sendtype",
+                                          "void *recvbuf", "const int recvcounts[]",
+                                          "const int rdispls[]", "MPI_Datatype recvtype",
+                                          "MPI_Comm comm"]),
+    ("int", "MPI_Bench_group_%(n)d", ["MPI_Group group", "int n", "const int ranks[]",
+                                      "MPI_Group *newgroup"]),
+    ("int", "MPI_Bench_win_%(n)d", ["void *base", "MPI_Aint size", "int disp_unit",
+                                    "MPI_Info info", "MPI_Comm comm", "void *baseptr",
+                                    "MPI_Win *win"]),
+    ("int", "MPI_Bench_file_%(n)d", ["MPI_File fh", "MPI_Offset offset", "void *buf",
+                                     "int count", "MPI_Datatype datatype",
+                                     "MPI_Status *status"]),
+    ("int", "MPI_Bench_ctl_%(n)d", ["const int level", "..."]),
+    ("int", "MPI_Bench_counter_%(n)d", ["unsigned long long value", "long long *result",
+                                        "unsigned flags", "MPI_Comm comm"]),
+    ("double", "MPI_Bench_time_%(n)d", ["void"]),
+    ("int", "MPI_Bench_send_%(n)d_c", ["const void *buf", "MPI_Count count",
+                                       "MPI_Datatype datatype", "int dest", "int tag",
+                                       "MPI_Comm comm"]),
+]
+
+# Text between declarations, as it comes out of the preprocessor.
+noise = """\
+typedef struct ompi_bench_t_%(n)d *MPI_Bench_handle_%(n)d;
+typedef int (MPI_Bench_callback_%(n)d)(MPI_Comm, int, void *, void *);
+extern struct ompi_predefined_bench_t ompi_mpi_bench_%(n)d;
+struct bench_status_%(n)d {
+    int MPI_SOURCE;
+    int MPI_TAG;
+    int MPI_ERROR;
+};
+extern int bench_helper_%(n)d(const char *name, int len);
+"""
+
+def declaration(n):
+    """Text of the nth synthetic declaration."""
+    rtype, name, args = signatures[n % len(signatures)]
+    name = name % {"n" : n}
+    prefix = '__attribute__((visibility("default"))) ' if n % 3 == 0 else ""
+    if n % 2 == 0:
+        # Split across lines, as headers that wrap long argument lists do.
+        indent = " " * len("%s%s %s(" % (prefix, rtype, name))
+        return "%s%s %s(%s);\n" % (prefix, rtype, name, (",\n" + indent).join(args))
+    return "%s%s %s(%s);\n" % (prefix, rtype, name, ", ".join(args))
+
+def preprocessed_header(functions, source="conftest.c"):
+    """Returns preprocessed text with the real functions and n synthetic ones."""
+    parts = ['# 1 "%s"\n' % source,
+             '# 1 "<built-in>"\n',
+             '# 1 "%s"\n' % source,
+             '# 1 "/opt/bench-mpi/include/mpi.h" 1\n',
+             '# 1 "/usr/include/stddef.h" 1 3 4\n',
+             'typedef long unsigned int size_t;\n',
+             '# 2 "/opt/bench-mpi/include/mpi.h" 2\n',
+             'typedef long MPI_Aint;\n',
+             'typedef long long MPI_Offset;\n',
+             'typedef long long MPI_Count;\n',
+             real_functions]
+    for n in range(functions):
+        if n % 100 == 0:
+            parts.append('# %d "/opt/bench-mpi/include/mpi_ext_%d.h" 1\n' % (n + 1, n // 100))
+        if n % 10 == 0:
+            parts.append(noise % {"n" : n})
+        parts.append(declaration(n))
+    parts.append('# 3 "%s" 2\n' % source)
+    return "".join(parts)
+
+def main():
+    functions = 1000
+    source = "conftest.c"
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == "-n":
+            functions = int(args.pop(0))
+        elif arg.startswith("-n"):
+            functions = int(arg[2:])
+        elif arg == "-I":
+            args.pop(0)
+        elif not arg.startswith("-"):
+            source = arg
+    sys.stdout.write(preprocessed_header(functions, source))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Checks that --profile counts the same macro calls in serial and parallel batch runs.
+
+Batch mode reuses the chunks parsed from a wrapper file for every output that uses it,
+and each worker of a parallel run profiles into its own Profile.  Reused chunks must
+report to the current run's Profile, or calls go missing from the merged report.
+
+    python -m unittest discover tests
+"""
+from __future__ import print_function
+import json, os, shutil, subprocess, sys, tempfile, unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+wrap_py = os.path.join(root, "wrap.py")
+fake_mpicc = "%s %s -n 50" % (sys.executable, os.path.join(root, "bench", "fake_mpicc.py"))
+
+class ProfileBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(root, "examples", "tutorial.w"), os.path.join(self.dir, "tool.w"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def macro_calls(self, jobs, outputs):
+        """Runs a batch that generates outputs from tool.w, and returns the calls the
+           profile reports for each macro."""
+        profile = os.path.join(self.dir, "profile-%d.json" % jobs)
+        rules = ["tool.w=out%d.c" % i for i in range(outputs)]
+        subprocess.check_call([sys.executable, wrap_py, "-c", fake_mpicc, "--no-cache",
+                               "-b", "-j", str(jobs), "--profile", profile] + rules,
+                              cwd=self.dir)
+        with open(profile) as f:
+            timers = json.load(f)["timers"]
+        return dict((name, timer["calls"]) for name, timer in timers.items()
+                    if name.startswith("macro:"))
+
+    def test_parallel_matches_serial(self):
+        once = self.macro_calls(1, 1)
+        serial = self.macro_calls(1, 4)
+        parallel = self.macro_calls(2, 4)
+        self.assertTrue(once)
+        self.assertEqual(serial, dict((name, 4 * calls) for name, calls in once.items()))
+        self.assertEqual(parallel, serial)
+
+if __name__ == "__main__":
+    unittest.main()
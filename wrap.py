@@ -32,28 +32,71 @@
 #################################################################################################
 from __future__ import print_function
 usage_string = \
-'''Usage: wrap.py [-fgd] [-i pmpi_init] [-c mpicc_name] [-o file] wrapper.w [...]
+'''Usage: wrap.py [-fagted] [-i pmpi_init] [-c mpicc_name] [-o file] wrapper.w [...]
+       wrap.py -b [-fagted] [-i pmpi_init] [-c mpicc_name] wrapper.w=output [...]
  Python script for creating PMPI wrappers. Roughly follows the syntax of
    the Argonne PMPI wrapper generator, with some enhancements.
  Options:"
    -d             Just dump function declarations parsed out of mpi.h
    -f             Generate fortran wrappers in addition to C wrappers.
+   -a             With -f, define each Fortran wrapper once, as mpi_foo_, and make the
+                  other name manglings (MPI_FOO, mpi_foo, mpi_foo__) aliases of it where
+                  the compiler supports aliases.  Elsewhere they call mpi_foo_.
    -g             Generate reentry guards around wrapper functions.
+   -t             Like -g, but each thread has its own guard, so that under
+                  MPI_THREAD_MULTIPLE calls on one thread don't skip wrappers on others.
    -s             Skip writing #includes, #defines, and other front-matter (for non-C output).
    -c exe         Provide name of MPI compiler (for parsing mpi.h).  Default is \'mpicc\'.
    -I dir         Provide an extra include directory to use when parsing mpi.h.
    -i pmpi_init   Specify proper binding for the fortran pmpi_init function.
                   Default is \'pmpi_init_\'.  Wrappers compiled for PIC will guess the
                   right binding automatically (use -DPIC when you compile dynamic libs).
-   -o file        Send output to a file instead of stdout.
+   -o file        Send output to a file instead of stdout.  The file is only
+                  rewritten if the generated code has changed.
+   -MF depfile    Write a Makefile-style dependency file listing the wrapper files,
+                  mpi.h, and every header it includes, as a C compiler would.
+   -j jobs        Expand function bodies, and generate batch outputs, on this many
+                  processes.  Output is identical to a serial run.
+   --shards n     Split wrappers for different functions across n C files that can be
+                  compiled in parallel.  With -o out.c, writes out.h, out.c, out_1.c,
+                  ..., out_<n-1>.c.  See README for how globals are handled.
+   -e             Make wrappers check a runtime mask of enabled functions, set from
+                  the $WRAP_ENABLE list of functions and categories at MPI_Init and
+                  changed with MPI_Pcontrol.  Disabled wrappers just call PMPI.
+   --sample n     Run wrapper bodies on about 1 in n calls to each function, per thread,
+                  at random.  Other calls go straight to the PMPI function.  Use {{sample_weight}}
+                  to scale statistics.  MPI_Init, MPI_Init_thread, MPI_Finalize and
+                  MPI_Pcontrol wrappers always run.
+   --sample-interval us
+                  Also skip calls until this many microseconds have passed since the
+                  function was last sampled.  The clock is read every --sample calls.
+   -b             Batch mode.  Each argument is wrapper.w=output, and each output is
+                  generated as if by a separate run with -o.  Wrapper files mapped to
+                  the same output are generated into it together, in order.
    -w             Do not print compiler warnings for deprecated MPI functions.
                   This option will add macros around {{callfn}} to disable (and
                   restore) the compilers diagnostic functions, if the compiler
                   supports this functionality.
+   --watch        After generating, keep running and regenerate outputs whenever their
+                  wrapper files, mpi.h, or headers it includes change.  mpi.h and
+                  unchanged wrapper files are not parsed again.  Needs -o or -b.
+   --profile file Write a JSON report of where the run spent its time (running the
+                  preprocessor, scanning mpi.h, lexing, parsing, and each macro) and
+                  how many bytes it generated for each MPI function and wrapper file.
+                  Use '-' to write the report to stderr.
+   --no-cache     Don't read or write the cache of declarations parsed out of mpi.h
+                  and of parsed wrapper files.
+   --clear-cache  Delete everything in the cache before running.
+   --cache-dir d  Directory for the cache.  Default is $WRAP_CACHE_DIR,
+                  or $XDG_CACHE_HOME/wrap.py (~/.cache/wrap.py).
 
  by Todd Gamblin, tgamblin@llnl.gov
 '''
-import tempfile, getopt, subprocess, sys, os, re, types, itertools
+import tempfile, getopt, subprocess, sys, os, re, types, itertools, hashlib, json, glob, time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 # Default values for command-line parameters
 mpicc = 'mpicc'                    # Default name for the MPI compiler
@@ -61,9 +104,19 @@ includes = []                      # Default set of directories to inlucde when
 pmpi_init_binding = "pmpi_init_"   # Default binding for pmpi_init
 output_fortran_wrappers = False    # Don't print fortran wrappers by default
 output_guards = False              # Don't print reentry guards by default
+thread_local_guards = False        # Make reentry guards thread-local (with output_guards)
+fortran_aliases = False            # Make Fortran bindings aliases of one definition where possible
 skip_headers = False               # Skip header information and defines (for non-C output)
 dump_prototypes = False            # Just exit and dump MPI protos if false.
 ignore_deprecated = False          # Do not print compiler warnings for deprecated MPI functions
+use_cache = True                   # Cache declarations and parsed wrapper files between runs
+clear_cache = False                # Delete cached declarations before running
+cache_dir = None                   # Cache directory.  None means use default_cache_dir()
+jobs = 1                           # Number of processes to expand function bodies with
+sample_period = 1                  # Run wrapper bodies on 1 in this many calls to each function
+sample_interval = 0                # Microseconds between sampled calls to a function (0 for none)
+runtime_enable = False             # Check a runtime mask of enabled functions in wrappers
+shards = 1                         # Number of translation units to split wrappers into
 
 # Possible legal bindings for the fortran version of PMPI_Init()
 pmpi_init_bindings = ["PMPI_INIT", "pmpi_init", "pmpi_init_", "pmpi_init__"]
@@ -78,18 +131,23 @@ rtypes = ['int', 'double', 'MPI_Aint' ]
 # If we find these strings in a declaration, exclude it from consideration.
 exclude_strings = [ "c2f", "f2c", "typedef", "MPI_T_", "MPI_Comm_spawn" ]
 
-# Regular expressions for start and end of declarations in mpi.h. These are
-# used to get the declaration strings out for parsing with formal_re below.
-begin_decl_re = re.compile("(" + "|".join(rtypes) + r")\s+(MPI_\w+)\s*\(")
-exclude_re =    re.compile("|".join(exclude_strings))
-end_decl_re =   re.compile(r"\).*\;")
+# Regular expression for scanning preprocessed mpi.h.  It matches either of:
+#   - the start of a declaration, up to the open paren.  Groups: return type, name.
+#   - a preprocessor line marker, e.g. '# 1 "/usr/include/mpi.h" 1'.  These tell us
+#     which headers were read while preprocessing mpi.h.  Group: header path.
+mpi_h_re = re.compile(
+    r"\b(" + "|".join(rtypes) + r")\s+(MPI_\w+)\s*\(" +
+    r'|^[ \t]*#[ \t]*(?:line[ \t]+)?\d+[ \t]+"((?:[^"\\\n]|\\.)*)"', re.M)
+exclude_re = re.compile("|".join(exclude_strings))
 
 # Regular Expression for splitting up args. Matching against this
 # returns three groups: type info, arg name, and array info
 formal_re = re.compile(
     r"\s*(" +                       # Start type
     r"(?:const)?\s*" +              # Initial const
-    r"\w+"                          # Type name (note: doesn't handle 'long long', etc. right now)
+    r"(?:(?:unsigned|signed|long|short)\b" +                  # Builtin type, e.g.
+    r"(?:\s+(?:unsigned|signed|long|short|int|char|double)\b)*" + # 'unsigned long long',
+    r"|\w+)"                        # or type name
     r")\s*(" +                      # End type, begin pointers
     r"(?:\s*\*(?:\s*const)?)*" +    # Look for 0 or more pointers with optional 'const'
     r")\s*"                         # End pointers
@@ -161,6 +219,1322 @@ wrapper_diagnosics_macros = '''
 
 '''
 
+# Storage class for per-thread variables in generated code: C11/C++11 thread-locals,
+# or the compiler extensions that predate them.  Where none is available, variables
+# fall back to ordinary globals, and WRAP_NO_THREAD_LOCAL is defined.
+wrapper_thread_local = '''
+#ifndef WRAP_THREAD_LOCAL
+#if defined(__cplusplus) && __cplusplus >= 201103L
+#define WRAP_THREAD_LOCAL thread_local
+#elif defined(__STDC_VERSION__) && __STDC_VERSION__ >= 201112L
+#define WRAP_THREAD_LOCAL _Thread_local
+#elif defined(__GNUC__) || defined(__clang__) || defined(__INTEL_COMPILER) || \\
+      defined(__IBMC__) || defined(__SUNPRO_C) || defined(__PGI)
+#define WRAP_THREAD_LOCAL __thread
+#elif defined(_MSC_VER)
+#define WRAP_THREAD_LOCAL __declspec(thread)
+#else
+#define WRAP_THREAD_LOCAL
+#define WRAP_NO_THREAD_LOCAL 1
+#endif
+#endif /* WRAP_THREAD_LOCAL */
+
+'''
+
+# Compiler-specific attributes for generated code.
+wrapper_attributes = '''
+#ifndef WRAP_UNUSED
+#if defined(__GNUC__) || defined(__clang__)
+#define WRAP_UNUSED __attribute__((unused))
+#else
+#define WRAP_UNUSED
+#endif
+#endif /* WRAP_UNUSED */
+
+#ifndef WRAP_LIKELY
+#if defined(__GNUC__) || defined(__clang__)
+#define WRAP_LIKELY(x)   __builtin_expect(!!(x), 1)
+#define WRAP_UNLIKELY(x) __builtin_expect(!!(x), 0)
+#else
+#define WRAP_LIKELY(x)   (x)
+#define WRAP_UNLIKELY(x) (x)
+#endif
+#endif /* WRAP_LIKELY */
+
+'''
+
+# Atomic compare-and-swap for the few places where threads share data: the GCC
+# builtin, which GCC, clang, and Intel support, or a plain comparison otherwise.
+wrapper_atomics = '''
+#ifndef WRAP_CAS
+#if defined(__GNUC__) || defined(__clang__) || defined(__INTEL_COMPILER)
+#define WRAP_CAS(ptr, old, new) __sync_bool_compare_and_swap(ptr, old, new)
+#else
+#define WRAP_CAS(ptr, old, new) (*(ptr) == (old) ? (*(ptr) = (new), 1) : 0)
+#endif
+#endif /* WRAP_CAS */
+
+'''
+
+# Scratch space for converting arrays of handles in Fortran wrappers.  Arrays of up to
+# WRAP_F_STACK_HANDLES handles are converted in buffers on the stack.  Bigger ones use
+# per-thread blocks that grow as needed, and are freed when MPI_Finalize deletes the
+# attributes on MPI_COMM_SELF.  Every block is on a global list so that blocks of
+# threads that have exited are freed too.
+wrapper_fortran_scratch = '''
+#if !(!defined(MPICH_HAS_C2F) && defined(MPICH_NAME) && (MPICH_NAME == 1))
+#ifndef WRAP_F_STACK_HANDLES
+#define WRAP_F_STACK_HANDLES 32
+#endif
+#define WRAP_SCRATCH_SLOTS 4
+
+typedef struct wrap_scratch_block {
+    struct wrap_scratch_block *next;
+    size_t size;
+    union { long double ld; long long ll; void *p; } data[1];
+} wrap_scratch_block;
+
+static wrap_scratch_block *wrap_scratch_blocks = NULL;
+static int wrap_scratch_epoch = 1;
+static WRAP_THREAD_LOCAL wrap_scratch_block *wrap_thread_scratch[WRAP_SCRATCH_SLOTS];
+static WRAP_THREAD_LOCAL int wrap_thread_scratch_epoch = 0;
+
+static WRAP_UNUSED int wrap_scratch_free(MPI_Comm comm, int keyval, void *value, void *extra) {
+    wrap_scratch_block *block = wrap_scratch_blocks, *next;
+    wrap_scratch_blocks = NULL;
+    wrap_scratch_epoch++;    /* Tells other threads their blocks are gone. */
+    for (; block; block = next) {
+        next = block->next;
+        free(block);
+    }
+    return MPI_SUCCESS;
+}
+
+/* Returns size bytes of scratch space for this thread.  The space stays valid until
+   the next call with the same slot. */
+static WRAP_UNUSED void *wrap_scratch(int slot, size_t size) {
+#ifdef WRAP_NO_THREAD_LOCAL
+    return malloc(size);
+#else
+    wrap_scratch_block *block, *head;
+    int i;
+    if (wrap_thread_scratch_epoch != wrap_scratch_epoch) {
+        for (i = 0; i < WRAP_SCRATCH_SLOTS; i++)
+            wrap_thread_scratch[i] = NULL;
+        wrap_thread_scratch_epoch = wrap_scratch_epoch;
+    }
+    block = wrap_thread_scratch[slot];
+    if (block && block->size >= size)
+        return block->data;
+
+    if (block && size < 2 * block->size)
+        size = 2 * block->size;
+    block = (wrap_scratch_block*)malloc(sizeof(wrap_scratch_block) + size);
+    if (!block)
+        return NULL;
+    block->size = size;
+    do {
+        head = wrap_scratch_blocks;
+        block->next = head;
+    } while (!WRAP_CAS(&wrap_scratch_blocks, head, block));
+    if (!head) {
+        /* First block since MPI_Init: free them all in MPI_Finalize. */
+        int keyval;
+        PMPI_Comm_create_keyval(MPI_COMM_NULL_COPY_FN, wrap_scratch_free, &keyval, NULL);
+        PMPI_Comm_set_attr(MPI_COMM_SELF, keyval, NULL);
+    }
+    wrap_thread_scratch[slot] = block;
+    return block->data;
+#endif
+}
+
+/* Releases space from wrap_scratch().  Only needed without thread-local storage. */
+#ifdef WRAP_NO_THREAD_LOCAL
+#define wrap_scratch_done(p) free(p)
+#else
+#define wrap_scratch_done(p) ((void)0)
+#endif
+#endif /* MPICH test */
+
+'''
+
+# Number of MPI_Fints in a Fortran status, for indexing arrays of them.
+wrapper_fortran_status = '''
+#ifndef WRAP_F_STATUS_SIZE
+#ifdef MPI_F_STATUS_SIZE
+#define WRAP_F_STATUS_SIZE MPI_F_STATUS_SIZE
+#else
+#define WRAP_F_STATUS_SIZE (sizeof(MPI_Status) / sizeof(MPI_Fint))
+#endif
+#endif /* WRAP_F_STATUS_SIZE */
+
+'''
+
+# WRAP_F_ALIAS(name) makes a declaration an alias for the function called name.  It is
+# only defined where aliases work: GCC-compatible compilers producing ELF objects.
+wrapper_fortran_alias = '''
+#ifndef WRAP_F_ALIAS
+#if (defined(__GNUC__) || defined(__clang__)) && defined(__ELF__)
+#define WRAP_F_ALIAS(name) __attribute__((alias(#name)))
+#endif
+#endif /* WRAP_F_ALIAS */
+
+'''
+
+# A cheap clock for timing and tracing.  wrap_ticks() reads clock_gettime() with
+# CLOCK_MONOTONIC_RAW (or CLOCK_MONOTONIC) where there is one, the x86 time stamp counter
+# with -DWRAP_CLOCK_TSC, and PMPI_Wtime() otherwise.  wrap_ticks_calibrate() sets
+# wrap_tick_seconds, which only needs measuring for the time stamp counter.
+wrapper_clock = '''
+#include <time.h>
+
+typedef unsigned long long wrap_ticks_t;
+
+#if defined(WRAP_CLOCK_TSC) && (defined(__x86_64__) || defined(__i386__)) && \\
+    (defined(__GNUC__) || defined(__clang__))
+#define WRAP_TICKS_CALIBRATE 1
+static WRAP_UNUSED wrap_ticks_t wrap_ticks(void) {
+    unsigned int lo, hi;
+    __asm__ __volatile__ ("rdtsc" : "=a" (lo), "=d" (hi));
+    return ((wrap_ticks_t)hi << 32) | lo;
+}
+#elif defined(CLOCK_MONOTONIC_RAW) || defined(CLOCK_MONOTONIC)
+static WRAP_UNUSED wrap_ticks_t wrap_ticks(void) {
+    struct timespec ts;
+#ifdef CLOCK_MONOTONIC_RAW
+    clock_gettime(CLOCK_MONOTONIC_RAW, &ts);
+#else
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+#endif
+    return (wrap_ticks_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+#else
+static WRAP_UNUSED wrap_ticks_t wrap_ticks(void) {
+    return (wrap_ticks_t)(PMPI_Wtime() * 1e9);
+}
+#endif
+
+static double wrap_tick_seconds = 1e-9;
+
+/* Sets wrap_tick_seconds.  Call it after MPI_Init. */
+static WRAP_UNUSED void wrap_ticks_calibrate(void) {
+#ifdef WRAP_TICKS_CALIBRATE
+    /* Measure the tick rate against MPI_Wtime for 10ms. */
+    double start = PMPI_Wtime(), end;
+    wrap_ticks_t ticks = wrap_ticks();
+    while ((end = PMPI_Wtime()) - start < 0.01)
+        ;
+    wrap_tick_seconds = (end - start) / (double)(wrap_ticks() - ticks);
+#endif
+}
+
+'''
+
+# Per-thread timing of MPI calls for {{time_callfn}}.  Each thread accumulates into its
+# own cache-line-aligned block of slots, one per function ID, and wrap_timing_merge()
+# sums the blocks of all threads into wrap_timings.  With --sample, each sampled call
+# counts for the calls it stands for.
+wrapper_timing = '''
+#ifndef WRAP_CACHE_LINE
+#define WRAP_CACHE_LINE 64
+#endif
+
+#ifndef WRAP_SAMPLE_WEIGHT
+#define WRAP_SAMPLE_WEIGHT 1
+#endif
+
+/* Calls, total, min, and max ticks for one function. */
+typedef struct wrap_timing {
+    wrap_ticks_t count, total, min, max;
+} wrap_timing;
+
+typedef struct wrap_timing_block {
+    wrap_timing slots[WRAP_FN_COUNT];
+    struct wrap_timing_block *next;
+    char pad[WRAP_CACHE_LINE];
+} wrap_timing_block;
+
+static wrap_timing_block *wrap_timing_blocks = NULL;
+static WRAP_THREAD_LOCAL wrap_timing_block *wrap_thread_timing = NULL;
+
+/* Timings for all threads, filled in by wrap_timing_merge() along with wrap_tick_seconds. */
+static wrap_timing wrap_timings[WRAP_FN_COUNT];
+
+static WRAP_UNUSED wrap_timing_block *wrap_timing_new_block(void) {
+    char *mem = (char*)malloc(sizeof(wrap_timing_block) + WRAP_CACHE_LINE);
+    wrap_timing_block *block, *head;
+    int i;
+    if (!mem)
+        return NULL;
+    block = (wrap_timing_block*)(mem + WRAP_CACHE_LINE - (size_t)mem % WRAP_CACHE_LINE);
+    for (i = 0; i < WRAP_FN_COUNT; i++) {
+        block->slots[i].count = block->slots[i].total = block->slots[i].max = 0;
+        block->slots[i].min = ~(wrap_ticks_t)0;
+    }
+    do {
+        head = wrap_timing_blocks;
+        block->next = head;
+    } while (!WRAP_CAS(&wrap_timing_blocks, head, block));
+    return block;
+}
+
+/* Adds one call that took elapsed ticks to this thread's timing for function id. */
+static WRAP_UNUSED void wrap_timing_add(int id, wrap_ticks_t elapsed) {
+    wrap_timing *slot;
+    if (!wrap_thread_timing && !(wrap_thread_timing = wrap_timing_new_block()))
+        return;
+    slot = &wrap_thread_timing->slots[id];
+    slot->count += WRAP_SAMPLE_WEIGHT;
+    slot->total += elapsed * WRAP_SAMPLE_WEIGHT;
+    if (elapsed < slot->min) slot->min = elapsed;
+    if (elapsed > slot->max) slot->max = elapsed;
+}
+
+/* Sums the timings of all threads into wrap_timings, and sets wrap_tick_seconds.  Call
+   it while no other thread is in MPI, e.g. in an MPI_Finalize wrapper before PMPI_Finalize. */
+static WRAP_UNUSED void wrap_timing_merge(void) {
+    wrap_timing_block *block;
+    int i;
+    for (i = 0; i < WRAP_FN_COUNT; i++) {
+        wrap_timings[i].count = wrap_timings[i].total = wrap_timings[i].max = 0;
+        wrap_timings[i].min = ~(wrap_ticks_t)0;
+    }
+    for (block = wrap_timing_blocks; block; block = block->next) {
+        for (i = 0; i < WRAP_FN_COUNT; i++) {
+            wrap_timing *slot = &block->slots[i];
+            wrap_timings[i].count += slot->count;
+            wrap_timings[i].total += slot->total;
+            if (slot->min < wrap_timings[i].min) wrap_timings[i].min = slot->min;
+            if (slot->max > wrap_timings[i].max) wrap_timings[i].max = slot->max;
+        }
+    }
+    for (i = 0; i < WRAP_FN_COUNT; i++)
+        if (!wrap_timings[i].count) wrap_timings[i].min = 0;
+    wrap_ticks_calibrate();
+}
+
+'''
+
+# Profiles for {{profile}}: the timings of all processes, reduced to statistics for each
+# function at one process, which writes them to a single file.  Each process converts its
+# timings to seconds, so they can be combined even if processes' clocks tick at different
+# rates, and a user-defined op combines them in one PMPI_Reduce, which takes O(log P)
+# steps.  With -DWRAP_PROFILE_BY_NODE, processes reduce to a leader on each node first,
+# and then the leaders reduce to the root.
+wrapper_profile = '''
+#include <string.h>
+
+#ifndef WRAP_PROFILE_FILE
+#define WRAP_PROFILE_FILE "wrap.profile"    /* Unless $WRAP_PROFILE_FILE is set. */
+#endif
+
+/* One function's statistics for a group of processes.  Times are in seconds. */
+typedef struct wrap_profile {
+    unsigned long long count;       /* Calls in all processes. */
+    double total;                   /* Time in all processes. */
+    double call_min, call_max;      /* Shortest and longest call. */
+    double least, most;             /* Least and most total time in a process that called it. */
+    int least_rank, most_rank;      /* Ranks of those processes. */
+    int ranks;                      /* Processes that called it. */
+    int reserved;
+} wrap_profile;
+
+/* Profiles of all functions, filled in at the root by wrap_profile_reduce(). */
+static wrap_profile wrap_profiles[WRAP_FN_COUNT];
+
+/* This process's profiles, and its node's with WRAP_PROFILE_BY_NODE. */
+static wrap_profile wrap_profile_scratch[2 * WRAP_FN_COUNT];
+
+/* Combines profiles in in into inout.  Ties go to the lower rank, so the op commutes. */
+static WRAP_UNUSED void wrap_profile_op(void *in, void *inout, int *len, MPI_Datatype *type) {
+    wrap_profile *a = (wrap_profile*)in, *b = (wrap_profile*)inout;
+    int i;
+    for (i = 0; i < *len; i++, a++, b++) {
+        if (!a->ranks)
+            continue;
+        if (!b->ranks) {
+            *b = *a;
+            continue;
+        }
+        b->count += a->count;
+        b->total += a->total;
+        if (a->call_min < b->call_min) b->call_min = a->call_min;
+        if (a->call_max > b->call_max) b->call_max = a->call_max;
+        if (a->least < b->least || (a->least == b->least && a->least_rank < b->least_rank)) {
+            b->least = a->least;
+            b->least_rank = a->least_rank;
+        }
+        if (a->most > b->most || (a->most == b->most && a->most_rank < b->most_rank)) {
+            b->most = a->most;
+            b->most_rank = a->most_rank;
+        }
+        b->ranks += a->ranks;
+    }
+}
+
+/* Reduces the wrap_timings of all processes in comm into wrap_profiles at root.  Call
+   wrap_timing_merge() first.  Ranks in the profiles are ranks in comm. */
+static WRAP_UNUSED void wrap_profile_reduce(MPI_Comm comm, int root) {
+    wrap_profile *mine = wrap_profile_scratch;
+    MPI_Datatype type;
+    MPI_Op op;
+    int i, rank;
+    PMPI_Comm_rank(comm, &rank);
+    memset(mine, 0, WRAP_FN_COUNT * sizeof(wrap_profile));
+    for (i = 0; i < WRAP_FN_COUNT; i++) {
+        if (wrap_timings[i].count) {
+            mine[i].count = wrap_timings[i].count;
+            mine[i].least = mine[i].most = mine[i].total = wrap_timings[i].total * wrap_tick_seconds;
+            mine[i].call_min = wrap_timings[i].min * wrap_tick_seconds;
+            mine[i].call_max = wrap_timings[i].max * wrap_tick_seconds;
+            mine[i].least_rank = mine[i].most_rank = rank;
+            mine[i].ranks = 1;
+        }
+    }
+
+    PMPI_Type_contiguous(sizeof(wrap_profile), MPI_BYTE, &type);
+    PMPI_Type_commit(&type);
+    PMPI_Op_create(wrap_profile_op, 1, &op);
+#if defined(WRAP_PROFILE_BY_NODE) && defined(MPI_COMM_TYPE_SHARED)
+    {
+        /* Order root first, so that it leads its node and the leaders. */
+        MPI_Comm node, leaders;
+        int node_rank, key = (rank == root) ? -1 : rank;
+        PMPI_Comm_split_type(comm, MPI_COMM_TYPE_SHARED, key, MPI_INFO_NULL, &node);
+        PMPI_Comm_rank(node, &node_rank);
+        PMPI_Reduce(mine, mine + WRAP_FN_COUNT, WRAP_FN_COUNT, type, op, 0, node);
+        PMPI_Comm_split(comm, node_rank ? MPI_UNDEFINED : 0, key, &leaders);
+        if (leaders != MPI_COMM_NULL) {
+            PMPI_Reduce(mine + WRAP_FN_COUNT, wrap_profiles, WRAP_FN_COUNT, type, op, 0, leaders);
+            PMPI_Comm_free(&leaders);
+        }
+        PMPI_Comm_free(&node);
+    }
+#else
+    PMPI_Reduce(mine, wrap_profiles, WRAP_FN_COUNT, type, op, root, comm);
+#endif
+    PMPI_Op_free(&op);
+    PMPI_Type_free(&type);
+}
+
+/* Merges and reduces the timings of all processes, and writes them from rank 0 to
+   filename, or if it's NULL, $WRAP_PROFILE_FILE or WRAP_PROFILE_FILE.  Call it in all
+   processes, while no other thread is in MPI, before PMPI_Finalize.  {{profile}} calls
+   it in the MPI_Finalize wrapper. */
+static WRAP_UNUSED void wrap_profile_write(const char *filename) {
+    int initialized, finalized = 0, rank, size, i;
+    FILE *file;
+    PMPI_Initialized(&initialized);
+    if (initialized)
+        PMPI_Finalized(&finalized);
+    if (!initialized || finalized)
+        return;
+    wrap_timing_merge();
+    wrap_profile_reduce(MPI_COMM_WORLD, 0);
+    PMPI_Comm_rank(MPI_COMM_WORLD, &rank);
+    PMPI_Comm_size(MPI_COMM_WORLD, &size);
+    if (rank != 0)
+        return;
+
+    if (!filename)
+        filename = getenv("WRAP_PROFILE_FILE");
+    if (!filename)
+        filename = WRAP_PROFILE_FILE;
+    if (!(file = fopen(filename, "w"))) {
+        fprintf(stderr, "WARNING: couldn't open profile file %s.\\n", filename);
+        return;
+    }
+    fprintf(file, "# %d processes.  Times are in seconds: total, shortest and longest call, and\\n", size);
+    fprintf(file, "# least and most total time in one process, with its rank.\\n");
+    fprintf(file, "# %-26s %14s %8s %14s %12s %12s %12s %8s %12s %8s\\n", "function", "calls", "ranks",
+            "total", "min", "max", "least", "rank", "most", "rank");
+    for (i = 0; i < WRAP_FN_COUNT; i++) {
+        const wrap_profile *p = &wrap_profiles[i];
+        if (p->ranks)
+            fprintf(file, "%-28s %14llu %8d %14.6f %12.9f %12.9f %12.6f %8d %12.6f %8d\\n",
+                    wrap_fn_names[i], p->count, p->ranks, p->total, p->call_min, p->call_max,
+                    p->least, p->least_rank, p->most, p->most_rank);
+    }
+    fclose(file);
+}
+
+'''
+
+# Cache of datatype sizes for {{bytes}}.  Each thread has an open-addressing hash table
+# from MPI_Datatype to size, seeded with the predefined types.  Sizes of other types are
+# looked up with PMPI_Type_size the first time, and the type gets an attribute whose
+# delete callback invalidates every thread's table when the type is freed.
+wrapper_type_sizes = '''
+#ifndef WRAP_TYPE_CACHE_SIZE
+#define WRAP_TYPE_CACHE_SIZE 256
+#endif
+#define WRAP_TYPE_HASH(type) \\
+    ((((size_t)(type) >> 3) ^ ((size_t)(type) >> 12)) % WRAP_TYPE_CACHE_SIZE)
+
+typedef struct wrap_type_entry {
+    MPI_Datatype type;
+    int size;
+    int used;
+} wrap_type_entry;
+
+typedef struct wrap_type_cache {
+    int epoch;
+    int count;
+    wrap_type_entry entries[WRAP_TYPE_CACHE_SIZE];
+} wrap_type_cache;
+
+static int wrap_type_cache_epoch = 1;
+static int wrap_type_keyval = MPI_KEYVAL_INVALID;
+static int wrap_type_lock = 0;
+static WRAP_THREAD_LOCAL wrap_type_cache wrap_thread_type_cache;
+
+static WRAP_UNUSED int wrap_type_freed(MPI_Datatype type, int keyval, void *value, void *extra) {
+    int epoch;
+    do {
+        epoch = wrap_type_cache_epoch;  /* The type's handle may be reused, so start over. */
+    } while (!WRAP_CAS(&wrap_type_cache_epoch, epoch, epoch + 1));
+    return MPI_SUCCESS;
+}
+
+static WRAP_UNUSED void wrap_type_cache_put(wrap_type_cache *cache, MPI_Datatype type, int size) {
+    size_t i = WRAP_TYPE_HASH(type);
+    if (cache->count >= WRAP_TYPE_CACHE_SIZE * 3 / 4)
+        return;     /* Keep probe sequences short; other types are looked up every time. */
+    for (; cache->entries[i].used; i = (i + 1) % WRAP_TYPE_CACHE_SIZE)
+        if (cache->entries[i].type == type)
+            return;
+    cache->entries[i].type = type;
+    cache->entries[i].size = size;
+    cache->entries[i].used = 1;
+    cache->count++;
+}
+
+static WRAP_UNUSED void wrap_type_cache_reset(wrap_type_cache *cache) {
+    int i;
+    for (i = 0; i < WRAP_TYPE_CACHE_SIZE; i++)
+        cache->entries[i].used = 0;
+    cache->count = 0;
+    cache->epoch = wrap_type_cache_epoch;
+    wrap_type_cache_put(cache, MPI_DATATYPE_NULL, 0);
+    wrap_type_cache_put(cache, MPI_BYTE, 1);
+    wrap_type_cache_put(cache, MPI_PACKED, 1);
+    wrap_type_cache_put(cache, MPI_CHAR, sizeof(char));
+    wrap_type_cache_put(cache, MPI_SIGNED_CHAR, sizeof(signed char));
+    wrap_type_cache_put(cache, MPI_UNSIGNED_CHAR, sizeof(unsigned char));
+    wrap_type_cache_put(cache, MPI_SHORT, sizeof(short));
+    wrap_type_cache_put(cache, MPI_UNSIGNED_SHORT, sizeof(unsigned short));
+    wrap_type_cache_put(cache, MPI_INT, sizeof(int));
+    wrap_type_cache_put(cache, MPI_UNSIGNED, sizeof(unsigned));
+    wrap_type_cache_put(cache, MPI_LONG, sizeof(long));
+    wrap_type_cache_put(cache, MPI_UNSIGNED_LONG, sizeof(unsigned long));
+    wrap_type_cache_put(cache, MPI_FLOAT, sizeof(float));
+    wrap_type_cache_put(cache, MPI_DOUBLE, sizeof(double));
+    wrap_type_cache_put(cache, MPI_LONG_DOUBLE, sizeof(long double));
+    wrap_type_cache_put(cache, MPI_AINT, sizeof(MPI_Aint));
+    wrap_type_cache_put(cache, MPI_OFFSET, sizeof(MPI_Offset));
+#ifdef MPI_LONG_LONG
+    wrap_type_cache_put(cache, MPI_LONG_LONG, sizeof(long long));
+#endif
+#ifdef MPI_UNSIGNED_LONG_LONG
+    wrap_type_cache_put(cache, MPI_UNSIGNED_LONG_LONG, sizeof(unsigned long long));
+#endif
+#ifdef MPI_INT8_T
+    wrap_type_cache_put(cache, MPI_INT8_T, 1);
+    wrap_type_cache_put(cache, MPI_INT16_T, 2);
+    wrap_type_cache_put(cache, MPI_INT32_T, 4);
+    wrap_type_cache_put(cache, MPI_INT64_T, 8);
+    wrap_type_cache_put(cache, MPI_UINT8_T, 1);
+    wrap_type_cache_put(cache, MPI_UINT16_T, 2);
+    wrap_type_cache_put(cache, MPI_UINT32_T, 4);
+    wrap_type_cache_put(cache, MPI_UINT64_T, 8);
+#endif
+#ifdef MPI_COUNT
+    wrap_type_cache_put(cache, MPI_COUNT, sizeof(MPI_Count));
+#endif
+}
+
+/* Returns the size of type in bytes. */
+static WRAP_UNUSED int wrap_type_size(MPI_Datatype type) {
+    wrap_type_cache *cache = &wrap_thread_type_cache;
+    size_t i;
+    int size = 0, n, combiner, flag;
+    void *value;
+    if (cache->epoch != wrap_type_cache_epoch)
+        wrap_type_cache_reset(cache);
+    for (i = WRAP_TYPE_HASH(type); cache->entries[i].used; i = (i + 1) % WRAP_TYPE_CACHE_SIZE)
+        if (cache->entries[i].type == type)
+            return cache->entries[i].size;
+
+    PMPI_Type_size(type, &size);
+    if (size == MPI_UNDEFINED)
+        size = 0;
+    PMPI_Type_get_envelope(type, &n, &n, &n, &combiner);
+    if (combiner != MPI_COMBINER_NAMED) {
+        if (wrap_type_keyval == MPI_KEYVAL_INVALID) {
+            /* Only one thread creates the keyval, so none is leaked. */
+            while (!WRAP_CAS(&wrap_type_lock, 0, 1))
+                ;
+            if (wrap_type_keyval == MPI_KEYVAL_INVALID)
+                PMPI_Type_create_keyval(MPI_TYPE_NULL_COPY_FN, wrap_type_freed, &wrap_type_keyval, NULL);
+            WRAP_CAS(&wrap_type_lock, 1, 0);
+        }
+        PMPI_Type_get_attr(type, wrap_type_keyval, &value, &flag);
+        if (!flag)
+            PMPI_Type_set_attr(type, wrap_type_keyval, NULL);
+    }
+    wrap_type_cache_put(cache, type, size);
+    return size;
+}
+
+'''
+
+# Cached communicator information for {{comm_info}}.  The first lookup of a communicator
+# stores a wrap_comm in an attribute on it.  MPI_Comm_dup copies it through the keyval's
+# copy callback, and MPI_Comm_free frees it through the delete callback, whether or not
+# those functions are wrapped.  Each thread also keeps a small direct-mapped table of the
+# communicators it looked up recently, so repeated lookups make no MPI calls at all.
+wrapper_comm_info = '''
+typedef struct wrap_comm {
+    int rank;           /* Rank of this process in the communicator. */
+    int size;           /* Size of the communicator (of the local group, for intercomms). */
+    int world_rank;     /* Rank of this process in MPI_COMM_WORLD. */
+    int is_inter;       /* Nonzero for intercommunicators. */
+    int remote_size;    /* Size of the remote group of an intercommunicator. */
+    int *world_ranks;   /* MPI_COMM_WORLD ranks of peers.  See wrap_comm_world_rank(). */
+    int id;             /* Number of the communicator in this process, counting from 0. */
+} wrap_comm;
+
+/* Number of entries in each thread's table of recently used communicators. */
+#ifndef WRAP_COMM_CACHE_SIZE
+#define WRAP_COMM_CACHE_SIZE 16
+#endif
+#define WRAP_COMM_HASH(comm) \\
+    ((((size_t)(comm) >> 3) ^ ((size_t)(comm) >> 12)) % WRAP_COMM_CACHE_SIZE)
+
+typedef struct wrap_comm_entry {
+    MPI_Comm comm;
+    wrap_comm *info;
+    int epoch;          /* Entries from before the last MPI_Comm_free are stale. */
+} wrap_comm_entry;
+
+static wrap_comm wrap_null_comm = { MPI_UNDEFINED, 0, MPI_UNDEFINED, 0, 0, NULL, -1 };
+static int wrap_comm_keyval = MPI_KEYVAL_INVALID;
+static int wrap_comm_lock = 0;
+static int wrap_comm_epoch = 1;
+static int wrap_comm_next_id = 0;
+
+static WRAP_UNUSED int wrap_comm_new_id(void) {
+    int id;
+    do {
+        id = wrap_comm_next_id;
+    } while (!WRAP_CAS(&wrap_comm_next_id, id, id + 1));
+    return id;
+}
+static WRAP_THREAD_LOCAL wrap_comm_entry wrap_thread_comms[WRAP_COMM_CACHE_SIZE];
+
+static WRAP_UNUSED int wrap_comm_copy(MPI_Comm comm, int keyval, void *extra, void *value,
+                                      void *new_value, int *flag) {
+    wrap_comm *info = (wrap_comm*)malloc(sizeof(wrap_comm));
+    *flag = 0;
+    if (!info)
+        return MPI_SUCCESS;
+    *info = *(wrap_comm*)value;
+    info->world_ranks = NULL;   /* Filled in again if it's needed. */
+    info->id = wrap_comm_new_id();
+    *(void**)new_value = info;
+    *flag = 1;
+    return MPI_SUCCESS;
+}
+
+static WRAP_UNUSED int wrap_comm_delete(MPI_Comm comm, int keyval, void *value, void *extra) {
+    wrap_comm *info = (wrap_comm*)value;
+    int epoch;
+    do {
+        epoch = wrap_comm_epoch;    /* The handle may be reused, so forget it in every thread. */
+    } while (!WRAP_CAS(&wrap_comm_epoch, epoch, epoch + 1));
+    free(info->world_ranks);
+    free(info);
+    return MPI_SUCCESS;
+}
+
+/* Returns information about comm, computing it on the first lookup. */
+static WRAP_UNUSED const wrap_comm *wrap_comm_info(MPI_Comm comm) {
+    wrap_comm_entry *entry;
+    wrap_comm *info;
+    int flag, finalized = 0;
+    if (comm == MPI_COMM_NULL)
+        return &wrap_null_comm;
+    entry = &wrap_thread_comms[WRAP_COMM_HASH(comm)];
+    if (entry->epoch == wrap_comm_epoch && entry->comm == comm)
+        return entry->info;
+
+    PMPI_Initialized(&flag);
+    if (flag)
+        PMPI_Finalized(&finalized);
+    if (!flag || finalized)
+        return &wrap_null_comm;
+    info = NULL;
+    if (wrap_comm_keyval != MPI_KEYVAL_INVALID)
+        PMPI_Comm_get_attr(comm, wrap_comm_keyval, &info, &flag);
+    if (!info) {
+        /* Only one thread adds attributes at a time, so none replaces another's. */
+        while (!WRAP_CAS(&wrap_comm_lock, 0, 1))
+            ;
+        if (wrap_comm_keyval == MPI_KEYVAL_INVALID)
+            PMPI_Comm_create_keyval(wrap_comm_copy, wrap_comm_delete, &wrap_comm_keyval, NULL);
+        PMPI_Comm_get_attr(comm, wrap_comm_keyval, &info, &flag);
+        if (!flag && (info = (wrap_comm*)malloc(sizeof(wrap_comm)))) {
+            PMPI_Comm_rank(comm, &info->rank);
+            PMPI_Comm_size(comm, &info->size);
+            PMPI_Comm_rank(MPI_COMM_WORLD, &info->world_rank);
+            PMPI_Comm_test_inter(comm, &info->is_inter);
+            info->remote_size = 0;
+            if (info->is_inter)
+                PMPI_Comm_remote_size(comm, &info->remote_size);
+            info->world_ranks = NULL;
+            info->id = wrap_comm_new_id();
+            PMPI_Comm_set_attr(comm, wrap_comm_keyval, info);
+        }
+        WRAP_CAS(&wrap_comm_lock, 1, 0);
+        if (!info)
+            return &wrap_null_comm;
+    }
+    entry->comm = comm;
+    entry->info = info;
+    entry->epoch = wrap_comm_epoch;
+    return info;
+}
+
+/* Translates rank, a peer in comm (in the remote group for intercomms), to a rank in
+   MPI_COMM_WORLD.  Special ranks like MPI_ANY_SOURCE and MPI_PROC_NULL are returned as is.
+   The first translation for a communicator builds a table of all of its peers. */
+static WRAP_UNUSED int wrap_comm_world_rank(MPI_Comm comm, int rank) {
+    wrap_comm *info = (wrap_comm*)wrap_comm_info(comm);
+    int npeers = info->is_inter ? info->remote_size : info->size;
+    if (rank < 0 || rank >= npeers)
+        return rank;
+    if (!info->world_ranks) {
+        MPI_Group group, world_group;
+        int i, *peers = (int*)malloc(npeers * sizeof(int));
+        int *ranks = (int*)malloc(npeers * sizeof(int));
+        if (!peers || !ranks) {
+            free(peers);
+            free(ranks);
+            return MPI_UNDEFINED;
+        }
+        for (i = 0; i < npeers; i++)
+            peers[i] = i;
+        if (info->is_inter)
+            PMPI_Comm_remote_group(comm, &group);
+        else
+            PMPI_Comm_group(comm, &group);
+        PMPI_Comm_group(MPI_COMM_WORLD, &world_group);
+        PMPI_Group_translate_ranks(group, npeers, peers, world_group, ranks);
+        PMPI_Group_free(&group);
+        PMPI_Group_free(&world_group);
+        free(peers);
+        if (!WRAP_CAS(&info->world_ranks, NULL, ranks))
+            free(ranks);    /* Another thread got there first. */
+    }
+    return info->world_ranks[rank];
+}
+
+'''
+
+# Sampling for --sample and --sample-interval.  Each thread counts down calls to each
+# function, and calls that don't reach zero go straight to the PMPI function.  When the
+# count runs out, wrap_sample() starts it over from a random number between 1 and twice
+# the period, so that sampling doesn't lock onto patterns of calls that repeat with the
+# period, and decides whether to run the wrapper body: always, or with
+# --sample-interval, only if that much time has passed since the thread last sampled
+# the function.  wrap_sample_weight is then the number of calls the sampled one stands
+# for, to scale statistics by.
+wrapper_sampling = '''
+#ifndef WRAP_SAMPLE_PERIOD
+#define WRAP_SAMPLE_PERIOD %(period)d
+#endif
+#ifndef WRAP_SAMPLE_INTERVAL_US
+#define WRAP_SAMPLE_INTERVAL_US %(interval)d
+#endif
+#define WRAP_SAMPLE_WEIGHT wrap_sample_weight
+
+static WRAP_THREAD_LOCAL int wrap_sample_countdown[WRAP_FN_COUNT];
+static WRAP_THREAD_LOCAL int wrap_sample_counted[WRAP_FN_COUNT];   /* Where each countdown started. */
+static WRAP_THREAD_LOCAL unsigned wrap_sample_random = 0;
+static WRAP_THREAD_LOCAL long long wrap_sample_weight = 1;
+#if WRAP_SAMPLE_INTERVAL_US > 0
+static WRAP_THREAD_LOCAL double wrap_sample_last[WRAP_FN_COUNT];
+static WRAP_THREAD_LOCAL long long wrap_sample_skipped[WRAP_FN_COUNT];
+#endif
+
+/* Called when the countdown for function id runs out.  Returns nonzero if this call
+   should run the wrapper body. */
+static WRAP_UNUSED int wrap_sample(int id) {
+    long long calls = (wrap_sample_countdown[id] < 0) ? 1 : wrap_sample_counted[id];
+    unsigned x = wrap_sample_random;
+    if (!x)
+        x = (unsigned)(size_t)&wrap_sample_random | 1;  /* A different seed in each thread. */
+    x ^= x << 13;
+    x ^= x >> 17;
+    x ^= x << 5;
+    wrap_sample_random = x;
+    wrap_sample_countdown[id] = wrap_sample_counted[id] = 1 + x %% (2 * WRAP_SAMPLE_PERIOD - 1);
+#if WRAP_SAMPLE_INTERVAL_US > 0
+    {
+        double now = PMPI_Wtime();
+        if (calls > 1 && (now - wrap_sample_last[id]) * 1e6 < WRAP_SAMPLE_INTERVAL_US) {
+            wrap_sample_skipped[id] += calls;
+            return 0;
+        }
+        wrap_sample_last[id] = now;
+        calls += wrap_sample_skipped[id];
+        wrap_sample_skipped[id] = 0;
+    }
+#endif
+    wrap_sample_weight = calls;
+    return 1;
+}
+
+'''
+
+def write_sampling(out):
+    out.write(wrapper_sampling % {"period" : sample_period, "interval" : sample_interval})
+
+# Runtime enabling and disabling of wrappers for -e.  Wrappers return the PMPI call right
+# away if their function's bit in wrap_fn_disabled is set.  The bits start out clear, and
+# the MPI_Init and MPI_Init_thread wrappers set them from a list of functions and
+# categories in $WRAP_ENABLE.  MPI_Pcontrol changes them while the program runs.
+wrapper_enable = '''
+#include <stdarg.h>
+
+#ifndef WRAP_ENABLE_VAR
+#define WRAP_ENABLE_VAR "WRAP_ENABLE"
+#endif
+
+/* MPI_Pcontrol levels for the wrappers.  Applications define their own levels, so these
+   are far from the usual small ones; redefine them if they collide. */
+#ifndef WRAP_PCONTROL_DISABLE
+#define WRAP_PCONTROL_DISABLE 7270  /* Disable every wrapper. */
+#endif
+#ifndef WRAP_PCONTROL_RESTORE
+#define WRAP_PCONTROL_RESTORE 7271  /* Go back to the wrappers enabled at MPI_Init. */
+#endif
+#ifndef WRAP_PCONTROL_LIST
+#define WRAP_PCONTROL_LIST 7272     /* Apply the list in the next argument. */
+#endif
+#define WRAP_ENABLE_WORDS ((WRAP_FN_COUNT + 31) / 32)
+#define WRAP_FN_DISABLED(id) (wrap_fn_disabled[(id) >> 5] & (1u << ((id) & 31)))
+#define WRAP_ENABLE_SEPARATOR(c) ((c) == ',' || (c) == ' ' || (c) == ':' || (c) == ';')
+
+static unsigned wrap_fn_disabled[WRAP_ENABLE_WORDS];
+static unsigned wrap_fn_disabled_initial[WRAP_ENABLE_WORDS];
+
+static WRAP_UNUSED void wrap_fn_enable(int id, int enable) {
+    if (enable)
+        wrap_fn_disabled[id >> 5] &= ~(1u << (id & 31));
+    else
+        wrap_fn_disabled[id >> 5] |= 1u << (id & 31);
+}
+
+/* True if the len characters at word name str, ignoring case.  Function names can
+   leave out the MPI_ prefix. */
+static WRAP_UNUSED int wrap_enable_match(const char *str, const char *word, size_t len) {
+    size_t i;
+    for (i = 0; i < len && str[i]; i++)
+        if ((str[i] | 0x20) != (word[i] | 0x20))
+            break;
+    if (i == len && !str[i])
+        return 1;
+    if (str[0] == 'M' && str[1] == 'P' && str[2] == 'I' && str[3] == '_')
+        return wrap_enable_match(str + 4, word, len);
+    return 0;
+}
+
+/* Enables the functions and categories in a list like "collective,MPI_Wait" and disables
+   the ones preceded by '-', like "-p2p".  "all" is every function.  With reset, a list
+   that starts by enabling something enables only what it lists. */
+static WRAP_UNUSED void wrap_enable_list(const char *list, int reset) {
+    const char *word = list;
+    int i, first = 1;
+    while (*word) {
+        size_t len;
+        int enable = 1, found = 0;
+        while (WRAP_ENABLE_SEPARATOR(*word))
+            word++;
+        if (*word == '-' || *word == '!') {
+            enable = 0;
+            word++;
+        }
+        for (len = 0; word[len] && !WRAP_ENABLE_SEPARATOR(word[len]); len++)
+            ;
+        if (!len)
+            continue;
+        if (first && reset && enable)
+            for (i = 0; i < WRAP_FN_COUNT; i++)
+                wrap_fn_enable(i, 0);
+        first = 0;
+        for (i = 0; i < WRAP_FN_COUNT; i++) {
+            if ((len == 3 && wrap_enable_match("all", word, len)) ||
+                wrap_enable_match(wrap_fn_names[i], word, len) ||
+                wrap_enable_match(wrap_fn_category_names[wrap_fn_categories[i]], word, len)) {
+                wrap_fn_enable(i, enable);
+                found = 1;
+            }
+        }
+        if (!found)
+            fprintf(stderr, "WARNING: no MPI function or category '%.*s' in %s.\\n",
+                    (int)len, word, WRAP_ENABLE_VAR);
+        word += len;
+    }
+}
+
+/* Called by the MPI_Init and MPI_Init_thread wrappers. */
+static WRAP_UNUSED void wrap_enable_init(void) {
+    const char *list = getenv(WRAP_ENABLE_VAR);
+    int i;
+    if (list)
+        wrap_enable_list(list, 1);
+    for (i = 0; i < WRAP_ENABLE_WORDS; i++)
+        wrap_fn_disabled_initial[i] = wrap_fn_disabled[i];
+}
+
+/* Called by the MPI_Pcontrol wrapper.  Only reads args for WRAP_PCONTROL_LIST, and
+   leaves other levels to the application and other tools. */
+static WRAP_UNUSED void wrap_enable_pcontrol(int level, va_list args) {
+    int i;
+    if (level == WRAP_PCONTROL_DISABLE) {
+        for (i = 0; i < WRAP_ENABLE_WORDS; i++)
+            wrap_fn_disabled[i] = ~0u;
+    } else if (level == WRAP_PCONTROL_RESTORE) {
+        for (i = 0; i < WRAP_ENABLE_WORDS; i++)
+            wrap_fn_disabled[i] = wrap_fn_disabled_initial[i];
+    } else if (level == WRAP_PCONTROL_LIST) {
+        const char *list = va_arg(args, const char *);
+        if (list)
+            wrap_enable_list(list, 0);
+    }
+}
+
+'''
+
+# Per-thread binary event traces for {{trace}}.  Each thread encodes events into its own
+# buffer, as a chunk that can be decoded on its own: a wrap_trace_chunk header, then the
+# events.  Functions, communicators, and datatypes are interned in small dictionaries
+# that start over in each chunk, and are defined in the chunk the first time they're
+# used.  Numbers are LEB128 varints, signed ones zigzag-encoded, and each event's start
+# time is a delta from the one before.  When the buffer fills up, the thread reserves
+# space at the end of this process's trace file with an atomic add, grows the file with
+# ftruncate() if it has to, and copies the chunk into an mmap() of the space, so it never
+# waits in write().  Events that don't fit in the buffer before MPI_Init, or that can't
+# be written at all, are counted as dropped.  wrap_trace_finish() writes out the buffers
+# of all threads, tables of function names and fields, and a header at the start of the
+# file.  wraptrace.py, next to wrap.py, reads the files.
+wrapper_trace = '''
+#include <fcntl.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/types.h>
+#include <unistd.h>
+
+#ifndef WRAP_TRACE_BUFFER
+#define WRAP_TRACE_BUFFER (256 * 1024)  /* Bytes per thread, unless $WRAP_TRACE_BUFFER is set. */
+#endif
+#ifndef WRAP_TRACE_PREFIX
+#define WRAP_TRACE_PREFIX "wrap"        /* <prefix>-<rank>.trace, unless $WRAP_TRACE_PREFIX is set. */
+#endif
+#define WRAP_TRACE_DICT 32              /* Entries in the communicator and datatype dictionaries. */
+#define WRAP_TRACE_MAX_FNS 125          /* Functions in a chunk, so event tags fit in a byte. */
+#define WRAP_TRACE_MAX_EVENT (128 + MPI_MAX_OBJECT_NAME)
+
+/* Tags that start each item in a chunk.  Tags from WRAP_TRACE_EVENT up are events of the
+   function defined with index tag - WRAP_TRACE_EVENT. */
+enum { WRAP_TRACE_DEF_FN, WRAP_TRACE_DEF_COMM, WRAP_TRACE_DEF_TYPE, WRAP_TRACE_EVENT };
+
+/* Start of each trace file.  All numbers are in the byte order of the machine. */
+typedef struct wrap_trace_header {
+    char magic[8];                  /* "WRAPTRC" and a 0. */
+    unsigned int version;           /* 2 */
+    unsigned int header_size;       /* sizeof(wrap_trace_header); chunks start here. */
+    unsigned int fn_count;          /* WRAP_FN_COUNT */
+    unsigned int threads;           /* Threads that traced calls. */
+    int rank, size;                 /* In MPI_COMM_WORLD. */
+    double tick_seconds;            /* wrap_tick_seconds */
+    unsigned long long chunks;      /* Chunks in the file. */
+    unsigned long long events;      /* Events in the chunks. */
+    unsigned long long dropped;     /* Events that couldn't be written. */
+    unsigned long long names;       /* Offset of WRAP_FN_COUNT 0-terminated function names, */
+    unsigned long long fields;      /* and of WRAP_FN_COUNT bytes of wrap_trace_fields. */
+} wrap_trace_header;
+
+/* Start of each chunk. */
+typedef struct wrap_trace_chunk {
+    unsigned int size;              /* Bytes of events after the header. */
+    unsigned int events;
+    unsigned int thread;            /* Number of the thread, in the order they first traced. */
+    unsigned int reserved;
+} wrap_trace_chunk;
+
+typedef struct wrap_trace_buffer {
+    unsigned char *data;            /* A wrap_trace_chunk, then events. */
+    size_t capacity, used;
+    unsigned int events;
+    unsigned long long dropped;
+    wrap_ticks_t last;              /* Start of the last event. */
+    int fns;                        /* Functions defined in this chunk. */
+    int type_epoch;                 /* wrap_type_cache_epoch when the chunk started. */
+    unsigned char fn_index[WRAP_FN_COUNT];  /* 1 + index of each function, or 0. */
+    int comms[WRAP_TRACE_DICT];             /* 1 + wrap_comm id at each index, or 0. */
+    MPI_Datatype types[WRAP_TRACE_DICT];
+    unsigned char has_type[WRAP_TRACE_DICT];
+    int thread;
+    struct wrap_trace_buffer *next_buffer;
+} wrap_trace_buffer;
+
+/* Before the file is opened, while tracing, after wrap_trace_finish(), and if it failed. */
+enum { WRAP_TRACE_CLOSED, WRAP_TRACE_OPEN, WRAP_TRACE_FINISHED, WRAP_TRACE_FAILED };
+
+static wrap_trace_buffer *wrap_trace_buffers = NULL;
+static WRAP_THREAD_LOCAL wrap_trace_buffer *wrap_thread_trace = NULL;
+static int wrap_trace_state = WRAP_TRACE_CLOSED;
+static int wrap_trace_lock = 0;
+static int wrap_trace_fd = -1;
+static int wrap_trace_threads = 0;
+static unsigned long long wrap_trace_end = sizeof(wrap_trace_header);
+static unsigned long long wrap_trace_file_size = 0;
+static unsigned long long wrap_trace_chunks = 0;
+static unsigned long long wrap_trace_events = 0;
+
+static WRAP_UNUSED unsigned long long wrap_trace_fetch_add(unsigned long long *value, unsigned long long n) {
+    unsigned long long old;
+    do {
+        old = *value;
+    } while (!WRAP_CAS(value, old, old + n));
+    return old;
+}
+
+static WRAP_UNUSED unsigned char *wrap_trace_varint(unsigned char *p, unsigned long long value) {
+    while (value >= 0x80) {
+        *p++ = (unsigned char)(value | 0x80);
+        value >>= 7;
+    }
+    *p++ = (unsigned char)value;
+    return p;
+}
+
+static WRAP_UNUSED unsigned char *wrap_trace_signed(unsigned char *p, long long value) {
+    return wrap_trace_varint(p, ((unsigned long long)value << 1) ^ (unsigned long long)(value >> 63));
+}
+
+/* Empties buf, and starts a new chunk in it. */
+static WRAP_UNUSED void wrap_trace_start_chunk(wrap_trace_buffer *buf) {
+    buf->used = sizeof(wrap_trace_chunk);
+    buf->events = 0;
+    buf->last = 0;
+    buf->fns = 0;
+    buf->type_epoch = wrap_type_cache_epoch;
+    memset(buf->fn_index, 0, sizeof(buf->fn_index));
+    memset(buf->comms, 0, sizeof(buf->comms));
+    memset(buf->has_type, 0, sizeof(buf->has_type));
+}
+
+static WRAP_UNUSED wrap_trace_buffer *wrap_trace_new_buffer(void) {
+    wrap_trace_buffer *buf = (wrap_trace_buffer*)malloc(sizeof(wrap_trace_buffer)), *head;
+    const char *size = getenv("WRAP_TRACE_BUFFER");
+    int thread;
+    if (!buf)
+        return NULL;
+    buf->capacity = (size && atol(size) > 0) ? (size_t)atol(size) : WRAP_TRACE_BUFFER;
+    if (buf->capacity < 4 * WRAP_TRACE_MAX_EVENT)
+        buf->capacity = 4 * WRAP_TRACE_MAX_EVENT;
+    buf->data = (unsigned char*)malloc(buf->capacity);
+    if (!buf->data) {
+        free(buf);
+        return NULL;
+    }
+    wrap_trace_start_chunk(buf);
+    buf->dropped = 0;
+    do {
+        thread = wrap_trace_threads;
+    } while (!WRAP_CAS(&wrap_trace_threads, thread, thread + 1));
+    buf->thread = thread;
+    do {
+        head = wrap_trace_buffers;
+        buf->next_buffer = head;
+    } while (!WRAP_CAS(&wrap_trace_buffers, head, buf));
+    return buf;
+}
+
+/* Opens this process's trace file, once MPI is initialized. */
+static WRAP_UNUSED void wrap_trace_open(void) {
+    int initialized, finalized = 0, rank;
+    PMPI_Initialized(&initialized);
+    if (initialized)
+        PMPI_Finalized(&finalized);
+    if (!initialized || finalized)
+        return;
+    while (!WRAP_CAS(&wrap_trace_lock, 0, 1))
+        ;
+    if (wrap_trace_state == WRAP_TRACE_CLOSED) {
+        const char *prefix = getenv("WRAP_TRACE_PREFIX");
+        char *name;
+        PMPI_Comm_rank(MPI_COMM_WORLD, &rank);
+        if (!prefix)
+            prefix = WRAP_TRACE_PREFIX;
+        name = (char*)malloc(strlen(prefix) + 32);
+        if (name) {
+            sprintf(name, "%s-%d.trace", prefix, rank);
+            wrap_trace_fd = open(name, O_RDWR | O_CREAT | O_TRUNC, 0644);
+            free(name);
+        }
+        if (wrap_trace_fd < 0)
+            fprintf(stderr, "WARNING: couldn't open trace file for rank %d.\\n", rank);
+        wrap_trace_state = (wrap_trace_fd < 0) ? WRAP_TRACE_FAILED : WRAP_TRACE_OPEN;
+    }
+    WRAP_CAS(&wrap_trace_lock, 1, 0);
+}
+
+/* Copies len bytes to offset in the trace file.  Returns nonzero if it worked. */
+static WRAP_UNUSED int wrap_trace_write(const void *data, size_t len, unsigned long long offset) {
+    unsigned long long page = (unsigned long long)sysconf(_SC_PAGESIZE), start;
+    char *map;
+    int ok = 1;
+    if (!len)
+        return 1;
+    while (!WRAP_CAS(&wrap_trace_lock, 0, 1))
+        ;
+    if (offset + len > wrap_trace_file_size) {
+        /* Grow the file by at least half, so that it's only resized a few times. */
+        unsigned long long size = wrap_trace_file_size + wrap_trace_file_size / 2;
+        if (size < offset + len)
+            size = offset + len;
+        size = (size + (1 << 20) - 1) & ~(unsigned long long)((1 << 20) - 1);
+        if (ftruncate(wrap_trace_fd, (off_t)size) == 0)
+            wrap_trace_file_size = size;
+        else
+            ok = 0;
+    }
+    WRAP_CAS(&wrap_trace_lock, 1, 0);
+    if (!ok)
+        return 0;
+    start = offset - offset % page;
+    map = (char*)mmap(NULL, (size_t)(offset + len - start), PROT_READ | PROT_WRITE, MAP_SHARED,
+                      wrap_trace_fd, (off_t)start);
+    if (map == (char*)MAP_FAILED)
+        return 0;
+    memcpy(map + (offset - start), data, len);
+    munmap(map, (size_t)(offset + len - start));
+    return 1;
+}
+
+/* Writes out the chunk in buf if the trace file is open, and starts a new one.  Returns
+   zero, leaving the chunk as it is, if the file isn't open yet. */
+static WRAP_UNUSED int wrap_trace_flush(wrap_trace_buffer *buf) {
+    wrap_trace_chunk *chunk = (wrap_trace_chunk*)buf->data;
+    if (!buf->events)
+        return 1;
+    if (wrap_trace_state == WRAP_TRACE_CLOSED)
+        wrap_trace_open();
+    if (wrap_trace_state != WRAP_TRACE_OPEN)
+        return 0;
+    chunk->size = (unsigned int)(buf->used - sizeof(wrap_trace_chunk));
+    chunk->events = buf->events;
+    chunk->thread = (unsigned int)buf->thread;
+    chunk->reserved = 0;
+    if (wrap_trace_write(buf->data, buf->used, wrap_trace_fetch_add(&wrap_trace_end, buf->used))) {
+        wrap_trace_fetch_add(&wrap_trace_chunks, 1);
+        wrap_trace_fetch_add(&wrap_trace_events, buf->events);
+    } else {
+        /* The space stays reserved, and reads as an empty chunk, so readers stop there. */
+        buf->dropped += buf->events;
+        wrap_trace_state = WRAP_TRACE_FAILED;
+    }
+    wrap_trace_start_chunk(buf);
+    return 1;
+}
+
+/* Adds an event for a call to this thread's trace buffer.  The arguments that
+   wrap_trace_fields[fn] says the function doesn't have are ignored. */
+static WRAP_UNUSED void wrap_trace_add(int fn, wrap_ticks_t start, wrap_ticks_t end, MPI_Comm comm,
+                                       int peer, long long count, MPI_Datatype type) {
+    wrap_trace_buffer *buf = wrap_thread_trace;
+    unsigned char *p;
+    int fields = wrap_trace_fields[fn], comm_entry = 0, type_entry = 0;
+    if (WRAP_UNLIKELY(!buf || wrap_trace_state == WRAP_TRACE_FINISHED)) {
+        if (wrap_trace_state == WRAP_TRACE_FINISHED || !(buf = wrap_thread_trace = wrap_trace_new_buffer()))
+            return;
+    }
+    if (WRAP_UNLIKELY(buf->used + WRAP_TRACE_MAX_EVENT > buf->capacity ||
+                      (!buf->fn_index[fn] && buf->fns == WRAP_TRACE_MAX_FNS))) {
+        wrap_trace_flush(buf);
+        if (buf->used + WRAP_TRACE_MAX_EVENT > buf->capacity ||
+            (!buf->fn_index[fn] && buf->fns == WRAP_TRACE_MAX_FNS)) {
+            buf->dropped++;     /* The file isn't open yet, or it failed. */
+            return;
+        }
+    }
+    if (WRAP_UNLIKELY(buf->type_epoch != wrap_type_cache_epoch)) {
+        /* A datatype was freed, and its handle may be reused for another. */
+        memset(buf->has_type, 0, sizeof(buf->has_type));
+        buf->type_epoch = wrap_type_cache_epoch;
+    }
+    p = buf->data + buf->used;
+
+    if (!buf->fn_index[fn]) {
+        buf->fn_index[fn] = (unsigned char)++buf->fns;
+        *p++ = WRAP_TRACE_DEF_FN;
+        p = wrap_trace_varint(p, buf->fns - 1);
+        p = wrap_trace_varint(p, fn);
+    }
+    /* Dictionary entries are 1 + index, so that 0 can mean none. */
+    if (fields & WRAP_TRACE_HAS_COMM) {
+        const wrap_comm *info = wrap_comm_info(comm);
+        if (info->id < 0) {
+            comm = MPI_COMM_NULL;
+        } else {
+            comm_entry = info->id % WRAP_TRACE_DICT + 1;
+            if (buf->comms[comm_entry - 1] != info->id + 1) {
+                buf->comms[comm_entry - 1] = info->id + 1;
+                *p++ = WRAP_TRACE_DEF_COMM;
+                p = wrap_trace_varint(p, comm_entry - 1);
+                p = wrap_trace_varint(p, info->id);
+                p = wrap_trace_varint(p, info->size);
+                p = wrap_trace_signed(p, info->rank);
+            }
+        }
+    }
+    if ((fields & WRAP_TRACE_HAS_BUFFER) && type != MPI_DATATYPE_NULL) {
+        type_entry = (int)((((size_t)type >> 3) ^ ((size_t)type >> 12)) % WRAP_TRACE_DICT) + 1;
+        if (!buf->has_type[type_entry - 1] || buf->types[type_entry - 1] != type) {
+            char name[MPI_MAX_OBJECT_NAME];
+            int len = 0;
+            buf->has_type[type_entry - 1] = 1;
+            buf->types[type_entry - 1] = type;
+            PMPI_Type_get_name(type, name, &len);
+            *p++ = WRAP_TRACE_DEF_TYPE;
+            p = wrap_trace_varint(p, type_entry - 1);
+            p = wrap_trace_varint(p, wrap_type_size(type));
+            p = wrap_trace_varint(p, len);
+            memcpy(p, name, len);
+            p += len;
+        }
+    }
+
+    *p++ = (unsigned char)(WRAP_TRACE_EVENT + buf->fn_index[fn] - 1);
+    p = wrap_trace_signed(p, (long long)(start - buf->last));
+    p = wrap_trace_varint(p, end > start ? end - start : 0);
+    buf->last = start;
+    if (fields & WRAP_TRACE_HAS_COMM)
+        p = wrap_trace_varint(p, comm_entry);
+    if (fields & WRAP_TRACE_HAS_PEER)
+        p = wrap_trace_signed(p, comm == MPI_COMM_NULL ? peer : wrap_comm_world_rank(comm, peer));
+    if (fields & WRAP_TRACE_HAS_BUFFER) {
+        p = wrap_trace_varint(p, type_entry);
+        if (type_entry)
+            p = wrap_trace_varint(p, (unsigned long long)count);
+    }
+    buf->used = p - buf->data;
+    buf->events++;
+}
+
+/* Writes out the trace.  Call it while no other thread is in MPI, before PMPI_Finalize.
+   {{trace}} calls it in the MPI_Finalize wrapper. */
+static WRAP_UNUSED void wrap_trace_finish(void) {
+    wrap_trace_header header;
+    wrap_trace_buffer *buf;
+    unsigned long long dropped = 0, names, fields;
+    size_t len;
+    char *table, *p;
+    int i;
+    if (wrap_trace_state == WRAP_TRACE_FINISHED)
+        return;
+    for (buf = wrap_trace_buffers; buf; buf = buf->next_buffer) {
+        if (!wrap_trace_flush(buf))
+            buf->dropped += buf->events;
+        dropped += buf->dropped;
+    }
+    if (wrap_trace_fd >= 0) {
+        /* Even if a write failed, the header says what was written before it. */
+        for (len = 0, i = 0; i < WRAP_FN_COUNT; i++)
+            len += strlen(wrap_fn_names[i]) + 1;
+        table = (char*)malloc(len);
+        names = fields = 0;
+        if (table) {
+            for (p = table, i = 0; i < WRAP_FN_COUNT; i++) {
+                strcpy(p, wrap_fn_names[i]);
+                p += strlen(p) + 1;
+            }
+            names = wrap_trace_fetch_add(&wrap_trace_end, len + WRAP_FN_COUNT);
+            fields = names + len;
+            if (!wrap_trace_write(table, len, names) ||
+                !wrap_trace_write(wrap_trace_fields, WRAP_FN_COUNT, fields))
+                names = fields = 0;
+            free(table);
+        }
+
+        memset(&header, 0, sizeof(header));
+        memcpy(header.magic, "WRAPTRC", 8);
+        header.version = 2;
+        header.header_size = sizeof(wrap_trace_header);
+        header.fn_count = WRAP_FN_COUNT;
+        header.threads = wrap_trace_threads;
+        PMPI_Comm_rank(MPI_COMM_WORLD, &header.rank);
+        PMPI_Comm_size(MPI_COMM_WORLD, &header.size);
+        wrap_ticks_calibrate();
+        header.tick_seconds = wrap_tick_seconds;
+        header.chunks = wrap_trace_chunks;
+        header.events = wrap_trace_events;
+        header.dropped = dropped;
+        header.names = names;
+        header.fields = fields;
+        wrap_trace_write(&header, sizeof(header), 0);
+        if (ftruncate(wrap_trace_fd, (off_t)wrap_trace_end) != 0)
+            fprintf(stderr, "WARNING: couldn't truncate trace file.\\n");
+        close(wrap_trace_fd);
+    }
+    wrap_trace_state = WRAP_TRACE_FINISHED;
+}
+
+'''
+
+# Bits in wrap_trace_fields, which says which arguments traces record for each function,
+# and the Declaration methods that find them.
+trace_fields = [("WRAP_TRACE_HAS_COMM", "commArg"),
+                ("WRAP_TRACE_HAS_PEER", "peerArg"),
+                ("WRAP_TRACE_HAS_BUFFER", "bufferArgs")]
+
+def write_trace(out):
+    """Writes the tracing code, after a table of the fields recorded for each function."""
+    def fields(decl):
+        return sum(1 << bit for bit, (name, method) in enumerate(trace_fields)
+                   if getattr(decl, method)())
+
+    for bit, (name, method) in enumerate(trace_fields):
+        out.write("#define %s %d\n" % (name, 1 << bit))
+    out.write("\nstatic WRAP_UNUSED const unsigned char wrap_trace_fields[WRAP_FN_COUNT] = {\n")
+    out.write(",\n".join("    %d" % fields(mpi_functions[name]) for name in sorted(mpi_functions)))
+    out.write("\n};\n")
+    out.write(wrapper_trace)
+
+# C code that generated wrappers can need, by name: (names of the code it needs, code).
+# The code is a string, or a function that writes it to an output.  write_support()
+# writes each piece into an output at most once.
+support_code = {
+    "thread_local"     : ([], wrapper_thread_local),
+    "attributes"       : ([], wrapper_attributes),
+    "atomics"          : ([], wrapper_atomics),
+    "fortran_scratch"  : (["thread_local", "attributes", "atomics"], wrapper_fortran_scratch),
+    "fortran_status"   : ([], wrapper_fortran_status),
+    "fortran_alias"    : ([], wrapper_fortran_alias),
+    "clock"            : (["attributes"], wrapper_clock),
+    "timing"           : (["thread_local", "attributes", "atomics", "fn_registry", "clock"], wrapper_timing),
+    "type_sizes"       : (["thread_local", "attributes", "atomics"], wrapper_type_sizes),
+    "comm_info"        : (["thread_local", "attributes", "atomics"], wrapper_comm_info),
+    "sampling"         : (["thread_local", "attributes", "fn_registry"], write_sampling),
+    "enable"           : (["attributes", "fn_registry"], wrapper_enable),
+    "trace"            : (["clock", "comm_info", "type_sizes", "fn_registry"], write_trace),
+    "profile"          : (["timing"], wrapper_profile),
+}
+
 # Default modifiers for generated bindings
 default_modifiers = ["_EXTERN_C_"]  # _EXTERN_C_ is #defined (or not) in wrapper_includes. See above.
 
@@ -193,20 +1567,15 @@ def find_matching_paren(string, index, lparen='(', rparen=')'):
     if not string[index] == lparen:
         raise ValueError("Character at index %d is '%s'. Expected '%s'"
                          % (index, string[index], lparen))
-    index += 1
-    count = 1
-    while index < len(string) and count > 0:
-        while index < len(string) and string[index] not in (lparen, rparen):
-            index += 1
-        if string[index] == lparen:
+    count = 0
+    for match in re.compile("[%s]" % re.escape(lparen + rparen)).finditer(string, index):
+        if match.group() == lparen:
             count += 1
-        elif string[index] == rparen:
+        else:
             count -= 1
-
-    if count == 0:
-        return index
-    else:
-        return -1
+            if count == 0:
+                return match.start()
+    return -1
 
 
 def isindex(str):
@@ -254,60 +1623,74 @@ class Token:
 
 
 class LineTrackingLexer(object):
-    """Base class for Lexers that keep track of line numbers."""
+    """Base class for Lexers that keep track of line numbers.  The lexicon is a
+       list of (regex, action) pairs.  At each point in the input, the first regex
+       that matches is used, and action(value, line) makes a Token out of what it
+       matched (or None means skip it).  The regexes are combined into one, so
+       they can't have capturing groups of their own.  Lexing takes one pass
+       over the input.
+    """
     def __init__(self, lexicon):
-        self.line_no = -1
-        self.scanner = re.Scanner(lexicon)
-
-    def make_token(self, type, value):
-        token = Token(type, value, self.line_no)
-        self.line_no += value.count("\n")
-        return token
-
-    def lex(self, text):
-        self.line_no = 0
-        tokens, remainder = self.scanner.scan(text)
-        if remainder:
-            sys.stderr.write("Unlexable input:\n%s\n" % remainder)
-            sys.exit(1)
-        self.line_no = -1
+        self.regex = re.compile("|".join("(%s)" % regex for regex, action in lexicon))
+        self.actions = [action for regex, action in lexicon]
+
+    def lex(self, text, line=1):
+        """Returns a list of the tokens in text, which starts on line <line>."""
+        global cur_line
+        tokens = []
+        match = self.regex.match
+        actions = self.actions
+        pos = 0
+        while pos < len(text):
+            m = match(text, pos)
+            if not m or m.end() == pos:
+                cur_line = line
+                syntax_error("Unlexable input: '%s'" % text[pos:pos+40].split("\n")[0])
+            value = m.group()
+            action = actions[m.lastindex - 1]
+            if action:
+                tokens.append(action(value, line))
+            line += value.count("\n")
+            pos = m.end()
         return tokens
 
+    def lbrace(self, value, line): return Token(LBRACE, value, line)
+    def rbrace(self, value, line): return Token(RBRACE, value, line)
+    def text(self, value, line):   return Token(TEXT, value, line)
+
 class OuterRegionLexer(LineTrackingLexer):
     def __init__(self):
         super(OuterRegionLexer, self).__init__([
-            (r'{{',                     self.lbrace),
-            (r'}}',                     self.rbrace),
-            (r'({(?!{)|}(?!})|[^{}])*', self.text)])
-    def lbrace(self, scanner, token): return self.make_token(LBRACE, token)
-    def rbrace(self, scanner, token): return self.make_token(RBRACE, token)
-    def text(self, scanner, token):   return self.make_token(TEXT, token)
-
-class OuterCommentLexer(OuterRegionLexer):
-    def __init__(self):
-        super(OuterRegionLexer, self).__init__([
-            (r'/\*(.|[\r\n])*?\*/',                self.text),   # multiline comment
-            (r'//(.|[\r\n])*?(?=[\r\n])',          self.text),   # single line comment
-            (r'{{',                                self.lbrace),
-            (r'}}',                                self.rbrace),
-            (r'({(?!{)|}(?!})|/(?![/*])|[^{}/])*', self.text)])
+            (r'{{',                          self.lbrace),
+            (r'}}',                          self.rbrace),
+            (r'(?:[^{}]+|{(?!{)|}(?!}))+',   self.text)])
 
-class InnerLexer(OuterRegionLexer):
+class OuterCommentLexer(LineTrackingLexer):
     def __init__(self):
-        super(OuterRegionLexer, self).__init__([
-            (r'{{',                               self.lbrace),
-            (r'}}',                               self.rbrace),
-            (r'(["\'])?((?:(?!\1)[^\\]|\\.)*)\1', self.quoted_id),
-            (r'([^\s]+)',                         self.identifier),
-            (r'\s+', None)])
-    def identifier(self, scanner, token): return self.make_token(IDENTIFIER, token)
-    def quoted_id(self, scanner, token):
+        super(OuterCommentLexer, self).__init__([
+            (r'/\*[\s\S]*?\*/',                         self.text),   # multiline comment
+            (r'//[^\r\n]*',                             self.text),   # single line comment
+            (r'{{',                                     self.lbrace),
+            (r'}}',                                     self.rbrace),
+            (r'(?:[^{}/]+|{(?!{)|}(?!})|/(?![/*]))+',   self.text)])
+
+class InnerLexer(LineTrackingLexer):
+    def __init__(self):
+        super(InnerLexer, self).__init__([
+            (r'{{',                                     self.lbrace),
+            (r'}}',                                     self.rbrace),
+            (r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'', self.quoted_id),
+            (r'\S+',                                    self.identifier),
+            (r'\s+',                                    None)])
+    def identifier(self, value, line): return Token(IDENTIFIER, value, line)
+    def quoted_id(self, value, line):
         # remove quotes from quoted ids.  Note that ids and quoted ids are pretty much the same thing;
         # the quotes are just optional.  You only need them if you need spaces in your expression.
-        return self.make_token(IDENTIFIER, re.sub(r'^["\'](.*)["\']$', '\\1', token))
+        return Token(IDENTIFIER, re.sub(r'^["\'](.*)["\']$', '\\1', value), line)
 
-# Global current filename and function name for error msgs
+# Global current filename, line, and function name for error msgs
 cur_filename = ""
+cur_line = 0
 cur_function = None
 
 class WrapSyntaxError(Exception):
@@ -315,12 +1698,128 @@ class WrapSyntaxError(Exception):
     pass
 
 def syntax_error(msg):
-    # TODO: make line numbers actually work.
-    sys.stderr.write("%s:%d: %s\n" % (cur_filename, 0, msg))
+    sys.stderr.write("%s:%d: %s\n" % (cur_filename, cur_line, msg))
     if cur_function:
         sys.stderr.write("    While handling %s.\n" % cur_function)
     raise WrapSyntaxError
 
+################################################################################
+# Profiling:
+#   With --profile, wrap.py reports where a run spent its time and what it wrote.
+#   Phases and macros are timed with a stack of timers, so each timer's "seconds"
+#   excludes time spent in the timers nested inside it, and "inclusive_seconds"
+#   includes it.  Output is counted in bytes per MPI function and per wrapper file.
+################################################################################
+# Profile of the current run, or None when not profiling.
+profile = None
+
+# Best clock available for timing.
+clock = getattr(time, "perf_counter", time.time)
+
+class Profile:
+    """Timings and output sizes for one run of the generator."""
+    def __init__(self):
+        self.start = clock()
+        self.timers = {}          # name -> [calls, seconds, inclusive seconds]
+        self.stack = []           # [name, start time, time in nested timers]
+        self.function_bytes = {}  # MPI function name -> bytes of output
+        self.file_bytes = {}      # wrapper file name -> bytes of output
+        self.caches = {}          # cache name -> {"hits" : n, "misses" : n}
+
+    def enter(self, name):
+        self.stack.append([name, clock(), 0.0])
+
+    def exit(self):
+        name, start, nested = self.stack.pop()
+        elapsed = clock() - start
+        timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += elapsed - nested
+        # Don't count time twice when a timer is nested in itself, e.g. fn in fn.
+        if not any(frame[0] == name for frame in self.stack):
+            timer[2] += elapsed
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def time(self, name, function, *args):
+        """Calls function(*args), timing it as name."""
+        self.enter(name)
+        try:
+            return function(*args)
+        finally:
+            self.exit()
+
+    def wrap_macros(self, macros):
+        """Returns a copy of a table of macros that times each call as macro:<name>."""
+        return dict((name, self.timed_macro(name, value)) for name, value in macros.items())
+
+    def timed_macro(self, name, value):
+        if not callable(value):
+            return value
+        def timed(*args):
+            return self.time("macro:" + name, value, *args)
+        timed.has_body = getattr(value, "has_body", False)
+        return timed
+
+    def count_cache(self, name, hit):
+        counts = self.caches.setdefault(name, {"hits" : 0, "misses" : 0})
+        counts["hits" if hit else "misses"] += 1
+
+    def add_bytes(self, table, name, size):
+        table[name] = table.get(name, 0) + size
+
+    def data(self):
+        """Everything measured so far, as a dict that can be stored as JSON."""
+        return {
+            "timers" : dict((name, {"calls" : calls, "seconds" : seconds,
+                                    "inclusive_seconds" : inclusive})
+                            for name, (calls, seconds, inclusive) in self.timers.items()),
+            "caches" : self.caches,
+            "output_bytes" : {
+                "total"     : sum(self.file_bytes.values()),
+                "files"     : self.file_bytes,
+                "functions" : self.function_bytes,
+            },
+        }
+
+    def merge(self, data):
+        """Adds in data() from a profile taken in a worker process."""
+        for name, timer in data["timers"].items():
+            mine = self.timers.setdefault(name, [0, 0.0, 0.0])
+            mine[0] += timer["calls"]
+            mine[1] += timer["seconds"]
+            mine[2] += timer["inclusive_seconds"]
+        for name, counts in data["caches"].items():
+            mine = self.caches.setdefault(name, {"hits" : 0, "misses" : 0})
+            mine["hits"] += counts["hits"]
+            mine["misses"] += counts["misses"]
+        for name, size in data["output_bytes"]["files"].items():
+            self.add_bytes(self.file_bytes, name, size)
+        for name, size in data["output_bytes"]["functions"].items():
+            self.add_bytes(self.function_bytes, name, size)
+
+    def report(self):
+        """data(), plus the wall-clock time since the profile started."""
+        report = self.data()
+        report["seconds"] = clock() - self.start
+        return report
+
+def timed(name, function, *args):
+    """Calls function(*args), and times it as name if profiling."""
+    if profile is None:
+        return function(*args)
+    return profile.time(name, function, *args)
+
+class CountingWriter:
+    """Passes writes through to a file, and counts the characters written."""
+    def __init__(self, out):
+        self.out = out
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+        self.out.write(text)
+
 ################################################################################
 # MPI Semantics:
 #   Classes in this section describe MPI declarations and types.  These are used
@@ -336,6 +1835,7 @@ class Scope:
         self.map = {}
         self.enclosing_scope = enclosing_scope
         self.macro_name = None           # For better debugging error messages
+        self.function_name = None        # Function whose wrapper this scope is for, if any
 
     def __getitem__(self, key):
         if key in self.map:         return self.map[key]
@@ -362,6 +1862,9 @@ class Scope:
 # Map from function name to declaration created from mpi.h.
 mpi_functions = {}
 
+# Paths of mpi.h and every header the preprocessor read along with it.
+mpi_headers = set()
+
 class Param:
     """Descriptor for formal parameters of MPI functions.
        Doesn't represent a full parse, only the initial type information,
@@ -495,6 +1998,35 @@ class Declaration:
     def getArgName(self, index):
         return self.argsNoEllipsis()[index].name
 
+    def bufferArgs(self):
+        """Returns (buffer, count, datatype) Params for each buffer whose size is given
+           by a count and a datatype, e.g. (buf, count, datatype) for MPI_Send.  Where
+           two buffers share a count and datatype, as in MPI_Allreduce, the buffer is
+           the second one."""
+        buffers = []
+        for buf, count, datatype in zip(self.args, self.args[1:], self.args[2:]):
+            if (datatype.type == "MPI_Datatype" and not (datatype.pointers or datatype.array) and
+                count.type in ("int", "MPI_Count") and not (count.pointers or count.array) and
+                "void" in buf.type.split() and buf.pointers == "*" and not buf.array):
+                buffers.append((buf, count, datatype))
+        return buffers
+
+    def commArg(self):
+        """Returns the first MPI_Comm argument passed by value, or None."""
+        for arg in self.args:
+            if arg.type == "MPI_Comm" and not (arg.pointers or arg.array):
+                return arg
+        return None
+
+    def peerArg(self):
+        """Returns the first int argument that is the rank of another process, like
+           dest or source for point-to-point and root for collectives, or None."""
+        for arg in self.args:
+            if (arg.name in ("dest", "source", "target_rank", "root") and arg.type == "int"
+                and not (arg.pointers or arg.array)):
+                return arg
+        return None
+
     def fortranFormals(self):
         formals = list(map(Param.fortranFormal, self.argsNoEllipsis()))
         if self.name == "MPI_Init": formals = []    # Special case for init: no args in fortran
@@ -533,10 +2065,11 @@ class Declaration:
 types = set()
 all_pointers = set()
 
-def enumerate_mpi_declarations(mpicc, includes):
+def enumerate_mpi_declarations(mpicc, includes, headers=None):
     """ Invokes mpicc's C preprocessor on a C file that includes mpi.h.
         Parses the output for declarations, and yields each declaration to
-        the caller.
+        the caller.  If a set is passed as headers, the paths of all headers
+        the preprocessor read are added to it.
     """
     # Create an input file that just includes <mpi.h>
     tmpfile = tempfile.NamedTemporaryFile('w+b', -1, suffix='.c')
@@ -556,68 +2089,260 @@ def enumerate_mpi_declarations(mpicc, includes):
         sys.stderr.write("IOError: couldn't run '" + mpicc_cmd + "' for parsing mpi.h\n")
         sys.exit(1)
 
-    # Parse out the declarations from the MPI file
-    mpi_h = popen.stdout
-    for line in mpi_h:
-        line = line.decode().strip()
-        begin = begin_decl_re.search(line)
-        if begin and not exclude_re.search(line):
-            # Grab return type and fn name from initial parse
-            return_type, fn_name = begin.groups()
-
-            # Accumulate rest of declaration (possibly multi-line)
-            while not end_decl_re.search(line):
-                line += " " + next(mpi_h).decode().strip()
-
-            # Split args up by commas so we can parse them independently
-            fn_and_paren = r'(%s\s*\()' % fn_name
-            match = re.search(fn_and_paren, line)
-            lparen = match.start(1) + len(match.group(1)) - 1
-            rparen = find_matching_paren(line, lparen)
-            if rparen < 0:
-                raise ValueError("Malformed declaration in header: '%s'" % line)
-
-            arg_string = line[lparen+1:rparen]
-            arg_list = list(map(lambda s: s.strip(), arg_string.split(",")))
-
-            # Handle functions that take no args specially
-            if arg_list == ['void']:
-                arg_list = []
-
-            # Parse formal parameter descriptors out of args
-            decl = Declaration(return_type, fn_name)
-            arg_num = 0
-            for arg in arg_list:
-                if arg == '...':   # Special case for Pcontrol.
-                    decl.addArgument(Param(None, None, '...', None, arg_num))
-                else:
+    # Read all of the preprocessor's output before parsing it, so that the
+    # preprocessor and the parser can be profiled separately.
+    output, errors = timed("preprocess", popen.communicate)
+    if popen.returncode != 0:
+        sys.stderr.write("Error: Couldn't run '%s' for parsing mpi.h.\n" % mpicc_cmd)
+        sys.stderr.write("       Process exited with code %d.\n" % popen.returncode)
+        sys.exit(1)
+
+    # Find all the declarations and line markers in one pass over the output.
+    text = output.decode()
+    formals = {}
+    pos = 0
+    while True:
+        match = mpi_h_re.search(text, pos)
+        if not match:
+            break
+        pos = match.end()
+
+        if match.group(3) is not None:
+            if headers is not None:
+                path = re.sub(r'\\(.)', r'\1', match.group(3))
+                if not path.startswith("<") and path != tmpname:
+                    headers.add(path)
+            continue
+
+        # Skip declarations whose first line contains an excluded string.
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        line_end = text.find("\n", match.start())
+        if exclude_re.search(text, line_start, line_end if line_end >= 0 else len(text)):
+            continue
+
+        # Find the end of the argument list.  Skip the match if it isn't followed
+        # by a semicolon (i.e., if it's a function definition, not a declaration).
+        return_type, fn_name = match.group(1), match.group(2)
+        lparen = match.end() - 1
+        rparen = find_matching_paren(text, lparen)
+        if rparen < 0:
+            raise ValueError("Malformed declaration in header: '%s'" % text[match.start():])
+        semicolon = text.find(";", rparen)
+        brace = text.find("{", rparen)
+        if semicolon < 0 or 0 <= brace < semicolon:
+            continue
+        pos = semicolon + 1
+
+        # Split args up by commas so we can parse them independently, and join
+        # lines of args split across several lines.
+        arg_list = [" ".join(arg.split()) for arg in text[lparen+1:rparen].split(",")]
+
+        # Handle functions that take no args specially
+        if arg_list == ['void']:
+            arg_list = []
+
+        # Parse formal parameter descriptors out of args
+        decl = Declaration(return_type, fn_name)
+        arg_num = 0
+        for arg in arg_list:
+            if arg == '...':   # Special case for Pcontrol.
+                decl.addArgument(Param(None, None, '...', None, arg_num))
+            else:
+                # The same few formals appear over and over, so parse each one once.
+                formal = formals.get(arg)
+                if formal is None:
                     match = formal_re.match(arg)
                     if not match:
                         sys.stderr.write("MATCH FAILED FOR: '%s' in %s\n" % (arg, fn_name))
                         sys.exit(1)
+                    formal = formals[arg] = match.groups()
+                    types.add(formal[0])
+                    all_pointers.add(formal[1])
 
-                    type, pointers, name, array = match.groups()
-                    types.add(type)
-                    all_pointers.add(pointers)
-                    # If there's no name, make one up.
-                    if not name: name = "arg_" + str(arg_num)
+                type, pointers, name, array = formal
+                # If there's no name, make one up.
+                if not name: name = "arg_" + str(arg_num)
 
-                    decl.addArgument(Param(type.strip(), pointers, name, array, arg_num))
-                arg_num += 1
+                decl.addArgument(Param(type.strip(), pointers, name, array, arg_num))
+            arg_num += 1
 
-            yield decl
-
-    mpi_h.close()
-    return_code = popen.wait()
-    if return_code != 0:
-        sys.stderr.write("Error: Couldn't run '%s' for parsing mpi.h.\n" % mpicc_cmd)
-        sys.stderr.write("       Process exited with code %d.\n" % return_code)
-        sys.exit(1)
+        yield decl
 
     # Do some cleanup once we're done reading.
     tmpfile.close()
 
 
+################################################################################
+# Declaration cache:
+#   Parsing mpi.h means running the preprocessor, which is by far the slowest part
+#   of a typical run.  The parsed declarations are cached on disk, keyed by the
+#   compiler and include path, and validated against the contents of every header
+#   the preprocessor read when the cache entry was made.
+################################################################################
+# Version of the cache format.  Bump this when the declaration parser changes.
+cache_version = 2
+
+def default_cache_dir():
+    """Directory for the cache: $WRAP_CACHE_DIR if it is set, otherwise
+       wrap.py under $XDG_CACHE_HOME (or ~/.cache)."""
+    if os.environ.get("WRAP_CACHE_DIR"):
+        return os.environ["WRAP_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "wrap.py")
+
+def find_executable(name):
+    """Full path to an executable, searching PATH if needed.  None if not found."""
+    if os.path.dirname(name):
+        return os.path.abspath(name) if os.path.isfile(name) else None
+    for dir in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(dir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def file_hash(path):
+    """SHA1 of a file's contents, or None if the file can't be read."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def declaration_cache_file(mpicc, includes):
+    """Path of the cache entry for the declarations mpicc finds with includes.
+       The key covers the compiler command, the executable it resolves to, and the
+       include path.  The headers themselves are checked when the entry is read."""
+    key = [cache_version, mpicc, [os.path.abspath(dir) for dir in includes]]
+    words = mpicc.split()
+    exe = find_executable(words[0]) if words else None
+    if exe:
+        st = os.stat(exe)
+        key += [os.path.realpath(exe), st.st_size, int(st.st_mtime)]
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return os.path.join(cache_dir or default_cache_dir(), "decls-%s.json" % digest)
+
+def read_declaration_cache(filename, headers=None):
+    """Returns the cached list of Declarations in filename, or None if there is
+       no valid entry there (missing, unreadable, or any header has changed).
+       If a set is passed as headers, the headers in the entry are added to it."""
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get("version") != cache_version:
+        return None
+    for path, digest in data["headers"].items():
+        if file_hash(path) != digest:
+            return None
+    if headers is not None:
+        headers.update(data["headers"])
+
+    decls = []
+    for rtype, name, args in data["decls"]:
+        decl = Declaration(rtype, name)
+        for pos, (type, pointers, arg_name, array) in enumerate(args):
+            decl.addArgument(Param(type, pointers, arg_name, array, pos))
+        decls.append(decl)
+    return decls
+
+def write_declaration_cache(filename, decls, headers):
+    """Stores decls in the cache, along with hashes of the headers they came from.
+       Failing to write the cache is not an error; we'll just parse mpi.h again."""
+    data = {
+        "version" : cache_version,
+        "headers" : dict((path, file_hash(path)) for path in headers),
+        "decls"   : [[decl.rtype, decl.name,
+                      [[arg.type, arg.pointers, arg.name, arg.array] for arg in decl.args]]
+                     for decl in decls]
+    }
+    write_cache_file(filename, data)
+
+def write_cache_file(filename, data):
+    """Writes data to a cache file as JSON.  Failing to write the cache is not an
+       error; it will just be rebuilt next time."""
+    try:
+        dir = os.path.dirname(filename)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        # Write to a temp file and rename so concurrent runs never see a partial entry.
+        fd, tmpname = tempfile.mkstemp(dir=dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.rename(tmpname, filename)
+    except (IOError, OSError):
+        pass
+
+def clear_cache_files():
+    """Removes all cached declarations and parsed wrapper files."""
+    for pattern in ["decls-*.json", "ast-*.json"]:
+        for filename in glob.glob(os.path.join(cache_dir or default_cache_dir(), pattern)):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+def load_mpi_declarations(mpicc, includes, headers=None):
+    """Returns a list of the declarations in mpi.h.  Uses the declaration cache
+       unless caching is disabled, and refreshes the cache if it is stale.  If a
+       set is passed as headers, the paths of the headers read are added to it."""
+    if headers is None:
+        headers = set()
+    if not use_cache:
+        return timed("scan_headers", list, enumerate_mpi_declarations(mpicc, includes, headers))
+
+    filename = declaration_cache_file(mpicc, includes)
+    decls = timed("read_declaration_cache", read_declaration_cache, filename, headers)
+    if profile is not None:
+        profile.count_cache("declarations", decls is not None)
+    if decls is None:
+        decls = timed("scan_headers", list, enumerate_mpi_declarations(mpicc, includes, headers))
+        if decls:
+            write_declaration_cache(filename, decls, headers)
+    return decls
+
+
+# Functions whose wrappers run every time, even when sampling or disabled at runtime.
+always_wrapped_functions = set(["MPI_Init", "MPI_Init_thread", "MPI_Finalize", "MPI_Pcontrol"])
+
+def sampling():
+    """True if wrappers should only run their bodies on sampled calls."""
+    return sample_period > 1 or sample_interval > 0
+
+def write_pmpi_return(out, decl, condition):
+    """Writes code that skips the rest of the wrapper, returning the PMPI call,
+       when condition is true."""
+    if ignore_deprecated:
+        out.write("WRAP_MPI_CALL_PREFIX\n")
+    out.write("    if (%s)\n" % condition)
+    out.write("        return P%s(%s);\n" % (decl.name, ", ".join(decl.argNames())))
+    if ignore_deprecated:
+        out.write("WRAP_MPI_CALL_POSTFIX\n")
+
+def write_sample_check(out, decl):
+    """When sampling, skip the wrapper body and just call the PMPI function unless
+       this call is sampled."""
+    if sampling() and decl.name not in always_wrapped_functions:
+        id = fn_id(decl.name)
+        write_pmpi_return(out, decl, "WRAP_LIKELY(--wrap_sample_countdown[%s] > 0) || !wrap_sample(%s)" % (id, id))
+
+def write_enable_check(out, decl):
+    """With -e, skip the wrapper body if the function is disabled at runtime.  Also
+       has the MPI_Init and MPI_Pcontrol wrappers set up and change what's enabled."""
+    if not runtime_enable:
+        return
+    if decl.name in ("MPI_Init", "MPI_Init_thread"):
+        out.write("    wrap_enable_init();\n")
+    elif decl.name == "MPI_Pcontrol" and decl.args and decl.args[-1].name == "...":
+        out.write("    {\n")
+        out.write("        va_list wrap_args;\n")
+        out.write("        va_start(wrap_args, %s);\n" % decl.argNames()[0])
+        out.write("        wrap_enable_pcontrol(%s, wrap_args);\n" % decl.argNames()[0])
+        out.write("        va_end(wrap_args);\n")
+        out.write("    }\n")
+    elif decl.name not in always_wrapped_functions:
+        write_pmpi_return(out, decl, "WRAP_LIKELY(WRAP_FN_DISABLED(%s))" % fn_id(decl.name))
+
 def write_enter_guard(out, decl):
     """Prevent us from entering wrapper functions if we're already in a wrapper function.
        Just call the PMPI function w/o the wrapper instead."""
@@ -643,6 +2368,8 @@ def write_c_wrapper(out, decl, return_val, write_body):
     out.write(" { \n")
     out.write("    %s %s = 0;\n" % (decl.retType(), return_val))
 
+    write_enable_check(out, decl)
+    write_sample_check(out, decl)
     write_enter_guard(out, decl)
     write_body(out)
     write_exit_guard(out)
@@ -669,6 +2396,19 @@ def write_fortran_binding(out, decl, delegate_name, binding, stmts=None):
     out.write("}\n\n")
 
 
+def write_fortran_aliases(out, decl, target, bindings):
+    """Outputs Fortran bindings that are aliases of the binding named target, where the
+       compiler supports aliases.  Elsewhere, they're wrappers that delegate to target.
+    """
+    out.write("#ifdef WRAP_F_ALIAS\n")
+    for binding in bindings:
+        out.write("%s WRAP_F_ALIAS(%s);\n" % (decl.fortranPrototype(binding, default_modifiers), target))
+    out.write("#else /* !WRAP_F_ALIAS */\n")
+    for binding in bindings:
+        write_fortran_binding(out, decl, target, binding)
+    out.write("#endif /* !WRAP_F_ALIAS */\n\n")
+
+
 class FortranDelegation:
     """Class for constructing a call to a Fortran wrapper delegate function.  Provides
        storage for local temporary variables, copies of parameters, callsites for MPI-1 and
@@ -678,16 +2418,23 @@ class FortranDelegation:
         self.decl = decl
         self.return_val = return_val
 
-        self.temps = set()
+        self.temps = []
         self.copies = []
         self.writebacks = []
         self.actuals = []
         self.mpich_actuals = []
+        self.scratch_slots = 0
+
+    def nextScratchSlot(self):
+        """Returns the next wrap_scratch() slot for a temporary array in this call."""
+        self.scratch_slots += 1
+        return self.scratch_slots - 1
 
     def addTemp(self, type, name):
         """Adds a temp var with a particular name.  Adds the same var only once."""
         temp = "    %s %s;" % (type, name)
-        self.temps.add(temp)
+        if not temp in self.temps:
+            self.temps.append(temp)
 
     def addActual(self, actual):
         self.actuals.append(actual)
@@ -730,8 +2477,14 @@ def write_fortran_wrappers(out, decl, return_val):
     """Writes primary fortran wrapper that handles arg translation.
        Also outputs bindings for this wrapper for different types of fortran compilers.
     """
-    delegate_name = decl.name + f_wrap_suffix
-    out.write(decl.fortranPrototype(delegate_name, ["static"]))
+    bindings = [decl.name.upper(), decl.name.lower(), decl.name.lower() + "_", decl.name.lower() + "__"]
+    if fortran_aliases and decl.name != "MPI_Init":
+        # Write the wrapper as one of the bindings, and make the rest aliases of it.
+        delegate_name = bindings.pop(2)
+        out.write(decl.fortranPrototype(delegate_name, default_modifiers))
+    else:
+        delegate_name = decl.name + f_wrap_suffix
+        out.write(decl.fortranPrototype(delegate_name, ["static"]))
     out.write(" { \n")
 
     call = FortranDelegation(decl, return_val)
@@ -783,38 +2536,67 @@ def write_fortran_wrappers(out, decl, return_val):
                 # For MPI-2, other pointer and array types need temporaries and special conversions.
                 if not arg.isHandleArray():
                     call.addTemp(arg.type, temp)
-                    call.addActualMPI2("&%s" % temp)
 
                     if arg.isStatus():
-                        call.addCopy("%s_f2c(%s, &%s);"  % (conv, arg.name, temp))
-                        call.addWriteback("%s_c2f(&%s, %s);" % (conv, temp, arg.name))
+                        # Pass MPI_F_STATUS_IGNORE through as MPI_STATUS_IGNORE, unconverted.
+                        given = "%s != MPI_F_STATUS_IGNORE" % arg.name
+                        call.addActualMPI2("(%s) ? &%s : MPI_STATUS_IGNORE" % (given, temp))
+                        call.addCopy("if (%s) %s_f2c(%s, &%s);"  % (given, conv, arg.name, temp))
+                        call.addWriteback("if (%s) %s_c2f(&%s, %s);" % (given, conv, temp, arg.name))
                     else:
+                        call.addActualMPI2("&%s" % temp)
                         call.addCopy("%s = %s_f2c(*%s);"  % (temp, conv, arg.name))
                         call.addWriteback("*%s = %s_c2f(%s);" % (arg.name, conv, temp))
                 else:
-                    # Make temporary variables for the array and the loop var
+                    # Make temporary variables for the array, a buffer on the stack for
+                    # small arrays, and the loop var
                     temp_arr_type = "%s*" % arg.type
+                    call.addTemp(arg.type, "%s_buf[WRAP_F_STACK_HANDLES]" % temp)
                     call.addTemp(temp_arr_type, temp)
                     call.addTemp("int", "i")
 
-                    # generate a copy and a writeback statement for this type of handle
+                    # generate a copy and a writeback statement for this type of handle.
+                    # Fortran statuses are arrays of WRAP_F_STATUS_SIZE MPI_Fints.
                     if arg.isStatus():
-                        copy = "    %s_f2c(&%s[i], &%s[i])"  % (conv, arg.name, temp)
-                        writeback = "    %s_c2f(&%s[i], &%s[i])" % (conv, temp, arg.name)
+                        copy = "%s_f2c(&%s[i * WRAP_F_STATUS_SIZE], &%s[i])"  % (conv, arg.name, temp)
+                        writeback = "%s_c2f(&%s[i], &%s[i * WRAP_F_STATUS_SIZE])" % (conv, temp, arg.name)
                     else:
-                        copy = "    temp_%s[i] = %s_f2c(%s[i])"  % (arg.name, conv, arg.name)
-                        writeback = "    %s[i] = %s_c2f(temp_%s[i])" % (arg.name, conv, arg.name)
+                        copy = "temp_%s[i] = %s_f2c(%s[i])"  % (arg.name, conv, arg.name)
+                        writeback = "%s[i] = %s_c2f(temp_%s[i])" % (arg.name, conv, arg.name)
 
-                    # Generate the call surrounded by temp array allocation, copies, writebacks, and temp free
+                    # Generate the call surrounded by copies and writebacks.  Big arrays
+                    # are converted in per-thread scratch space instead of on the stack.
                     count = "*%s" % arg.countParam().name
-                    call.addCopy("%s = (%s)malloc(sizeof(%s) * %s);" %
-                                 (temp, temp_arr_type, arg.type, count))
-                    call.addCopy("for (i=0; i < %s; i++)" % count)
-                    call.addCopy("%s;" % copy)
+                    slot = call.nextScratchSlot()
+                    alloc = ["%s = %s_buf;" % (temp, temp),
+                             "if (%s > WRAP_F_STACK_HANDLES)" % count,
+                             "    %s = (%s)wrap_scratch(%d, sizeof(%s) * %s);" %
+                             (temp, temp_arr_type, slot, arg.type, count),
+                             "for (i=0; i < %s; i++)" % count,
+                             "    %s;" % copy]
+                    release = ["for (i=0; i < %s; i++)" % count,
+                               "    %s;" % writeback,
+                               "if (%s != %s_buf) wrap_scratch_done(%s);" % (temp, temp, temp)]
+
+                    if arg.isStatus():
+                        # MPI_F_STATUSES_IGNORE goes through as MPI_STATUSES_IGNORE, with
+                        # no temporary array and no conversions.
+                        call.addCopy("if (%s == MPI_F_STATUSES_IGNORE) {" % arg.name)
+                        call.addCopy("    %s = MPI_STATUSES_IGNORE;" % temp)
+                        call.addCopy("} else {")
+                        for stmt in alloc:
+                            call.addCopy("    " + stmt)
+                        call.addCopy("}")
+                        call.addWriteback("if (%s != MPI_F_STATUSES_IGNORE) {" % arg.name)
+                        for stmt in release:
+                            call.addWriteback("    " + stmt)
+                        call.addWriteback("}")
+                    else:
+                        for stmt in alloc:
+                            call.addCopy(stmt)
+                        for stmt in release:
+                            call.addWriteback(stmt)
                     call.addActualMPI2(temp)
-                    call.addWriteback("for (i=0; i < %s; i++)" % count)
-                    call.addWriteback("%s;" % writeback)
-                    call.addWriteback("free(%s);" % temp)
 
     call.write(out)
     if decl.returnsErrorCode():
@@ -824,10 +2606,11 @@ def write_fortran_wrappers(out, decl, return_val):
     out.write("}\n\n")
 
     # Write out various bindings that delegate to the main fortran wrapper
-    write_fortran_binding(out, decl, delegate_name, decl.name.upper())
-    write_fortran_binding(out, decl, delegate_name, decl.name.lower())
-    write_fortran_binding(out, decl, delegate_name, decl.name.lower() + "_")
-    write_fortran_binding(out, decl, delegate_name, decl.name.lower() + "__")
+    if fortran_aliases:
+        write_fortran_aliases(out, decl, delegate_name, bindings)
+    else:
+        for binding in bindings:
+            write_fortran_binding(out, decl, delegate_name, binding)
 
 
 ################################################################################
@@ -880,24 +2663,88 @@ class TypeApplier:
             if arg.cType() == type:
                 out.write("%s(%s);\n" % (macro_name, arg.name))
 
+class BytesMacro:
+    """This class implements {{bytes}}, which expands to an expression for the size in
+       bytes of a buffer passed to the function, computed from its count and datatype.
+       {{bytes}} is the first such buffer, and {{bytes <n>}} the nth, counting from 0.
+       It expands to 0 if the function has no such buffer, or if it's MPI_IN_PLACE.
+    """
+    def __init__(self, decl):
+        self.decl = decl
+
+    def __call__(self, out, scope, args, children):
+        len(args) <= 1 or syntax_error("Wrong number of args in bytes macro.")
+        try:
+            index = int(args[0]) if args else 0
+        except ValueError:
+            syntax_error("Invalid buffer index in bytes macro: '%s'" % args[0])
+        return bytes_expression(self.decl, index)
+
+def bytes_expression(decl, index=0):
+    """C expression for the size in bytes of decl's buffer number index, for {{bytes}}."""
+    buffers = decl.bufferArgs()
+    if index >= len(buffers):
+        return "0"
+    buf, count, datatype = buffers[index]
+    return "(%s == MPI_IN_PLACE ? 0 : (long long)%s * wrap_type_size(%s))" % (
+        buf.name, count.name, datatype.name)
+
+class CommInfoMacro:
+    """This class implements {{comm_info}}, which expands to a call that returns cached
+       information about a communicator: {{comm_info <comm>}} for a particular one, or
+       {{comm_info}} for the function's first MPI_Comm argument (MPI_COMM_NULL if it has
+       none).
+    """
+    def __init__(self, decl):
+        self.decl = decl
+
+    def __call__(self, out, scope, args, children):
+        len(args) <= 1 or syntax_error("Wrong number of args in comm_info macro.")
+        if args:
+            comm = args[0]
+        else:
+            comm = self.decl.commArg()
+            comm = comm.name if comm else "MPI_COMM_NULL"
+        return "wrap_comm_info(%s)" % comm
+
 def include_decl(scope, decl):
     """This function is used by macros to include attributes MPI declarations in their scope."""
-    scope["ret_type"] = decl.retType()
-    scope["args"]     = decl.argNames()
-    scope["nargs"]    = len(decl.argNames())
-    scope["types"]    = decl.types()
-    scope["formals"]  = decl.formals()
-    scope["apply_to_type"] = TypeApplier(decl)
+    scope.include(decl_scope_values(decl))
     scope.function_name  = decl.name
+    if profile is not None:
+        # Time apply_to_type like the global macros.
+        apply = profile.timed_macro("apply_to_type", scope.map["apply_to_type"])
+        scope["apply_to_type"] = scope["applyToType"] = apply
+
+def decl_scope_values(decl):
+    """Returns a map of the names include_decl() defines for decl.  It's built once
+       per declaration, since fn and fnall include the same ones over and over."""
+    values = getattr(decl, "scope_values", None)
+    if values is not None:
+        return values
+
+    values = {}
+    values["ret_type"] = decl.retType()
+    values["args"]     = decl.argNames()
+    values["nargs"]    = len(decl.argNames())
+    values["types"]    = decl.types()
+    values["formals"]  = decl.formals()
+    values["apply_to_type"] = TypeApplier(decl)
+    values["fn_id"]    = fn_id(decl.name)
+    values["bytes"]    = BytesMacro(decl)
+    values["comm_info"] = CommInfoMacro(decl)
 
     # These are old-stype, deprecated names.
     def get_arg(out, scope, args, children):
         return handle_list("args", decl.argNames(), args)
-    scope["get_arg"]     = get_arg
-    scope["applyToType"] = scope["apply_to_type"]
-    scope["retType"]     = scope["ret_type"]
-    scope["argList"]     = "(%s)" % ", ".join(scope["args"])
-    scope["argTypeList"] = "(%s)" % ", ".join(scope["formals"])
+    values["get_arg"]     = get_arg
+    values["applyToType"] = values["apply_to_type"]
+    values["retType"]     = values["ret_type"]
+    values["argList"]     = "(%s)" % ", ".join(values["args"])
+    values["argTypeList"] = "(%s)" % ", ".join(values["formals"])
+
+    decl.scope_values = values
+    return values
 
 def all_but(fn_list):
     """Return a list of all mpi functions except those in fn_list"""
@@ -905,39 +2752,262 @@ def all_but(fn_list):
     diff = all_mpi - set(fn_list)
     return [x for x in sorted(diff)]
 
+################################################################################
+# Parallel generation:
+#   fn, fnall, foreachfn, and forallfn expand their body once per MPI function,
+#   and each expansion is independent of the others.  With jobs > 1, the
+#   functions are split into contiguous blocks that forked worker processes
+#   expand, and the results are written out in the original order.  fn_num is
+#   the one piece of state shared between expansions: workers emit a placeholder
+#   for it, which is replaced with sequential numbers once the blocks are joined.
+################################################################################
+# Placeholder that workers emit for fn_num.
+fn_num_placeholder = "\0wrap.py:fn_num\0"
+
+# Work for forked worker processes: (render function, function names).
+parallel_job = None
+
+# True in worker processes.  Workers always expand bodies serially.
+in_worker = False
+
+def fork_pool(processes):
+    """Returns a multiprocessing pool with forked workers, which inherit the parsed
+       templates and mpi.h declarations.  Returns None where fork isn't available."""
+    try:
+        import multiprocessing
+        if hasattr(multiprocessing, "get_context"):
+            return multiprocessing.get_context("fork").Pool(processes, init_worker)
+        elif os.name == "posix":
+            return multiprocessing.Pool(processes, init_worker)
+    except (ImportError, ValueError, OSError):
+        pass
+    return None
+
+def init_worker():
+    global in_worker
+    in_worker = True
+
+def uses_macro(chunk, name):
+    """True if the macro called name is used anywhere in a chunk, its args, or its children."""
+    if chunk.macro == name:
+        return True
+    return any(isinstance(arg, Chunk) and uses_macro(arg, name) for arg in chunk.args) or \
+           any(uses_macro(child, name) for child in chunk.children)
+
+def can_parallelize(children):
+    """Bodies can be expanded in parallel unless they pass fn_num's value to
+       another macro, since placeholders can only stand in for printed values."""
+    for chunk in children:
+        if any(isinstance(arg, Chunk) and uses_macro(arg, "fn_num") for arg in chunk.args):
+            return False
+        if not can_parallelize(chunk.children):
+            return False
+    return True
+
+def render_block(bounds):
+    """Runs in a worker: renders the functions in fn_names[start:end].  Returns
+       a list with the output for each function, and the block's profile data
+       if profiling."""
+    global cur_function, profile
+    render, fn_names = parallel_job
+    start, end = bounds
+    if profile is not None:
+        profile = Profile()
+    texts = []
+    for fn_name in fn_names[start:end]:
+        cur_function = fn_name
+        out = StringIO()
+        render(out, fn_name)
+        texts.append(out.getvalue())
+    return texts, profile.data() if profile is not None else None
+
+def render_parallel(fn_names, render):
+    """Renders functions on a pool of jobs workers.  Returns a list with the output
+       for each function, or None if no pool could be created."""
+    global parallel_job
+    nblocks = min(len(fn_names), jobs * 4)
+    bounds = [(len(fn_names) * i // nblocks, len(fn_names) * (i + 1) // nblocks)
+              for i in range(nblocks)]
+
+    parallel_job = (render, fn_names)
+    fn_num.placeholder = True
+    try:
+        pool = fork_pool(min(jobs, nblocks))
+        if not pool:
+            return None
+        try:
+            texts = []
+            for block, data in pool.imap(render_block, bounds):
+                texts.extend(block)
+                if data is not None:
+                    profile.merge(data)
+        finally:
+            pool.terminate()
+    finally:
+        fn_num.placeholder = False
+        parallel_job = None
+
+    def number(match):
+        val = fn_num.val
+        fn_num.val += 1
+        return str(val)
+    placeholder = re.compile(re.escape(fn_num_placeholder))
+    return [placeholder.sub(number, text) for text in texts]
+
+def for_each_function(out, fn_names, children, render, sink=None):
+    """Calls render(out, fn_name) for each function in fn_names, in order, either
+       serially or on a pool of worker processes.  If sink is a list, the output
+       for each function is appended to it instead of being written to out."""
+    global cur_function
+    texts = None
+    if jobs > 1 and not in_worker and len(fn_names) > 1 and can_parallelize(children):
+        texts = render_parallel(fn_names, render)
+
+    if texts is None:
+        if sink is None and profile is None:
+            for fn_name in fn_names:
+                cur_function = fn_name
+                render(out, fn_name)
+            cur_function = None
+            return
+
+        texts = []
+        for fn_name in fn_names:
+            cur_function = fn_name
+            buffer = StringIO()
+            render(buffer, fn_name)
+            texts.append(buffer.getvalue())
+        cur_function = None
+
+    if profile is not None:
+        for fn_name, text in zip(fn_names, texts):
+            profile.add_bytes(profile.function_bytes, fn_name, len(text))
+    if sink is None:
+        out.write("".join(texts))
+    else:
+        sink.extend(texts)
+
+# Macros that fn and fnall bodies can use, and the support code they need, which is
+# written once before the first wrappers that use them.
+body_macro_support = [
+    ("fn_id",       ["fn_registry"]),
+    ("time_callfn", ["timing"]),
+    ("bytes",       ["type_sizes"]),
+    ("comm_info",   ["comm_info"]),
+    ("trace",       ["trace"]),
+    ("profile",     ["profile"]),
+]
+
+def write_body_support(out, children):
+    """Writes the support code needed by the macros used in a fn or fnall body."""
+    for macro_name, names in body_macro_support:
+        if any(uses_macro(chunk, macro_name) for chunk in children):
+            for name in names:
+                write_support(out, name)
+
+def check_functions(fn_names):
+    """Raises a syntax error if any name in fn_names is not an MPI function."""
+    global cur_function
+    for fn_name in fn_names:
+        cur_function = fn_name
+        if not fn_name in mpi_functions:
+            syntax_error(fn_name + " is not an MPI function")
+    cur_function = None
+
+def timed_callfn(decl, callfn):
+    """Returns a {{time_callfn}} macro for decl, which makes the call that callfn
+       makes and adds its time to this thread's timing for the function."""
+    def time_callfn(out, scope, args, children):
+        args and syntax_error("'time_callfn' macro takes no arguments.")
+        out.write("{\n")
+        out.write("    wrap_ticks_t wrap_start = wrap_ticks();\n")
+        if callable(callfn):
+            callfn(out, scope, args, children)
+        else:
+            out.write("    %s\n" % callfn)
+        out.write("    wrap_timing_add(%s, wrap_ticks() - wrap_start);\n" % fn_id(decl.name))
+        out.write("    }")
+    return time_callfn
+
+def traced_callfn(decl, callfn):
+    """Returns a {{trace}} macro for decl, which makes the call that callfn makes and
+       adds an event for it to this thread's trace buffer.  In MPI_Finalize, it writes
+       out the trace before the call instead."""
+    def trace(out, scope, args, children):
+        args and syntax_error("'trace' macro takes no arguments.")
+        if decl.name == "MPI_Finalize":
+            out.write("wrap_trace_finish();\n")
+            if callable(callfn):
+                callfn(out, scope, args, children)
+            else:
+                out.write("    %s" % callfn)
+            return
+        comm, peer = decl.commArg(), decl.peerArg()
+        out.write("{\n")
+        out.write("    wrap_ticks_t wrap_start = wrap_ticks();\n")
+        if callable(callfn):
+            callfn(out, scope, args, children)
+        else:
+            out.write("    %s\n" % callfn)
+        buffers = decl.bufferArgs()
+        if buffers:
+            buf, count, datatype = (arg.name for arg in buffers[0])
+            count = "%s == MPI_IN_PLACE ? 0 : %s" % (buf, count)
+            datatype = "%s == MPI_IN_PLACE ? MPI_DATATYPE_NULL : %s" % (buf, datatype)
+        else:
+            count, datatype = "0", "MPI_DATATYPE_NULL"
+        out.write("    wrap_trace_add(%s, wrap_start, wrap_ticks(), %s, %s,\n" % (
+            fn_id(decl.name), comm.name if comm else "MPI_COMM_NULL",
+            peer.name if peer else "MPI_PROC_NULL"))
+        out.write("                   %s, %s);\n" % (count, datatype))
+        out.write("    }")
+    return trace
+
+def profiled_callfn(decl, callfn):
+    """Returns a {{profile}} macro for decl, which times the call like {{time_callfn}}.
+       In MPI_Finalize, it writes out the profile of all processes before the call
+       instead."""
+    time_callfn = timed_callfn(decl, callfn)
+    def profile(out, scope, args, children):
+        args and syntax_error("'profile' macro takes no arguments.")
+        if decl.name != "MPI_Finalize":
+            return time_callfn(out, scope, args, children)
+        out.write("wrap_profile_write(NULL);\n")
+        if callable(callfn):
+            callfn(out, scope, args, children)
+        else:
+            out.write("    %s" % callfn)
+    return profile
+
 @macro("foreachfn", has_body=True)
 def foreachfn(out, scope, args, children):
     """Iterate over all functions listed in args."""
     args or syntax_error("Error: foreachfn requires function name argument.")
-    global cur_function
-
     fn_var = args[0]
-    for fn_name in args[1:]:
-        cur_function = fn_name
-        if not fn_name in mpi_functions:
-            syntax_error(fn_name + " is not an MPI function")
+    check_functions(args[1:])
+    body = Body(children)
+    write_body_support(out, children)
 
+    def render(out, fn_name):
         fn = mpi_functions[fn_name]
         fn_scope = Scope(scope)
         fn_scope[fn_var] = fn_name
         include_decl(fn_scope, fn)
 
-        for child in children:
-            child.evaluate(out, fn_scope)
-    cur_function = None
+        body.evaluate(out, fn_scope)
+
+    for_each_function(out, args[1:], children, render)
 
 @macro("fn", has_body=True)
 def fn(out, scope, args, children):
     """Iterate over listed functions and generate skeleton too."""
     args or syntax_error("Error: fn requires function name argument.")
-    global cur_function
-
     fn_var = args[0]
-    for fn_name in args[1:]:
-        cur_function = fn_name
-        if not fn_name in mpi_functions:
-            syntax_error(fn_name + " is not an MPI function")
+    check_functions(args[1:])
+    body = Body(children)
+    write_body_support(out, children)
 
+    def render(out, fn_name):
         fn = mpi_functions[fn_name]
         return_val = "_wrap_py_return_val"
 
@@ -982,17 +3052,23 @@ def fn(out, scope, args, children):
                 out.write("    }\n")
 
             fn_scope["callfn"] = callfn
+            fn_scope["time_callfn"] = timed_callfn(fn, callfn)
+            fn_scope["trace"] = traced_callfn(fn, callfn)
+            fn_scope["profile"] = profiled_callfn(fn, callfn)
 
-            def write_fortran_init_flag():
-                output.write("static int fortran_init = 0;\n")
-            once(write_fortran_init_flag)
+            if shard_globals is None:
+                def write_fortran_init_flag():
+                    write_global(out, "int", "fortran_init", "0")
+                once(write_fortran_init_flag)
 
         else:
             fn_scope["callfn"] = c_call
+            fn_scope["time_callfn"] = timed_callfn(fn, c_call)
+            fn_scope["trace"] = traced_callfn(fn, c_call)
+            fn_scope["profile"] = profiled_callfn(fn, c_call)
 
         def write_body(out):
-            for child in children:
-                child.evaluate(out, fn_scope)
+            body.evaluate(out, fn_scope)
 
         out.write("/* ================== C Wrappers for %s ================== */\n" % fn_name)
         write_c_wrapper(out, fn, return_val, write_body)
@@ -1000,7 +3076,10 @@ def fn(out, scope, args, children):
             out.write("/* =============== Fortran Wrappers for %s =============== */\n" % fn_name)
             write_fortran_wrappers(out, fn, return_val)
             out.write("/* ================= End Wrappers for %s ================= */\n\n\n" % fn_name)
-    cur_function = None
+
+    if shard_globals is not None and output_fortran_wrappers and "MPI_Init" in args[1:]:
+        write_global(out, "int", "fortran_init", "0")   # render() may run in a worker.
+    for_each_function(out, args[1:], children, render, wrapper_sink)
 
 @macro("forallfn", has_body=True)
 def forallfn(out, scope, args, children):
@@ -1014,6 +3093,16 @@ def fnall(out, scope, args, children):
     args or syntax_error("Error: fnall requires function name argument.")
     fn(out, scope, [args[0]] + all_but(args[1:]), children)
 
+# Compiled regexes for sub and filter, which run the same few regexes on every function.
+regexes = {}
+
+def compile_regex(regex):
+    """Returns the compiled form of regex, compiling it only the first time it's used."""
+    compiled = regexes.get(regex)
+    if compiled is None:
+        compiled = regexes[regex] = re.compile(regex)
+    return compiled
+
 @macro("sub")
 def sub(out, scope, args, children):
     """{{sub <string> <regexp> <substitution>}}
@@ -1022,11 +3111,11 @@ def sub(out, scope, args, children):
     len(args) == 3 or syntax_error("'sub' macro takes exactly 4 arguments.")
     string, regex, substitution = args
     if isinstance(string, list):
-        return [re.sub(regex, substitution, s) for s in string]
+        return [compile_regex(regex).sub(substitution, s) for s in string]
     if not isinstance(regex, str):
         syntax_error("Invalid regular expression in 'sub' macro: '%s'" % regex)
     else:
-        return re.sub(regex, substitution, string)
+        return compile_regex(regex).sub(substitution, string)
 
 @macro("zip")
 def zip_macro(out, scope, args, children):
@@ -1062,16 +3151,106 @@ def filter_macro(out, scope, args, children):
         syntax_error("Invalid list in 'filter' macro: '%s'" % str(list))
     if not isinstance(regex, str):
         syntax_error("Invalid regex in 'filter' macro: '%s'" % str(regex))
-    def match(s):
-        return re.search(regex, s)
-    return list(filter(match, l))
+    return list(filter(compile_regex(regex).search, l))
 
 @macro("fn_num")
 def fn_num(out, scope, args, children):
+    if fn_num.placeholder:
+        return fn_num_placeholder   # numbered after parallel expansion.  See render_parallel().
     val = fn_num.val
     fn_num.val += 1
     return val
 fn_num.val = 0  # init the counter here.
+fn_num.placeholder = False
+
+################################################################################
+# Function IDs:
+#   {{fn_id}} names a compile-time constant for the function being wrapped, from
+#   an enum of every function in mpi.h.  The enum and const tables of metadata
+#   indexed by it are written before the first fn, fnall, foreachfn, or forallfn
+#   whose body uses {{fn_id}}, or wherever {{fn_registry}} appears first.
+################################################################################
+# Categories of MPI functions, as (name, regex).  A function is in the category of
+# the first regex that matches its name, or in "other" if none does.
+fn_categories = [
+    ("error",      r"errhandler|^MPI_(Error_|Add_error_)"),
+    ("attribute",  r"^MPI_(Keyval_|Attr_)|_(create|free)_keyval$|_(get|set|delete)_attr$"),
+    ("info",       r"^MPI_Info_"),
+    ("io",         r"^MPI_(File_|Register_datarep)"),
+    ("one_sided",  r"^MPI_(Win_\w+|R?(put|get|accumulate|get_accumulate)|Fetch_and_op|Compare_and_swap)(_c)?$"),
+    ("collective", r"^MPI_I?(barrier|bcast|scatterv?|gatherv?|allgatherv?|alltoall[vw]?|reduce|allreduce|"
+                   r"reduce_scatter(_block)?|scan|exscan|neighbor_\w+?)(_init)?(_c)?$"),
+    ("p2p",        r"^MPI_(I?[bsr]?send|I?recv|I?sendrecv(_replace)?|I?m?probe|I?mrecv|[bsr]?send_init|recv_init|"
+                   r"buffer_(attach|detach)|p(send|recv)_init|pready\w*|parrived)(_c)?$"),
+    ("request",    r"^MPI_((wait|test)(all|any|some)?|start(all)?|cancel|test_cancelled|(g?request|status)_\w+)$"),
+    ("datatype",   r"^MPI_(type_\w+|(un)?pack\w*|address|get_(address|count|elements(_x)?)(_c)?)$"),
+    ("group",      r"^MPI_Group_"),
+    ("topology",   r"^MPI_(cart|graph|dist_graph|dims_create|topo_test)"),
+    ("comm",       r"^MPI_((Comm|Intercomm)_|(open|close)_port$|(lookup|publish|unpublish)_name$)"),
+    ("env",        r"^MPI_(init\w*|finalize\w*|abort|wtime|wtick|pcontrol|query_thread|is_thread_main|"
+                   r"get_(processor_name|version|library_version)|alloc_mem|free_mem|session_\w+)$"),
+]
+fn_category_res = [(name, re.compile(regex, re.I)) for name, regex in fn_categories]
+
+def fn_id(fn_name):
+    """Name of the enum constant that identifies an MPI function."""
+    return "WRAP_FN_%s" % fn_name
+
+def fn_category(fn_name):
+    """Name of the category an MPI function belongs to."""
+    for name, regex in fn_category_res:
+        if regex.search(fn_name):
+            return name
+    return "other"
+
+def write_fn_registry(out):
+    """Writes the enum of function IDs and the metadata tables indexed by them."""
+    fn_names = sorted(mpi_functions)
+    decls = [mpi_functions[name] for name in fn_names]
+    categories = [name for name, regex in fn_categories] + ["other"]
+
+    def write_table(type, name, values):
+        out.write("static WRAP_UNUSED const %s %s[WRAP_FN_COUNT] = {\n" % (type, name))
+        out.write(",\n".join("    %s" % value for value in values))
+        out.write("\n};\n\n")
+
+    out.write("/* IDs of the MPI functions in mpi.h.  Index the wrap_fn_ tables with them. */\n")
+    out.write("enum wrap_fn_id {\n")
+    out.write("".join("    %s,\n" % fn_id(name) for name in fn_names))
+    out.write("    WRAP_FN_COUNT\n};\n\n")
+
+    out.write("enum wrap_fn_category {\n")
+    out.write("".join("    WRAP_CAT_%s,\n" % category.upper() for category in categories))
+    out.write("    WRAP_CAT_COUNT\n};\n\n")
+    out.write("static WRAP_UNUSED const char *const wrap_fn_category_names[WRAP_CAT_COUNT] = {\n")
+    out.write(",\n".join('    "%s"' % category for category in categories))
+    out.write("\n};\n\n")
+
+    write_table("char *const", "wrap_fn_names", ['"%s"' % name for name in fn_names])
+    write_table("char *const", "wrap_fn_ret_types", ['"%s"' % decl.retType() for decl in decls])
+    write_table("unsigned char", "wrap_fn_nargs", [str(len(decl.argNames())) for decl in decls])
+    write_table("unsigned char", "wrap_fn_categories",
+                ["WRAP_CAT_%s" % fn_category(name).upper() for name in fn_names])
+
+@macro("fn_registry")
+def fn_registry(out, scope, args, children):
+    """{{fn_registry}}
+       Writes the enum of function IDs and their metadata tables here, if they
+       haven't been written yet.
+    """
+    args and syntax_error("'fn_registry' macro takes no arguments.")
+    write_support(out, "fn_registry")
+
+@macro("sample_weight")
+def sample_weight(out, scope, args, children):
+    """{{sample_weight}}
+       Number of calls the current call stands for: wrap_sample_weight when
+       sampling, otherwise 1.
+    """
+    args and syntax_error("'sample_weight' macro takes no arguments.")
+    return "wrap_sample_weight" if sampling() else "1"
+
+support_code["fn_registry"] = (["attributes"], write_fn_registry)
 
 
 ################################################################################
@@ -1084,11 +3263,12 @@ class Chunk:
        or a macro chunk with children to which the macro should be applied.
        macros are evaluated lazily, so the macro is just a string until
        execute is called and it is fetched from its enclosing scope."""
-    def __init__(self):
+    def __init__(self, line=0):
         self.macro    = None
         self.args     = []
         self.text     = None
         self.children = []
+        self.line     = line   # line in the wrapper file where the chunk starts
 
     def iwrite(self, file, level, text):
         """Write indented text."""
@@ -1105,98 +3285,263 @@ class Chunk:
     def execute(self, out, scope):
         """This function executes a chunk.  For strings, lists, text chunks, etc., this just
            entails returning the chunk's value.  For callable macros, this executes and returns
-           the chunk's value.
+           the chunk's value.  The first call compiles the chunk (see compile()); after that,
+           the compiled function is called directly.
+        """
+        self.compile()
+        return self.execute(out, scope)
+
+    def evaluate(self, out, scope):
+        """This is an 'interactive' version of execute.  This should be called when
+           the chunk's value (if any) should be written out.  Body macros and the outermost
+           scope should use this instead of execute().
         """
+        self.compile()
+        return self.evaluate(out, scope)
+
+    def compile(self):
+        """Compiles this chunk into functions specialized for its contents, and installs them
+           as this chunk's execute() and evaluate().  Work that doesn't depend on the scope is
+           done here, once, instead of every time the chunk runs: args that are plain strings
+           are put in a list up front, arg chunks are compiled, and macros that nothing in the
+           file can redefine are looked up ahead of time (see Body.static_macros()).  The
+           compiled functions behave just like the interpreted ones did, errors included.
+           A chunk compiled against different static_macros is compiled again, so that it
+           never calls macros from a table that has since been replaced.
+        """
+        if "execute" in self.__dict__:
+            if self.bound_macros == static_macros:
+                return   # already compiled
+            self.uncompile()
+        self.bound_macros = static_macros
         if not self.macro:
-            out.write(self.text)
-        else:
-            if not self.macro in scope:
-                error_msg = "Invalid macro: '%s'" % self.macro
-                if scope.function_name:
-                    error_msg += " for " + scope.function_name
-                syntax_error(error_msg)
-
-            value = scope[self.macro]
-            if hasattr(value, "__call__"):
+            text = self.text
+            def execute(out, scope):
+                out.write(text)
+            self.execute = self.evaluate = execute
+            return
+
+        name     = self.macro
+        line     = self.line
+        children = self.children
+        if not isinstance(children, Body):
+            children = Body(children)
+        raw_args = self.args
+
+        args = list(raw_args)
+        arg_chunks = [(i, arg) for i, arg in enumerate(raw_args) if isinstance(arg, Chunk)]
+
+        def call(out, scope, value):
+            """Runs a macro value the way the interpreter does."""
+            global cur_line
+            if callable(value):
                 # It's a macro, so we need to execute it.  But first evaluate its args.
-                def eval_arg(arg):
-                    if isinstance(arg, Chunk):
-                        return arg.execute(out, scope)
-                    else:
-                        return arg
-                args = [eval_arg(arg) for arg in self.args]
-                return value(out, scope, args, self.children)
+                if arg_chunks:
+                    call_args = list(args)
+                    for i, arg in arg_chunks:
+                        call_args[i] = arg.execute(out, scope)
+                    cur_line = line
+                else:
+                    call_args = args
+                return value(out, scope, call_args, children)
             elif isinstance(value, list):
                 # Special case for handling lists and list indexing
-                return handle_list(self.macro, value, self.args)
+                return handle_list(name, value, raw_args)
             else:
                 # Just return the value of anything else
                 return value
 
-    def stringify(self, value):
-        """Used by evaluate() to print the return values of chunks out to the output file."""
-        if isinstance(value, list):
-            return ", ".join(value)
+        def invalid_macro(scope):
+            error_msg = "Invalid macro: '%s'" % name
+            if scope.function_name:
+                error_msg += " for " + scope.function_name
+            syntax_error(error_msg)
+
+        static = name in static_macros and static_macros[name]
+        if static and not arg_chunks:
+            def execute(out, scope):
+                global cur_line
+                cur_line = line
+                return static(out, scope, args, children)
+        elif static:
+            def execute(out, scope):
+                global cur_line
+                cur_line = line
+                return call(out, scope, static)
         else:
-            return str(value)
+            def execute(out, scope):
+                global cur_line
+                cur_line = line
+                # Scope.lookup(), inlined since this is the generator's hot loop.
+                enclosing = scope
+                while enclosing is not None:
+                    map = enclosing.map
+                    if name in map:
+                        value = map[name]
+                        if value.__class__ is str:
+                            return value
+                        return call(out, scope, value)
+                    enclosing = enclosing.enclosing_scope
+                invalid_macro(scope)
+
+        def evaluate(out, scope):
+            value = execute(out, scope)
+            if value is not None:  # Note the distinction here -- 0 is false but we want to print it!
+                if value.__class__ is str:
+                    out.write(value)
+                else:
+                    out.write(stringify(value))
+
+        self.execute  = execute
+        self.evaluate = evaluate
+
+    def uncompile(self):
+        """Removes what compile() installed in this chunk and the chunks in it, so that
+           they're compiled again the next time they run."""
+        for name in ("execute", "evaluate", "bound_macros"):
+            self.__dict__.pop(name, None)
+        for arg in self.args:
+            if isinstance(arg, Chunk):
+                arg.uncompile()
+        if isinstance(self.children, Body):
+            self.children.__dict__.pop("evaluate", None)
+        for child in self.children:
+            child.uncompile()
 
+def stringify(value):
+    """Used by evaluate() to print the return values of chunks out to the output file."""
+    if isinstance(value, list):
+        return ", ".join(value)
+    else:
+        return str(value)
+
+# Macros that chunks can be bound to when they're compiled, instead of looking them up in
+# their scope every time they run.  Set by evaluate_files() for each file; see static_bindings().
+static_macros = {}
+
+# Names that fn and foreachfn define in each function's scope.
+function_scope_names = set(["ret_type", "args", "nargs", "types", "formals", "apply_to_type",
+                            "get_arg", "applyToType", "retType", "argList", "argTypeList",
+                            "ret_val", "returnVal", "callfn", "fileno"])
+
+def assigned_names(chunks):
+    """Returns the set of names that chunks could define in a scope: variables of
+       body macros and names passed to def.  Returns None if a name is computed by
+       a macro, since then it can't be known until the chunk runs."""
+    names = set()
+    for chunk in chunks:
+        if not chunk.macro:
+            continue
+        if chunk.macro == "def" or getattr(macros.get(chunk.macro), "has_body", False):
+            if chunk.args and isinstance(chunk.args[0], Chunk):
+                return None
+            names.update(chunk.args[:1])
+        inner = assigned_names([arg for arg in chunk.args if isinstance(arg, Chunk)] + chunk.children)
+        if inner is None:
+            return None
+        names |= inner
+    return names
+
+def static_bindings(chunks, macros=macros):
+    """Returns the global macros that nothing in chunks can redefine, so their chunks
+       can call them directly.  macros is the table the chunks' outer scope has."""
+    assigned = assigned_names(chunks)
+    if assigned is None:
+        return {}
+    return dict((name, value) for name, value in macros.items()
+                if not name in assigned and not name in function_scope_names)
+
+class Body(list):
+    """A list of Chunks: the body of a body macro.  Body macros can evaluate their
+       children one by one, or call evaluate() to run them all at once, which is
+       faster: the chunks are compiled on the first call, and adjacent text is
+       joined and written in one piece.
+    """
     def evaluate(self, out, scope):
-        """This is an 'interactive' version of execute.  This should be called when
-           the chunk's value (if any) should be written out.  Body macros and the outermost
-           scope should use this instead of execute().
-        """
-        value = self.execute(out, scope)
-        if value is not None:  # Note the distinction here -- 0 is false but we want to print it!
-            out.write(self.stringify(value))
+        """Evaluates all the chunks in this body in scope."""
+        chunks = []
+        for chunk in self:
+            if not chunk.macro and chunks and not chunks[-1].macro:
+                joined = Chunk(chunks[-1].line)
+                joined.text = chunks[-1].text + chunk.text
+                chunks[-1] = joined
+            else:
+                chunks.append(chunk)
+        for chunk in chunks:
+            chunk.compile()
+        functions = [chunk.evaluate for chunk in chunks]
+
+        if len(functions) == 1:
+            self.evaluate = functions[0]
+        else:
+            def evaluate(out, scope):
+                for function in functions:
+                    function(out, scope)
+            self.evaluate = evaluate
+        self.evaluate(out, scope)
 
 class Parser:
     """Parser for the really simple wrappergen grammar.
-       This parser has support for multiple lexers.  self.tokens is a list of iterables, each
-       representing a new token stream.  You can add additional tokens to be lexed using push_tokens.
-       This will cause the pushed tokens to be handled before any others.  This allows us to switch
-       lexers while parsing, so that the outer part of the file is processed in a language-agnostic
-       way, but stuff inside macros is handled as its own macro language.
+       This parser has support for multiple lexers.  self.streams is a stack of token lists, with
+       the list currently being read on top.  You can add additional tokens to be lexed using
+       push_tokens.  This will cause the pushed tokens to be handled before any others.  This allows
+       us to switch lexers while parsing, so that the outer part of the file is processed in a
+       language-agnostic way, but stuff inside macros is handled as its own macro language.
+       Lists are popped once they're read, so getting a token is constant time however much
+       has been pushed, and parsing takes time linear in the size of the input.
     """
     def __init__(self, macros):
         self.macros = macros
         self.macro_lexer = InnerLexer()
-        self.tokens = iter([]) # iterators over tokens, handled in order.  Starts empty.
+        self.streams = []      # stack of [token list, index of next token in list]
         self.token = None      # last accepted token
         self.next = None       # next token
 
     def gettok(self):
         """Puts the next token in the input stream into self.next."""
-        try:
-            self.next = next(self.tokens)
-        except StopIteration:
-            self.next = None
-
-    def push_tokens(self, iterable):
-        """Adds all tokens in some iterable to the token stream."""
-        self.tokens = itertools.chain(iter(iterable), iter([self.next]), self.tokens)
+        streams = self.streams
+        while streams:
+            stream = streams[-1]
+            tokens, index = stream
+            if index < len(tokens):
+                stream[1] = index + 1
+                self.next = tokens[index]
+                return
+            streams.pop()
+        self.next = None
+
+    def push_tokens(self, tokens):
+        """Adds a list of tokens to the front of the token stream."""
+        if self.next:
+            self.streams.append([[self.next], 0])
+        self.streams.append([tokens, 0])
         self.gettok()
 
     def accept(self, id):
         """Puts the next symbol in self.token if we like it.  Then calls gettok()"""
-        if self.next.isa(id):
+        if self.next and self.next.isa(id):
             self.token = self.next
             self.gettok()
             return True
         return False
 
+    def error(self, msg):
+        """Reports a syntax error at the current position in the input."""
+        global cur_line
+        cur_line = (self.next or self.token).line
+        syntax_error(msg)
+
     def unexpected_token(self):
-        syntax_error("Unexpected token: %s." % self.next)
+        self.error("Unexpected token: %s." % self.next)
 
     def expect(self, id):
         """Like accept(), but fails if we don't like the next token."""
         if self.accept(id):
             return True
+        elif self.next:
+            self.unexpected_token()
         else:
-            if self.next:
-                self.unexpected_token()
-            else:
-                syntax_error("Unexpected end of file.")
-            sys.exit(1)
+            self.error("Unexpected end of file.")
 
     def is_body_macro(self, name):
         """Shorthand for testing whether a particular name is the name of a macro that has a body.
@@ -1204,19 +3549,23 @@ class Parser:
         """
         return name in self.macros and self.macros[name].has_body
 
+    def push_macro_text(self):
+        """Lexes text inside a macro as wrapper language, and reads its tokens next."""
+        self.push_tokens(timed("lex", self.macro_lexer.lex, self.token.value, self.token.line))
+
     def macro(self, accept_body_macros=True):
+        chunk = Chunk(self.token.line)
+
         # lex inner-macro text as wrapper language if we encounter text here.
         if self.accept(TEXT):
-            self.push_tokens(self.macro_lexer.lex(self.token.value))
+            self.push_macro_text()
 
         # Now proceed with parsing the macro language's tokens
-        chunk = Chunk()
         self.expect(IDENTIFIER)
         chunk.macro = self.token.value
 
         if not accept_body_macros and self.is_body_macro(chunk.macro):
-            syntax_error("Cannot use body macros in expression context: '%s'" % chunk.macro)
-            eys.exit(1)
+            self.error("Cannot use body macros in expression context: '%s'" % chunk.macro)
 
         while True:
             if self.accept(LBRACE):
@@ -1224,7 +3573,7 @@ class Parser:
             elif self.accept(IDENTIFIER):
                 chunk.args.append(self.token.value)
             elif self.accept(TEXT):
-                self.push_tokens(self.macro_lexer.lex(self.token.value))
+                self.push_macro_text()
             else:
                 self.expect(RBRACE)
                 break
@@ -1234,7 +3583,7 @@ class Parser:
         chunks = []
         while self.next:
             if self.accept(TEXT):
-                chunk = Chunk()
+                chunk = Chunk(self.token.line)
                 chunk.text = self.token.value
                 chunks.append(chunk)
             elif self.accept(LBRACE):
@@ -1254,108 +3603,704 @@ class Parser:
             else:
                 self.unexpected_token()
 
-        return chunks
+        return Body(chunks)
 
     def parse(self, text):
         if skip_headers:
             outer_lexer = OuterRegionLexer()   # Not generating C code, text is text.
         else:
             outer_lexer = OuterCommentLexer()  # C code. Considers C-style comments.
-        self.push_tokens(outer_lexer.lex(text))
+        self.push_tokens(timed("lex", outer_lexer.lex, text))
         return self.text()
 
 ################################################################################
-# Main script:
-#   Get arguments, set up outer scope, parse files, generator wrappers.
+# Template cache:
+#   Tools often include large wrapper files that rarely change.  Parsed chunk trees
+#   are cached on disk with the declarations, one entry per wrapper file, so
+#   unchanged files aren't re-parsed.  Each entry records a digest of the text it
+#   was parsed from, and anything else that changes how it parses, and is
+#   overwritten when the file changes, so the cache doesn't grow with every edit.
 ################################################################################
-def usage():
-    sys.stderr.write(usage_string)
-    sys.exit(2)
+# Version of the cached chunk tree format.  Bump this when the parser changes.
+template_cache_version = 2
+
+def template_cache_file(wrapper_filename):
+    """Path of the cache entry for the wrapper file wrapper_filename."""
+    path = os.path.realpath(wrapper_filename)
+    digest = hashlib.sha1(path.encode("utf-8"))
+    return os.path.join(cache_dir or default_cache_dir(), "ast-%s.json" % digest.hexdigest())
+
+def template_digest(text):
+    """Digest of text that a cache entry for it must match.  Besides the text, it
+       covers the lexer (-s) and which macros have bodies."""
+    key = [template_cache_version, skip_headers,
+           sorted(name for name in macros if macros[name].has_body)]
+    digest = hashlib.sha1(json.dumps(key).encode())
+    digest.update(text if isinstance(text, bytes) else text.encode("utf-8"))
+    return digest.hexdigest()
+
+def chunk_to_json(chunk):
+    """Converts a chunk to lists that can be stored as JSON.  Text chunks are
+       [line, text]; macro chunks are [line, macro, args, children]."""
+    if chunk.macro is None:
+        return [chunk.line, chunk.text]
+    args = [chunk_to_json(arg) if isinstance(arg, Chunk) else arg for arg in chunk.args]
+    return [chunk.line, chunk.macro, args, [chunk_to_json(child) for child in chunk.children]]
+
+def chunk_from_json(data):
+    """Inverse of chunk_to_json()."""
+    chunk = Chunk(data[0])
+    if len(data) == 2:
+        chunk.text = data[1]
+    else:
+        chunk.macro = data[1]
+        chunk.args = [chunk_from_json(arg) if isinstance(arg, list) else arg for arg in data[2]]
+        chunk.children = Body(chunk_from_json(child) for child in data[3])
+    return chunk
+
+def read_template_cache(filename, digest):
+    """Returns the Body of chunks cached in filename, or None if there is no
+       valid entry there for text with the given template_digest()."""
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+        if data["version"] == template_cache_version and data["digest"] == digest:
+            return Body(chunk_from_json(chunk) for chunk in data["chunks"])
+    except (IOError, OSError, ValueError, KeyError, IndexError, TypeError):
+        pass
+    return None
+
+def parse_wrapper(text, wrapper_filename):
+    """Parses text, read from wrapper_filename, into a Body of chunks.  Uses the
+       template cache unless caching is disabled."""
+    if not use_cache:
+        return timed("parse", Parser(macros).parse, text)
+
+    filename = template_cache_file(wrapper_filename)
+    digest = template_digest(text)
+    chunks = timed("read_template_cache", read_template_cache, filename, digest)
+    if profile is not None:
+        profile.count_cache("templates", chunks is not None)
+    if chunks is not None:
+        return chunks
 
-# Let the user specify another mpicc to get mpi.h from
-output = sys.stdout
-output_filename = None
+    chunks = timed("parse", Parser(macros).parse, text)
+    write_cache_file(filename, {"version" : template_cache_version,
+                                "digest"  : digest,
+                                "chunks"  : [chunk_to_json(chunk) for chunk in chunks]})
+    return chunks
 
-try:
-    opts, args = getopt.gnu_getopt(sys.argv[1:], "fsgdwc:o:i:I:")
-except getopt.GetoptError as err:
-    sys.stderr.write(err + "\n")
-    usage()
-
-for opt, arg in opts:
-    if opt == "-d": dump_prototypes = True
-    if opt == "-f": output_fortran_wrappers = True
-    if opt == "-s": skip_headers = True
-    if opt == "-g": output_guards = True
-    if opt == "-w": ignore_deprecated = True
-    if opt == "-c": mpicc = arg
-    if opt == "-o": output_filename = arg
-    if opt == "-I":
-        stripped = arg.strip()
-        if stripped: includes.append(stripped)
-    if opt == "-i":
-        if not arg in pmpi_init_bindings:
-            sys.stderr.write("ERROR: PMPI_Init binding must be one of:\n    %s\n" % " ".join(possible_bindings))
-            usage()
-        else:
-            pmpi_init_binding = arg
+################################################################################
+# Sharded output:
+#   One file with wrappers for every MPI function (plus Fortran bindings) is slow
+#   to compile, since it builds on one core.  With shards > 1, each function's
+#   wrappers go into one of several translation units that can be compiled in
+#   parallel.  Everything else -- front matter, text outside of fn/fnall, and
+#   forallfn/foreachfn output -- goes in a header that every shard includes.
+#   File-global variables are defined once, in the first shard, and declared
+#   extern in the header.
+################################################################################
+# When generating shards, fn and fnall append each function's wrappers here.
+wrapper_sink = None
+
+# When generating shards, (type, name, value) of the globals generated code needs.
+shard_globals = None
+
+# Single-line definitions of file-scope static variables in text outside of
+# wrappers, e.g. "static MPI_Comm world48;" or "static double times[4] = {0};".
+# Groups are: type, name, array dimensions, and initializer.
+static_global_re = re.compile(
+    r"^static[ \t]+([^;=(){},\n]*?[\s*])(\w+)((?:[ \t]*\[[^\]\n]*\])*)"
+    r"[ \t]*(?:=[ \t]*([^;\n]*?))?[ \t]*;[ \t]*$", re.M)
+
+def write_global(out, type, name, value):
+    """Writes the definition of a file-global variable for generated code.  When
+       generating shards, it writes an extern declaration instead, and records the
+       global in shard_globals to be defined in the first shard."""
+    if shard_globals is None:
+        out.write("static %s %s = %s;\n" % (type, name, value))
+    elif not any(g[1] == name for g in shard_globals):
+        shard_globals.append((type, name, value))
+        out.write("extern %s %s;\n" % (type, name))
+
+def shard_filenames(output_filename):
+    """Returns the name of the common header and a list of shard file names for
+       sharded output to output_filename.  out.c has header out.h, and shards
+       out.c, out_1.c, ..., out_<shards-1>.c."""
+    stem, ext = os.path.splitext(output_filename)
+    return stem + ".h", [output_filename] + ["%s_%d%s" % (stem, i, ext) for i in range(1, shards)]
+
+def partition(texts, n):
+    """Splits texts into n contiguous groups of roughly equal total length."""
+    total = sum(len(t) for t in texts)
+    groups = [[] for i in range(n)]
+    size = 0
+    for text in texts:
+        groups[min(n - 1, size * n // max(total, 1))].append(text)
+        size += len(text)
+    return groups
+
+def assemble_shards(header_filename, shard_files, common, wrappers, globals):
+    """Builds the header and shard files from the common text, the list of
+       per-function wrappers, and the file-global variables."""
+    # Statics in the common text become extern declarations, defined in shard 0.
+    definitions = ["%s %s = %s;" % g for g in globals]
+    def externalize(match):
+        type, name, dims, value = match.groups()
+        if re.search(r"\bconst\b", type):
+            return match.group(0)    # Constants can stay static in every shard.
+        decl = "%s%s%s" % (type, name, dims)
+        definitions.append("%s = %s;" % (decl, value) if value else "%s;" % decl)
+        return "extern %s;" % decl
+    common = static_global_re.sub(externalize, common)
+
+    guard = "WRAP_PY_%s" % re.sub(r"\W", "_", os.path.basename(header_filename)).upper()
+    header = "#ifndef %s\n#define %s\n" % (guard, guard)
+    header += common
+    header += "\n#endif /* %s */\n" % guard
+
+    include = '#include "%s"\n\n' % os.path.basename(header_filename)
+    files = [(header_filename, header)]
+    for i, (filename, group) in enumerate(zip(shard_files, partition(wrappers, len(shard_files)))):
+        text = include
+        if i == 0:
+            text += joinlines(definitions) + "\n"
+        files.append((filename, text + "".join(group)))
+    return files
+
+################################################################################
+# Generator API:
+#   wrap.py can be imported and used as a library.  configure() sets the same
+#   options the command line does, and generate() turns wrapper files into code.
+#   mpi.h is parsed once per process and reused by later calls to generate().
+################################################################################
+# Names of module-level options that can be set with configure() or generate().
+option_names = ["mpicc", "includes", "pmpi_init_binding", "output_fortran_wrappers", "fortran_aliases",
+                "output_guards", "thread_local_guards", "skip_headers", "ignore_deprecated", "use_cache", "cache_dir",
+                "jobs", "shards", "sample_period", "sample_interval",
+                "runtime_enable"]
+
+# Compiler and include path that mpi_functions was last loaded with.
+mpi_functions_key = None
+
+def configure(**options):
+    """Sets generator options.  Keywords are the names in option_names, e.g.:
+           configure(output_fortran_wrappers=True, includes=["/opt/mpi/include"])
+       Options keep their values for later calls to generate().
+    """
+    for name in options:
+        if not name in option_names:
+            raise TypeError("Unknown wrap.py option: '%s'" % name)
+    globals().update(options)
+
+def load_mpi_functions():
+    """Fills mpi_functions with the declarations in mpi.h.  Does nothing if they
+       were already loaded with the current mpicc and includes."""
+    global mpi_functions_key
+    key = (mpicc, tuple(includes))
+    if key == mpi_functions_key:
+        return
 
-if len(args) < 1 and not dump_prototypes:
-    usage()
+    mpi_functions.clear()
+    mpi_headers.clear()
+    for decl in load_mpi_declarations(mpicc, includes, mpi_headers):
+        mpi_functions[decl.name] = decl
 
-# Parse mpi.h and put declarations into a map.
-for decl in enumerate_mpi_declarations(mpicc, includes):
-    mpi_functions[decl.name] = decl
-    if dump_prototypes: print(decl)
+    # Fail gracefully if we didn't find anything.
+    if not mpi_functions:
+        sys.stderr.write("Error: Found no declarations in mpi.h.\n")
+        sys.exit(1)
+    mpi_functions_key = key
 
-# Fail gracefully if we didn't find anything.
-if not mpi_functions:
-    sys.stderr.write("Error: Found no declarations in mpi.h.\n")
-    sys.exit(1)
+def start_generation():
+    """Resets state that lives for one run of the generator."""
+    global cur_function
+    fn_num.val = 0
+    cur_function = None
+    written_support.clear()
 
-# If we're just dumping prototypes, we can just exit here.
-if dump_prototypes: sys.exit(0)
+# Names of the support_code that has been written to the current output.
+written_support = set()
 
-# Open the output file here if it was specified
-if output_filename:
-    try:
-        output = open(output_filename, "w")
-    except IOError:
-        sys.stderr.write("Error: couldn't open file " + arg + " for writing.\n")
-        sys.exit(1)
+def write_support(out, name):
+    """Writes support_code[name], after the code it needs, unless it has already
+       been written to the current output."""
+    if name in written_support:
+        return
+    written_support.add(name)
+    requires, code = support_code[name]
+    for required in requires:
+        write_support(out, required)
+    if callable(code):
+        code(out)
+    else:
+        out.write(code)
 
-try:
-    # Start with some headers and definitions.
+def write_front_matter(out):
+    """Writes the includes, definitions, and globals that generated C code needs."""
     if not skip_headers:
-        output.write(wrapper_includes)
-        if output_guards: output.write("static int in_wrapper = 0;\n")
+        out.write(wrapper_includes)
+        if output_guards and thread_local_guards:
+            write_support(out, "thread_local")
+            write_global(out, "WRAP_THREAD_LOCAL int", "in_wrapper", "0")
+        elif output_guards:
+            write_global(out, "int", "in_wrapper", "0")
+        if output_fortran_wrappers:
+            write_support(out, "fortran_scratch")
+            write_support(out, "fortran_status")
+            if fortran_aliases:
+                write_support(out, "fortran_alias")
+        if sampling():
+            write_support(out, "sampling")
+        if runtime_enable:
+            write_support(out, "enable")
 
     # Print the macros for disabling MPI function deprecation warnings.
     if ignore_deprecated:
-        output.write(wrapper_diagnosics_macros)
+        out.write(wrapper_diagnosics_macros)
+
+# Map from wrapper file name to ((text, skip_headers), chunks) for the last text
+# parsed from it.  Runs that read a file again, e.g. in --watch mode, reuse them.
+parsed_files = {}
 
-    # Parse each file listed on the command line and execute
-    # it once it's parsed.
-    fileno = 0
-    for f in args:
-        cur_filename = f
-        file = open(cur_filename)
+def evaluate_files(out, wrapper_files):
+    """Parses each wrapper file and executes it once it's parsed."""
+    global cur_filename, static_macros
+    for fileno, filename in enumerate(wrapper_files):
+        cur_filename = filename
+        with open(filename) as file:
+            text = file.read()
 
         # Outer scope contains fileno and the fundamental macros.
+        file_macros = macros if profile is None else profile.wrap_macros(macros)
         outer_scope = Scope()
         outer_scope["fileno"] = str(fileno)
-        outer_scope.include(macros)
+        outer_scope.include(file_macros)
+
+        # Reuse the chunks parsed the last time this file was read, if it's the same.
+        key = (text, skip_headers)
+        parsed = parsed_files.get(filename)
+        reused = parsed is not None and parsed[0] == key
+        if reused:
+            chunks = parsed[1]
+        else:
+            chunks = parse_wrapper(text, filename)
+            parsed_files[filename] = (key, chunks)
+        static_macros = static_bindings(chunks, file_macros)
+        if reused:
+            # They were compiled against the last run's macros, which may be wrappers
+            # for another Profile; compile() rebinds them if the macros have changed.
+            for chunk in chunks:
+                chunk.compile()
+
+        if profile is None:
+            for chunk in chunks:
+                chunk.evaluate(out, Scope(outer_scope))
+        else:
+            # Count what this file writes, including wrappers that go to shards.
+            counter = CountingWriter(out)
+            sunk = len(wrapper_sink or [])
+            for chunk in chunks:
+                profile.time("evaluate", chunk.evaluate, counter, Scope(outer_scope))
+            size = counter.size + sum(len(text) for text in (wrapper_sink or [])[sunk:])
+            profile.add_bytes(profile.file_bytes, filename, size)
+
+def generate(wrapper_files, output=None, **options):
+    """Generates wrappers for a list of wrapper file names, as one run of wrap.py
+       on the command line would.  Any keyword arguments are passed to configure().
+       Writes to output if it is given, otherwise returns the generated code as a
+       string.  Raises WrapSyntaxError if a wrapper file has errors.
+    """
+    configure(**options)
+    load_mpi_functions()
+    start_generation()
+
+    out = output
+    if out is None:
+        out = StringIO()
+    write_front_matter(out)
+    evaluate_files(out, wrapper_files)
+
+    if output is None:
+        return out.getvalue()
+
+def generate_shards(wrapper_files, output_filename, **options):
+    """Generates wrappers split across shards translation units, with a common
+       header.  Keyword arguments are passed to configure().  Returns a list of
+       (file name, code) pairs: the header, then the shards in order.  See
+       shard_filenames() for how the files are named.
+    """
+    global wrapper_sink, shard_globals
+    configure(**options)
+    load_mpi_functions()
+    start_generation()
 
-        parser = Parser(macros)
-        chunks = parser.parse(file.read())
+    common = StringIO()
+    wrapper_sink, shard_globals = [], []
+    try:
+        write_front_matter(common)
+        evaluate_files(common, wrapper_files)
+        wrappers, globals = wrapper_sink, shard_globals
+    finally:
+        wrapper_sink, shard_globals = None, None
+
+    header_filename, shard_files = shard_filenames(output_filename)
+    return assemble_shards(header_filename, shard_files, common.getvalue(), wrappers, globals)
+
+def write_output(output_filename, text):
+    """Writes generated code to a file.  If the file already has exactly this
+       text, only its timestamp is updated: it's newer than whatever made the
+       build tool run wrap.py, so the tool doesn't run it again, and tools that
+       check whether outputs changed (like Ninja) still skip the recompile.
+       Otherwise the text is written to a temp file that is renamed into place,
+       so other processes never see a partial file."""
+    try:
+        with open(output_filename) as output:
+            unchanged = output.read() == text
+    except (IOError, OSError, ValueError):
+        unchanged = False
+    if unchanged:
+        try:
+            os.utime(output_filename, None)
+            return
+        except OSError:
+            pass
 
-        for chunk in chunks:
-            chunk.evaluate(output, Scope(outer_scope))
-        fileno += 1
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_filename)),
+                                       prefix=".wrap-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as output:
+                output.write(text)
+            os.chmod(tmpname, output_mode(output_filename))
+            getattr(os, "replace", os.rename)(tmpname, output_filename)
+        except:
+            os.remove(tmpname)
+            raise
+    except (IOError, OSError):
+        sys.stderr.write("Error: couldn't open file " + output_filename + " for writing.\n")
+        sys.exit(1)
+
+def output_mode(output_filename):
+    """Permissions for a new version of output_filename: the same as the old one,
+       or what open() would use for a new file."""
+    try:
+        return os.stat(output_filename).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def output_files(output_filename):
+    """List of files that generate_file() writes for output_filename."""
+    if shards > 1:
+        header_filename, shard_files = shard_filenames(output_filename)
+        return shard_files + [header_filename]
+    return [output_filename]
+
+def make_escape(path):
+    """Escapes a path for use in a Makefile rule."""
+    return re.sub(r"([ #])", r"\\\1", path).replace("$", "$$")
+
+def write_depfile(depfile, rules):
+    """Writes a Makefile-style dependency file, like a C compiler's -MF.  rules
+       is a list of (output, [wrapper files]).  Each output (and all of its
+       shards) depends on its wrapper files, mpi.h, and every header that mpi.h
+       includes, so build tools rerun wrap.py exactly when one of them changes."""
+    headers = sorted(mpi_headers)
+    text = ""
+    for output_filename, wrapper_files in rules:
+        targets = " ".join(make_escape(f) for f in output_files(output_filename))
+        deps = [make_escape(f) for f in list(wrapper_files) + headers]
+        text += targets + ":" + "".join(" \\\n  " + dep for dep in deps) + "\n"
+    write_output(depfile, text)
+
+def generate_file(wrapper_files, output_filename):
+    """Generates wrappers into the file output_filename (or into its shards, if
+       shards > 1).  If there is a syntax error, the output and its header and
+       shards are removed so that builds don't pick up stale wrappers, and
+       WrapSyntaxError is re-raised."""
+    try:
+        if shards > 1:
+            files = generate_shards(wrapper_files, output_filename)
+        else:
+            files = [(output_filename, generate(wrapper_files))]
+    except WrapSyntaxError:
+        if shards > 1:
+            header_filename, shard_files = shard_filenames(output_filename)
+            stale = [header_filename] + shard_files
+        else:
+            stale = [output_filename]
+        for filename in stale:
+            if os.path.exists(filename):
+                os.remove(filename)
+        raise
+    for filename, text in files:
+        timed("write_output", write_output, filename, text)
+
+def batch_jobs(args):
+    """Parses wrapper.w=output arguments for batch mode.  Returns a list of
+       (output, [wrapper files]) in order of first appearance.  Wrapper files
+       mapped to the same output are generated into it together, in order.
+    """
+    jobs = []
+    files = {}
+    for arg in args:
+        if not "=" in arg:
+            sys.stderr.write("Error: batch arguments must look like wrapper.w=output, got '%s'.\n" % arg)
+            usage()
+        wrapper_file, output_filename = arg.rsplit("=", 1)
+        if not output_filename in files:
+            files[output_filename] = []
+            jobs.append((output_filename, files[output_filename]))
+        files[output_filename].append(wrapper_file)
+    return jobs
+
+def generate_job(job):
+    """Generates one batch output.  Returns False if it had syntax errors."""
+    output_filename, wrapper_files = job
+    try:
+        generate_file(wrapper_files, output_filename)
+        return True
+    except WrapSyntaxError:
+        return False
+
+def generate_worker_job(job):
+    """Runs generate_job() in a worker.  Returns its result, and the job's profile
+       data if profiling."""
+    global profile
+    if profile is not None:
+        profile = Profile()
+    return generate_job(job), profile.data() if profile is not None else None
+
+def generate_batch(jobs_list):
+    """Generates a list of (output, [wrapper files]) batch jobs.  Outputs are
+       generated on a pool of worker processes if jobs > 1.  Returns a list with
+       True for each output that succeeded."""
+    if jobs > 1 and len(jobs_list) > 1:
+        pool = fork_pool(min(jobs, len(jobs_list)))
+        if pool:
+            try:
+                results = pool.map(generate_worker_job, jobs_list)
+            finally:
+                pool.terminate()
+            for ok, data in results:
+                if data is not None:
+                    profile.merge(data)
+            return [ok for ok, data in results]
+    return [generate_job(job) for job in jobs_list]
+
+def write_profile(filename):
+    """Writes the profile of this run to filename as JSON, or to stderr if
+       filename is '-'."""
+    text = json.dumps(profile.report(), indent=2, sort_keys=True) + "\n"
+    if filename == "-":
+        sys.stderr.write(text)
+        return
+    try:
+        with open(filename, "w") as f:
+            f.write(text)
+    except (IOError, OSError):
+        sys.stderr.write("Error: couldn't open file " + filename + " for writing.\n")
+        sys.exit(1)
+
+# Seconds between checks for changed files in --watch mode.
+watch_interval = 0.1
+
+def file_stamp(path):
+    """Modification time and size of a file, or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+def watch(rules, depfile=None):
+    """Regenerates outputs when their wrapper files change, until interrupted.
+       rules is a list of (output, [wrapper files]).  The declarations from mpi.h
+       and the parsed wrapper files stay in memory, so only files that changed are
+       parsed again.  If mpi.h or a header it includes changes, the declarations
+       are reloaded and every output is regenerated."""
+    global mpi_functions_key
+    wrapper_files = set(f for output_filename, files in rules for f in files)
+    stamps = dict((path, file_stamp(path)) for path in wrapper_files | mpi_headers)
+    sys.stderr.write("Watching %d wrapper files and %d headers.  Press Ctrl-C to stop.\n"
+                     % (len(wrapper_files), len(mpi_headers)))
+    try:
+        while True:
+            time.sleep(watch_interval)
+            changed = set()
+            for path in stamps:
+                stamp = file_stamp(path)
+                if stamp != stamps[path]:
+                    stamps[path] = stamp
+                    changed.add(path)
+            if not changed:
+                continue
+
+            start = clock()
+            if changed - wrapper_files:
+                mpi_functions_key = None
+                load_mpi_functions()
+                for path in mpi_headers - set(stamps):
+                    stamps[path] = file_stamp(path)
+                todo = rules
+            else:
+                todo = [rule for rule in rules if changed & set(rule[1])]
+            # Editors can delete a file while saving it; wait until it's back.
+            todo = [rule for rule in todo if all(stamps[f] is not None for f in rule[1])]
+            if not todo:
+                continue
+
+            failed = [output_filename for output_filename, files in todo
+                      if not generate_job((output_filename, files))]
+            if depfile and todo is rules:
+                write_depfile(depfile, rules)
+            sys.stderr.write("Regenerated %s in %.1f ms%s.\n" % (
+                ", ".join(output_filename for output_filename, files in todo),
+                (clock() - start) * 1000, " (with errors)" if failed else ""))
+    except KeyboardInterrupt:
+        pass
+
+################################################################################
+# Main script:
+#   Get arguments, set up outer scope, parse files, generator wrappers.
+################################################################################
+def usage():
+    sys.stderr.write(usage_string)
+    sys.exit(2)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    global dump_prototypes, clear_cache, profile
+    options = {"includes" : list(includes)}
+    output_filename = None
+    depfile = None
+    profile_filename = None
+    watch_files = False
+    batch = False
+
+    # -MF is spelled like a compiler flag, which getopt can't parse as one option.
+    argv = ["--MF" if arg == "-MF" else arg for arg in argv]
+
+    try:
+        opts, args = getopt.gnu_getopt(argv, "abefsgtdwc:o:i:I:j:",
+                                       ["no-cache", "clear-cache", "cache-dir=", "shards=", "MF=", "sample=", "sample-interval=",
+                                        "profile=", "watch"])
+    except getopt.GetoptError as err:
+        sys.stderr.write(str(err) + "\n")
+        usage()
+
+    for opt, arg in opts:
+        if opt == "-b": batch = True
+        if opt == "--MF": depfile = arg
+        if opt == "--profile": profile_filename = arg
+        if opt == "--watch": watch_files = True
+        if opt == "-d": dump_prototypes = True
+        if opt == "-f": options["output_fortran_wrappers"] = True
+        if opt == "-a": options["fortran_aliases"] = True
+        if opt == "-e": options["runtime_enable"] = True
+        if opt == "-s": options["skip_headers"] = True
+        if opt == "-g": options["output_guards"] = True
+        if opt == "-t":
+            options["output_guards"] = True
+            options["thread_local_guards"] = True
+        if opt == "-w": options["ignore_deprecated"] = True
+        if opt == "-c": options["mpicc"] = arg
+        if opt == "-o": output_filename = arg
+        if opt == "--no-cache":    options["use_cache"] = False
+        if opt == "--clear-cache": clear_cache = True
+        if opt == "--cache-dir":   options["cache_dir"] = arg
+        if opt == "-j":
+            if not (arg.isdigit() and int(arg) > 0):
+                sys.stderr.write("ERROR: -j requires a positive number of jobs, got '%s'.\n" % arg)
+                usage()
+            options["jobs"] = int(arg)
+        if opt == "--shards":
+            if not (arg.isdigit() and int(arg) > 0):
+                sys.stderr.write("ERROR: --shards requires a positive number of shards, got '%s'.\n" % arg)
+                usage()
+            options["shards"] = int(arg)
+        if opt == "--sample" or opt == "--sample-interval":
+            if not arg.isdigit():
+                sys.stderr.write("ERROR: %s requires a number, got '%s'.\n" % (opt, arg))
+                usage()
+            if opt == "--sample":
+                options["sample_period"] = max(int(arg), 1)
+            else:
+                options["sample_interval"] = int(arg)
+        if opt == "-I":
+            stripped = arg.strip()
+            if stripped: options["includes"].append(stripped)
+        if opt == "-i":
+            if not arg in pmpi_init_bindings:
+                sys.stderr.write("ERROR: PMPI_Init binding must be one of:\n    %s\n" % " ".join(pmpi_init_bindings))
+                usage()
+            else:
+                options["pmpi_init_binding"] = arg
+    configure(**options)
+
+    if clear_cache:
+        clear_cache_files()
+        if len(args) < 1 and not dump_prototypes:
+            sys.exit(0)
+
+    if len(args) < 1 and not dump_prototypes:
+        usage()
+    if batch and output_filename:
+        sys.stderr.write("Error: -o can't be used with -b; outputs are given as wrapper.w=output.\n")
+        usage()
+    if shards > 1 and not (batch or output_filename) and not dump_prototypes:
+        sys.stderr.write("Error: --shards requires an output file (-o or -b).\n")
+        usage()
+    if depfile and not (batch or output_filename) and not dump_prototypes:
+        sys.stderr.write("Error: -MF requires an output file (-o or -b).\n")
+        usage()
+    if watch_files and not (batch or output_filename):
+        sys.stderr.write("Error: --watch requires an output file (-o or -b).\n")
+        usage()
+    if shards > 1 and skip_headers:
+        sys.stderr.write("Error: --shards can't be used with -s; shards are C translation units.\n")
+        usage()
+
+    if profile_filename:
+        profile = Profile()
+    try:
+        # If we're just dumping prototypes, print them and exit.
+        if dump_prototypes:
+            decls = load_mpi_declarations(mpicc, includes)
+            for decl in decls:
+                print(decl)
+            if not decls:
+                sys.stderr.write("Error: Found no declarations in mpi.h.\n")
+                sys.exit(1)
+            sys.exit(0)
+
+        # Parse mpi.h and put declarations into a map.
+        load_mpi_functions()
+
+        if batch or output_filename:
+            # Generate every output, and fail at the end if any of them had errors.
+            rules = batch_jobs(args) if batch else [(output_filename, args)]
+            ok = all(generate_batch(rules))
+            if ok and depfile:
+                write_depfile(depfile, rules)
+            if watch_files:
+                watch(rules, depfile)
+            if not ok:
+                sys.exit(1)
+
+        else:
+            try:
+                generate(args, sys.stdout)
+            except WrapSyntaxError:
+                sys.exit(1)
+    finally:
+        if profile_filename:
+            write_profile(profile_filename)
 
-except WrapSyntaxError:
-    output.close()
-    if output_filename: os.remove(output_filename)
-    sys.exit(1)
 
-output.close()
+if __name__ == "__main__":
+    main()
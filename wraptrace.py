@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Reads the trace files that {{trace}} writes.
+
+Wrappers that use {{trace}} write one file per process, <prefix>-<rank>.trace.
+This script prints the events in them, one line per call:
+
+    wraptrace.py [-s] [-n events] file.trace ...
+
+-s prints a summary of the calls to each function instead, and -n stops after
+that many events in each file.  To use the traces from Python, import this
+module and iterate over read_trace(), which decodes the file a chunk at a
+time, so it works on traces much bigger than memory.
+
+A file starts with a header (see wrap_trace_header in wrap.py), followed by
+chunks.  Each chunk starts with its size in bytes (not counting its 16-byte
+header), its number of events and the number of the thread that wrote it.
+The rest of it is a sequence of items, each a tag byte followed by unsigned
+LEB128 varints, with signed ones zigzag-encoded:
+
+    0  function       index, function ID
+    1  communicator   index, ID, size, rank in it (signed)
+    2  datatype       index, size, name length, name
+    3+ event          of the function defined with index tag - 3:
+                      start (signed, ticks after the previous event's start),
+                      duration in ticks, and then for functions that have them,
+                      communicator index + 1 (0 for none), peer's rank in
+                      MPI_COMM_WORLD (signed), and datatype index + 1 (0 for
+                      none) followed by count if it's not 0.
+
+Definitions apply until the end of the chunk, or until another one with the
+same index.  Which fields a function's events have is in a table of one
+byte per function at the end of the file, after a table of function names.
+"""
+from __future__ import print_function
+import collections, errno, getopt, os, struct, sys
+
+header_format = "=8sIIIIiidQQQQQ"
+chunk_format = "=IIII"
+
+# Item tags and the bits in the fields table.
+DEF_FN, DEF_COMM, DEF_TYPE, EVENT = range(4)
+HAS_COMM, HAS_PEER, HAS_BUFFER = 1, 2, 4
+
+Header = collections.namedtuple("Header", ["version", "header_size", "fn_count", "threads",
+                                           "rank", "size", "tick_seconds", "chunks", "events",
+                                           "dropped", "names", "fields"])
+Comm = collections.namedtuple("Comm", ["id", "size", "rank"])
+Datatype = collections.namedtuple("Datatype", ["name", "size"])
+
+# A call.  start and end are in seconds, comm and datatype are None if the call had none,
+# and peer is a rank in MPI_COMM_WORLD, or None if the function has no peer argument.
+Event = collections.namedtuple("Event", ["fn", "thread", "start", "end", "comm", "peer",
+                                         "datatype", "count"])
+
+class TraceError(Exception):
+    """Raised for files that aren't complete traces."""
+    pass
+
+def read_header(f):
+    """Reads the header of an open trace file, and the names and fields of its functions."""
+    data = f.read(struct.calcsize(header_format))
+    if len(data) < struct.calcsize(header_format):
+        raise TraceError("File is too short for a trace header.")
+    values = struct.unpack(header_format, data)
+    if values[0] != b"WRAPTRC\0":
+        raise TraceError("Not a trace file, or the program didn't call MPI_Finalize.")
+    header = Header(*values[1:])
+    if header.version != 2:
+        raise TraceError("Can't read version %d traces." % header.version)
+    if not header.names:
+        raise TraceError("Trace has no function table.")
+    f.seek(header.names)
+    names = [name.decode() for name in f.read(header.fields - header.names).split(b"\0")]
+    fields = bytearray(f.read(header.fn_count))
+    return header, names[:header.fn_count], fields
+
+class Chunk:
+    """Decodes the items in a chunk of a trace file."""
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+
+    def varint(self):
+        value, shift = 0, 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def signed(self):
+        value = self.varint()
+        return (value >> 1) ^ -(value & 1)
+
+    def name(self):
+        length = self.varint()
+        self.pos += length
+        if self.pos > len(self.data):
+            raise IndexError("name runs past the end of the chunk")
+        return self.data[self.pos - length:self.pos].decode()
+
+def read_trace(filename):
+    """Yields the Events in a trace file, in the order they were written.  Events from
+       one thread are in order; events from different threads are not."""
+    with open(filename, "rb") as f:
+        header, names, fields = read_header(f)
+        tick = header.tick_seconds
+        chunk_size = struct.calcsize(chunk_format)
+        offset = header.header_size
+        while offset + chunk_size <= header.names:
+            f.seek(offset)
+            data = f.read(chunk_size)
+            if len(data) < chunk_size:
+                raise TraceError("Chunk at offset %d is truncated." % offset)
+            size, events, thread, reserved = struct.unpack(chunk_format, data)
+            if not size:
+                break       # The process couldn't write the rest of the file.
+            data = f.read(size)
+            if len(data) < size:
+                raise TraceError("Chunk at offset %d is truncated." % offset)
+            chunk = Chunk(data)
+            fns, comms, types = {}, {}, {}
+            start = 0
+            try:
+                while chunk.pos < size:
+                    tag = chunk.data[chunk.pos]
+                    chunk.pos += 1
+                    if tag == DEF_FN:
+                        index = chunk.varint()
+                        fns[index] = chunk.varint()
+                    elif tag == DEF_COMM:
+                        index = chunk.varint()
+                        comms[index + 1] = Comm(chunk.varint(), chunk.varint(), chunk.signed())
+                    elif tag == DEF_TYPE:
+                        index = chunk.varint()
+                        type_size = chunk.varint()
+                        types[index + 1] = Datatype(chunk.name(), type_size)
+                    else:
+                        fn = fns[tag - EVENT]
+                        start += chunk.signed()
+                        end = start + chunk.varint()
+                        comm = peer = datatype = None
+                        count = 0
+                        if fields[fn] & HAS_COMM:
+                            comm = comms.get(chunk.varint())
+                        if fields[fn] & HAS_PEER:
+                            peer = chunk.signed()
+                        if fields[fn] & HAS_BUFFER:
+                            datatype = types.get(chunk.varint())
+                            if datatype:
+                                count = chunk.varint()
+                        yield Event(names[fn], thread, start * tick, end * tick, comm, peer,
+                                    datatype, count)
+            except (IndexError, KeyError, UnicodeDecodeError):
+                raise TraceError("Chunk at offset %d is truncated or corrupt." % offset)
+            offset += chunk_size + size
+
+def print_events(filename, limit=None):
+    for n, event in enumerate(read_trace(filename)):
+        if limit is not None and n >= limit:
+            break
+        line = "%-24s thread %-3d %.9f %10.3f us" % (
+            event.fn, event.thread, event.start, (event.end - event.start) * 1e6)
+        if event.comm:
+            line += "  comm %d (%d of %d)" % (event.comm.id, event.comm.rank, event.comm.size)
+        if event.peer is not None:
+            line += "  peer %d" % event.peer
+        if event.datatype:
+            line += "  %d x %s (%d bytes)" % (event.count, event.datatype.name or "?",
+                                             event.count * event.datatype.size)
+        print(line)
+
+def print_summary(filename):
+    with open(filename, "rb") as f:
+        header = read_header(f)[0]
+    print("%s: rank %d of %d, %d threads, %d events, %d dropped" % (
+        filename, header.rank, header.size, header.threads, header.events, header.dropped))
+    calls, seconds, nbytes = {}, {}, {}
+    for event in read_trace(filename):
+        calls[event.fn] = calls.get(event.fn, 0) + 1
+        seconds[event.fn] = seconds.get(event.fn, 0) + event.end - event.start
+        if event.datatype:
+            nbytes[event.fn] = nbytes.get(event.fn, 0) + event.count * event.datatype.size
+    print("%-24s %10s %12s %14s" % ("function", "calls", "seconds", "bytes"))
+    for fn in sorted(calls, key=lambda fn: -seconds[fn]):
+        print("%-24s %10d %12.6f %14d" % (fn, calls[fn], seconds[fn], nbytes.get(fn, 0)))
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "sn:")
+    opts = dict(opts)
+    if not args:
+        print(__doc__.split("\n\n")[2].strip(), file=sys.stderr)
+        sys.exit(1)
+    for filename in args:
+        try:
+            if "-s" in opts:
+                print_summary(filename)
+            else:
+                print_events(filename, int(opts["-n"]) if "-n" in opts else None)
+        except TraceError as e:
+            print("%s: %s" % (filename, e), file=sys.stderr)
+            sys.exit(1)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # The reader went away (e.g. wraptrace.py file.trace | head).  Point stdout
+            # at /dev/null so that flushing it at exit doesn't fail again.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()